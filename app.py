@@ -1,18 +1,30 @@
-from flask import Flask, render_template, request, send_file, jsonify
-import wrds
+from flask import Flask, render_template, request, send_file, jsonify, Response, stream_with_context
 import pandas as pd
 from datetime import datetime
 import os
-import threading
+import json
+import hashlib
 import time
-import sys
 from waitress import serve
 import configparser
 import traceback
 from dotenv import load_dotenv
-import psycopg2
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 from collections import deque
+from db_pool import get_engine, get_pool_status
+from job_manager import JobManager, COMPLETE, ERROR
+from metadata_cache import MetadataCache
+from wrds_export import (find_pagination_key, build_keyset_query, pop_last_key, copy_export,
+                         iter_copy_export, get_column_types, estimate_row_count, format_row_count,
+                         SelectSpec, date_range_filters, estimate_query_rows, table_fingerprint, get_distinct_ratios,
+                         CTID_KEY)
+from output_formats import (OUTPUT_FORMATS, open_writer, file_extension, format_mimetype, arrow_schema_from_columns,
+                            supports_resume)
+from checkpoint import DownloadCheckpoint, claim_download, release_download
+from result_cache import ResultCache, cache_key, link_or_copy
+from dtype_mapper import DtypeMapper, frame_memory
+from pipeline import run_pipeline
+from file_streaming import available_encodings, encode_chunks, iter_file, iter_growing_file
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-here'
@@ -24,15 +36,6 @@ config.read('config.ini')
 # 載入環境變量
 load_dotenv()
 
-# 全局變數來追蹤下載進度
-download_status = {
-    'status': 'idle',
-    'step': 0,
-    'progress': 0,
-    'filename': '',
-    'error': None
-}
-
 # 創建錯誤日誌列表（最多保存100條記錄）
 error_logs = deque(maxlen=100)
 
@@ -56,44 +59,24 @@ def log_error(error_msg, error_obj=None):
         print(details)
     print("="*50 + "\n")
 
-def reset_status():
-    global download_status
-    download_status.update({
-        'status': 'idle',
-        'step': 0,
-        'progress': 0,
-        'filename': '',
-        'error': None
-    })
+def update_status(job, step, status='processing', **kwargs):
+    """更新下載任務的進度（直接調用 fetch_wrds_data 時 job 為 None）"""
+    if job is None:
+        return
+    job.update(status=status, step=step, **kwargs)
 
-def update_status(step, status='processing', **kwargs):
-    global download_status
-    download_status.update({
-        'status': status,
-        'step': step,
-        **kwargs
-    })
+def describe_progress(action, rows, total_rows, exact):
+    """計算進度百分比和狀態文字；總行數為估算值時百分比最多顯示 99%"""
+    fraction = rows / max(total_rows, 1)
+    if not exact:
+        fraction = min(fraction, 0.99)
+    progress = min(95, 40 + fraction * 55)
+    return progress, f'{action} {rows:,}/{format_row_count(total_rows, exact)} 行 ({fraction*100:.1f}%)'
 
 def get_wrds_connection():
     try:
-        # 從環境變量獲取連接信息
-        username = os.getenv('WRDS_USERNAME')
-        password = os.getenv('WRDS_PASSWORD')
-        
-        if not username or not password:
-            raise ValueError("未設置 WRDS 帳號或密碼")
-            
-        # 建立連接
-        conn = psycopg2.connect(
-            host='wrds-pgdata.wharton.upenn.edu',
-            port=9737,  # 修改為正確的端口
-            database='wrds',
-            user=username,
-            password=password,
-            sslmode='require'
-        )
-        
-        print(f"成功連接到 WRDS 數據庫 (用戶名: {username})")
+        # 從共用連接池取得連接（close() 會把連接歸還連接池）
+        conn = get_engine().raw_connection()
         return conn
         
     except Exception as e:
@@ -101,24 +84,35 @@ def get_wrds_connection():
         log_error(error_msg, e)
         return None
 
-def fetch_wrds_data(table_name):
+# 下載結果緩存：總大小上限（位元組，0 為停用）；視圖等沒有目錄指紋的結果最多保存 RESULT_CACHE_MAX_AGE 秒
+result_cache = ResultCache(os.getenv('RESULT_CACHE_DIR', os.path.join('downloads', 'cache')),
+                           max_bytes=int(os.getenv('RESULT_CACHE_MAX_BYTES', str(10 * 1024 ** 3))),
+                           max_age=int(os.getenv('RESULT_CACHE_MAX_AGE', '86400')))
+
+# 抓取和寫入之間最多排隊的批次數（每批 10 萬行）
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', '2'))
+
+def fetch_wrds_data(table_name, pagination='keyset', export_engine='pandas', output_format='csv',
+                    exact_count=False, columns=None, filters=None, limit=None, use_cache=True, compact_dtypes=True,
+                    job=None):
+    claimed_path = None
     try:
         print(f"\n開始下載表格: {table_name}")
         
         # 檢查表格名稱格式
         if '.' not in table_name:
             error_msg = "請使用 'schema.table_name' 格式（例如：'ciqsamp.capstrct'）"
-            update_status(0, status='error', error=error_msg)
+            update_status(job, 0, status='error', error=error_msg)
             raise Exception(error_msg)
         
         schema_name, table_name = table_name.split('.')
         
-        # 步驟 1: 連接到 WRDS
-        update_status(0, progress=10, status='連接到 WRDS 數據庫...')
-        engine = create_engine(f"postgresql://{os.getenv('WRDS_USERNAME')}:{os.getenv('WRDS_PASSWORD')}@{os.getenv('WRDS_HOST')}:{os.getenv('WRDS_PORT')}/{os.getenv('WRDS_DB')}")
+        # 步驟 1: 連接到 WRDS（使用共用連接池）
+        update_status(job, 0, progress=10, status='連接到 WRDS 數據庫...')
+        engine = get_engine()
         
         # 步驟 2: 檢查表格是否存在
-        update_status(1, progress=20, status='檢查表格是否存在...')
+        update_status(job, 1, progress=20, status='檢查表格是否存在...')
         check_query = text("""
             SELECT EXISTS (
                 SELECT 1 
@@ -132,95 +126,247 @@ def fetch_wrds_data(table_name):
             result = conn.execute(check_query, {"schema": schema_name, "table": table_name}).scalar()
             if not result:
                 error_msg = f"表格 {schema_name}.{table_name} 不存在"
-                update_status(0, status='error', error=error_msg)
+                update_status(job, 0, status='error', error=error_msg)
                 raise Exception(error_msg)
             
-            # 步驟 3: 獲取表格大小信息
-            update_status(2, progress=30, status='獲取表格信息...')
-            size_query = text("""
-                SELECT COUNT(*) 
-                FROM {}.{}
-            """.format(schema_name, table_name))
-            
-            total_rows = conn.execute(size_query).scalar()
-            print(f"表格總行數: {total_rows}")
+            # 步驟 3: 獲取表格大小信息（默認使用統計信息估算，避免 COUNT(*) 全表掃描）
+            update_status(job, 2, progress=30, status='獲取表格信息...')
+            # 欄位投影、過濾條件和行數上限直接放進 SQL，欄位名稱對照表格欄位驗證
+            spec = SelectSpec(get_column_types(conn, schema_name, table_name), columns, filters, limit)
+            if spec.is_empty:
+                total_rows, rows_exact = estimate_row_count(conn, schema_name, table_name, exact=exact_count)
+                print(f"表格總行數: {format_row_count(total_rows, rows_exact)}")
+            else:
+                spec_query, spec_params = spec.query(schema_name, table_name)
+                total_rows, rows_exact = estimate_query_rows(conn, spec_query, spec_params, exact=exact_count)
+                print(f"篩選條件: {json.dumps(spec.to_dict(), ensure_ascii=False, default=str)}")
+                print(f"符合條件的行數: {format_row_count(total_rows, rows_exact)}")
             
             # 步驟 4: 分批下載數據
-            update_status(3, progress=40, status=f'開始下載數據 (總計 {total_rows:,} 行)...')
+            update_status(job, 3, progress=40, status=f'開始下載數據 (總計 {format_row_count(total_rows, rows_exact)} 行)...')
+            
+            # 設定輸出文件；上次中斷的下載沿用原來的文件名
+            downloads_dir = os.path.abspath('downloads')
+            os.makedirs('downloads', exist_ok=True)
+            extension = file_extension(output_format)
+            # 帶篩選條件的下載在文件名中加上條件的指紋，避免覆蓋整表下載
+            name_prefix = f'{schema_name}_{table_name}_'
+            if not spec.is_empty:
+                spec_json = json.dumps(spec.to_dict(), sort_keys=True, default=str)
+                name_prefix += hashlib.sha1(spec_json.encode('utf-8')).hexdigest()[:8] + '_'
+            current_date = datetime.now().strftime('%Y%m%d')
+            
+            # 相同的請求已有緩存、且表格在目錄中沒有變化時，直接使用緩存的文件
+            result_key = fingerprint = None
+            if result_cache.enabled:
+                result_key = cache_key(f'{schema_name}.{table_name}', output_format,
+                                       spec.columns, spec.filters, spec.limit, compact_dtypes, export_engine)
+                fingerprint = table_fingerprint(conn, schema_name, table_name)
+                if use_cache:
+                    entry = result_cache.lookup(result_key, f'{schema_name}.{table_name}', fingerprint)
+                    if entry is not None:
+                        output_path = os.path.join(downloads_dir, f'{name_prefix}{current_date}{extension}')
+                        link_or_copy(entry['path'], output_path)
+                        output_filename = os.path.basename(output_path)
+                        print(f"使用緩存的下載結果: {output_filename}（{entry['rows']:,} 行）")
+                        update_status(job, 6,
+                                     status='complete',
+                                     filename=output_filename,
+                                     filepath=output_path,
+                                     total_rows=entry['rows'],
+                                     cached=True,
+                                     progress=100)
+                        return output_path, output_filename
             
-            # 設置批次大小
-            batch_size = 100000  # 每次下載10萬行
-            total_batches = (total_rows + batch_size - 1) // batch_size
+            # 同時執行的任務各自佔用不同的文件，不會續傳、清除或改名其他任務正在寫入的臨時文件
+            output_path = claimed_path = claim_download(downloads_dir, name_prefix, extension)
+            output_filename = os.path.basename(output_path)
             
-            all_data = []
-            downloaded_rows = 0
-            for batch_num in range(total_batches):
-                offset = batch_num * batch_size
-                batch_query = text(f"""
-                    SELECT * 
-                    FROM {schema_name}.{table_name}
-                    LIMIT :batch_size OFFSET :offset
-                """)
+            # 數據先寫入 .part 臨時文件，完成後才改名為最終文件
+            checkpoint_signature = {
+                'table': f'{schema_name}.{table_name}',
+                'format': output_format,
+                'engine': export_engine,
+                'pagination': pagination,
+                'spec': spec.to_dict(),
+                'compact_dtypes': compact_dtypes,
+            }
+            
+            # COPY 只能輸出 CSV，其他格式需要經過 pandas
+            if export_engine == 'copy' and output_format != 'csv':
+                print(f"COPY 引擎不支援 {output_format} 格式，改用 pandas 分批下載")
+                export_engine = 'pandas'
+            
+            timings = None
+            if export_engine == 'copy':
+                # COPY 引擎：由 PostgreSQL 直接輸出 CSV，不經過 pandas
+                print("使用 COPY TO STDOUT 匯出")
                 
-                print(f"下載批次 {batch_num + 1}/{total_batches}")
-                batch_df = pd.read_sql_query(
-                    batch_query, 
-                    conn, 
-                    params={"batch_size": batch_size, "offset": offset}
-                )
-                all_data.append(batch_df)
+                def report_copy_progress(rows):
+                    progress, status = describe_progress('已匯出', rows, total_rows, rows_exact)
+                    update_status(job, 3, progress=progress, status=status)
                 
-                # 更新已下載行數和進度
-                downloaded_rows += len(batch_df)
-                progress = min(90, 40 + (downloaded_rows / total_rows * 50))
-                update_status(3, 
-                            progress=progress, 
-                            status=f'已下載 {downloaded_rows:,}/{total_rows:,} 行 ({(downloaded_rows/total_rows*100):.1f}%)')
+                checkpoint = DownloadCheckpoint(output_path, checkpoint_signature)
+                checkpoint.discard()
+                checkpoint.save(last_key=None, rows=0, batches=0, bytes=0)
+                copy_query, copy_params = spec.query(schema_name, table_name)
+                with open(checkpoint.part_path, 'wb') as f:
+                    update_status(job, 3, filename=output_filename, partial_path=checkpoint.part_path)
+                    downloaded_rows = copy_export(
+                        engine, copy_query, f, params=copy_params,
+                        progress_callback=report_copy_progress)
+            else:
+                # 設置批次大小
+                batch_size = 100000  # 每次下載10萬行
+                total_batches = (total_rows + batch_size - 1) // batch_size
                 
-                # 強制更新狀態
-                time.sleep(0.1)
-            
-            # 步驟 5: 合併數據
-            update_status(4, progress=90, status=f'合併 {len(all_data)} 個數據批次...')
-            df = pd.concat(all_data, ignore_index=True)
-            print(f"數據下載完成，總計 {len(df):,} 行")
-            
-            # 步驟 6: 保存文件
-            update_status(5, progress=95, status=f'保存 {len(df):,} 行數據到文件...')
-            current_date = datetime.now().strftime('%Y%m%d')
-            output_filename = f'{schema_name}_{table_name}_{current_date}.csv'
+                # 尋找 keyset 分頁的排序鍵，找不到時退回 LIMIT/OFFSET
+                key_columns = None
+                if pagination == 'keyset':
+                    key_columns = find_pagination_key(conn, schema_name, table_name)
+                if key_columns:
+                    print(f"使用 keyset 分頁，排序鍵: {', '.join(key_columns)}")
+                else:
+                    print("使用 LIMIT/OFFSET 分頁")
+                
+                # 由表格欄位類型固定輸出 schema，避免各批次的 dtype 不一致
+                arrow_schema = None
+                if output_format != 'csv':
+                    arrow_schema = arrow_schema_from_columns(spec.output_columns())
+                
+                # 按欄位類型把每批數據轉換成緊湊的 dtype（可空整數、category 等），減少記憶體用量
+                dtypes = None
+                if compact_dtypes:
+                    dtypes = DtypeMapper(spec.table_columns, get_distinct_ratios(conn, schema_name, table_name),
+                                         row_count=total_rows)
+                
+                # keyset 分頁的 CSV 下載每批之後保存檢查點，中斷後從最後提交的鍵值繼續
+                checkpoint = DownloadCheckpoint(output_path, dict(
+                    checkpoint_signature, key_columns=key_columns, batch_size=batch_size))
+                resumable = bool(key_columns) and supports_resume(output_format)
+                state = checkpoint.resume() if resumable else None
+                if state is None:
+                    checkpoint.discard()
+                    checkpoint.save(last_key=None, rows=0, batches=0, bytes=0)
+                    batch_num = 0
+                    last_key = None
+                else:
+                    batch_num = state['batches']
+                    last_key = state['last_key']
+                    print(f"從上次中斷處繼續下載（已完成 {state['rows']:,} 行）")
+                
+                def fetch_batches(batch_num, last_key, rows):
+                    """抓取階段：按分頁逐批查詢，產生 (批次, 寫完該批後的分頁位置)"""
+                    while True:
+                        # 有行數上限時最後一批只取剩餘的行數
+                        current_batch = batch_size
+                        if spec.limit is not None:
+                            current_batch = min(batch_size, spec.limit - rows)
+                            if current_batch <= 0:
+                                return
+                        
+                        if key_columns:
+                            # 分頁需要排序鍵，不在投影中的鍵欄位取回後再移除
+                            extra = [] if key_columns == [CTID_KEY] else key_columns
+                            batch_query, params = build_keyset_query(
+                                schema_name, table_name, key_columns, last_key, current_batch,
+                                select=spec.select_list(extra), conditions=spec.conditions,
+                                condition_params=spec.params)
+                        else:
+                            where = "WHERE " + " AND ".join(spec.conditions) if spec.conditions else ""
+                            batch_query = text(f"""
+                                SELECT {spec.select_list()}
+                                FROM {schema_name}.{table_name}
+                                {where}
+                                LIMIT :batch_size OFFSET :offset
+                            """)
+                            params = dict(spec.params, batch_size=current_batch, offset=batch_num * batch_size)
+                        
+                        print(f"下載批次 {batch_num + 1}/{'' if rows_exact else '約 '}{total_batches}")
+                        batch_df = pd.read_sql_query(batch_query, conn, params=params)
+                        batch_num += 1
+                        if key_columns:
+                            last_key = pop_last_key(batch_df, key_columns)
+                            if spec.columns is not None:
+                                batch_df = batch_df[spec.columns]
+                        # 空表也寫出標題行
+                        if batch_df.empty and rows > 0:
+                            return
+                        rows += len(batch_df)
+                        last_batch = len(batch_df) < current_batch
+                        yield batch_df, {'last_key': last_key, 'batches': batch_num, 'last': last_batch}
+                        if last_batch:
+                            return
+                
+                def convert_batch(item):
+                    """轉換階段：把批次轉換成緊湊的 dtype，第一批顯示轉換前後的記憶體用量"""
+                    batch_df, position = item
+                    raw_memory = frame_memory(batch_df) if position['batches'] == 1 else None
+                    batch_df = dtypes.apply(batch_df)
+                    if raw_memory:
+                        print(f"每批記憶體用量: {raw_memory / 1024 ** 2:.1f} MB -> "
+                              f"{frame_memory(batch_df) / 1024 ** 2:.1f} MB")
+                    return batch_df, position
+                
+                with open_writer(output_format, checkpoint.part_path, arrow_schema,
+                                 resume_rows=state['rows'] if state else None) as writer:
+                    # 下載過程中即可經由 /download_file 邊寫邊送臨時文件
+                    update_status(job, 3, filename=output_filename, partial_path=checkpoint.part_path)
+                    
+                    def write_batch(item):
+                        """寫入階段：寫入一批、更新進度，並保存寫完該批後的檢查點"""
+                        batch_df, position = item
+                        writer.write_batch(batch_df)
+                        progress, status = describe_progress('已下載並寫入', writer.rows_written, total_rows,
+                                                             rows_exact)
+                        update_status(job, 3, progress=progress, status=status)
+                        if resumable and not position['last']:
+                            checkpoint.save(last_key=position['last_key'], rows=writer.rows_written,
+                                            batches=position['batches'], bytes=writer.flush())
+                    
+                    # 下一批的查詢與本批的轉換和寫入同時進行，隊列滿時抓取線程等待
+                    timings = run_pipeline(fetch_batches(batch_num, last_key, writer.rows_written), write_batch,
+                                           transform=convert_batch if dtypes is not None else None,
+                                           max_pending=PIPELINE_QUEUE_SIZE)
+                    print(f"各階段耗時: {timings.summary()}")
+                
+                downloaded_rows = writer.rows_written
             
-            # 獲取完整的下載路徑
-            downloads_dir = os.path.abspath('downloads')
-            output_path = os.path.join(downloads_dir, output_filename)
+            checkpoint.finish()
+            if result_key is not None:
+                result_cache.store(result_key, f'{schema_name}.{table_name}', output_format, output_path,
+                                   downloaded_rows, fingerprint)
             
-            os.makedirs('downloads', exist_ok=True)
-            df.to_csv(output_path, index=False)
+            print(f"數據下載完成，總計 {downloaded_rows:,} 行")
             
             # 完成，包含完整的文件路徑信息
-            update_status(6, 
+            update_status(job, 6, 
                          status='complete', 
                          filename=output_filename,
                          filepath=output_path,  # 添加完整路徑
-                         total_rows=len(df),    # 添加總行數
+                         total_rows=downloaded_rows,    # 添加總行數
+                         timings=timings.to_dict() if timings else None,
                          progress=100)
             
             print(f"\n下載完成！")
             print(f"文件名稱: {output_filename}")
             print(f"保存位置: {output_path}")
-            print(f"數據行數: {len(df):,}")
+            print(f"數據行數: {downloaded_rows:,}")
             
             return output_path, output_filename
         
     except Exception as e:
         error_msg = f"數據下載錯誤: {str(e)}"
         log_error(error_msg, e)
-        update_status(0, status='error', error=str(e))
+        update_status(job, 0, status='error', error=str(e))
         raise Exception(error_msg)
+    finally:
+        if claimed_path is not None:
+            release_download(claimed_path)
 
 def get_available_tables():
     try:
-        engine = create_engine(f"postgresql://{os.getenv('WRDS_USERNAME')}:{os.getenv('WRDS_PASSWORD')}@{os.getenv('WRDS_HOST')}:{os.getenv('WRDS_PORT')}/{os.getenv('WRDS_DB')}")
+        engine = get_engine()
         with engine.connect() as conn:
             query = text("""
                 SELECT table_schema, table_name 
@@ -235,66 +381,309 @@ def get_available_tables():
         log_error(error_msg, e)
         raise
 
+# 元數據緩存：各端點的 TTL（秒），條目數上限可用環境變量調整
+METADATA_TTLS = {
+    'tables': int(os.getenv('METADATA_TTL_TABLES', '3600')),
+    'wrds_libraries': int(os.getenv('METADATA_TTL_LIBRARIES', '21600')),
+    'database_tables': int(os.getenv('METADATA_TTL_DATABASE_TABLES', '3600')),
+    'table_columns': int(os.getenv('METADATA_TTL_TABLE_COLUMNS', '3600')),
+}
+metadata_cache = MetadataCache(max_entries=int(os.getenv('METADATA_CACHE_SIZE', '512')))
+
+def cached_metadata(key, loader):
+    """從元數據緩存讀取；請求帶有 refresh=1 時先使緩存失效"""
+    if request.args.get('refresh') == '1':
+        metadata_cache.invalidate(*key)
+    return metadata_cache.get_or_load(key, loader, METADATA_TTLS[key[0]])
+
+# 進度事件流沒有變化時發送心跳的間隔（秒）
+SSE_HEARTBEAT_SECONDS = 15
+
+# 下載任務登記表，線程池大小決定同時執行的下載數量
+download_jobs = JobManager(fetch_wrds_data, max_workers=int(os.getenv('WRDS_DOWNLOAD_WORKERS', '2')))
+
+# 任務尚未開始寫入文件時，/download_file 等待的最長時間（秒）
+STREAM_START_TIMEOUT = int(os.getenv('STREAM_START_TIMEOUT', '300'))
+
+def choose_encoding():
+    """選擇回應的內容編碼：compress 參數優先，否則按 Accept-Encoding；Range 請求不壓縮"""
+    requested = request.args.get('compress')
+    if requested == 'none' or request.range is not None:
+        return None
+    if requested:
+        return requested
+    return request.accept_encodings.best_match(available_encodings())
+
+def wait_for_job_file(job):
+    """等待任務開始寫入臨時文件或結束，返回是否已可讀取"""
+    deadline = time.monotonic() + STREAM_START_TIMEOUT
+    version = -1
+    while not job.is_finished and not job.get('partial_path'):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        version = job.wait_for_change(version, timeout=remaining)
+    return True
+
+def send_job_file(job):
+    """返回任務的輸出文件：已完成的文件支援 Range 續傳；仍在下載時邊寫邊送；可按 Accept-Encoding 即時壓縮"""
+    if job is None:
+        return jsonify({'error': 'No download available'}), 400
+    requested = request.args.get('compress')
+    if requested and requested not in ['none'] + available_encodings():
+        return jsonify({'error': f"compress must be one of none, {', '.join(available_encodings())}"}), 400
+    if not wait_for_job_file(job):
+        return jsonify({'error': 'Download has not started yet'}), 503
+    if job.state != COMPLETE and job.is_finished:
+        return jsonify({'error': 'No completed download available'}), 400
+    
+    encoding = choose_encoding()
+    chunks = None
+    if job.state != COMPLETE:
+        # 打開臨時文件之後即使下載完成、文件被改名也可以繼續讀取
+        try:
+            part_file = open(job.get('partial_path'), 'rb')
+        except FileNotFoundError:
+            part_file = None
+        if part_file is not None:
+            def finished():
+                if job.state == ERROR:
+                    raise IOError(f"下載失敗: {job.get('error')}")
+                return job.state == COMPLETE
+            chunks = iter_growing_file(part_file, finished)
+        else:
+            # 臨時文件剛被改名：等任務結束後返回完整文件
+            version = -1
+            while not job.is_finished:
+                version = job.wait_for_change(version, timeout=SSE_HEARTBEAT_SECONDS)
+            if job.state != COMPLETE:
+                return jsonify({'error': 'No completed download available'}), 400
+    
+    file_path = job.get('filepath')
+    if chunks is None:
+        if not file_path or not os.path.exists(file_path):
+            return jsonify({'error': 'File not found'}), 404
+        if encoding is None:
+            # 完整文件由 send_file 處理 Range / If-Range 續傳請求
+            return send_file(
+                file_path,
+                mimetype=format_mimetype(file_path),
+                as_attachment=True,
+                download_name=job.get('filename'),
+                conditional=True
+            )
+        chunks = iter_file(file_path)
+    
+    filename = job.get('filename')
+    headers = {
+        'Content-Disposition': f'attachment; filename={filename}',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+        'Vary': 'Accept-Encoding',
+    }
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return Response(
+        stream_with_context(encode_chunks(chunks, encoding)),
+        mimetype=format_mimetype(filename),
+        headers=headers
+    )
+
 @app.route('/', methods=['GET'])
 def index():
-    reset_status()
     return render_template('index.html')
 
 @app.route('/start_download', methods=['POST'])
 def start_download():
     table_name = request.form.get('table_name')
+    pagination = request.form.get('pagination', 'keyset')
+    export_engine = request.form.get('export_engine', 'pandas')
+    output_format = request.form.get('output_format', 'csv')
+    exact_count = request.form.get('exact_count') == '1'
+    # refresh=1 時忽略緩存，重新從 WRDS 下載
+    use_cache = request.form.get('refresh') != '1'
+    compact_dtypes = request.form.get('compact_dtypes') != '0'
     if not table_name:
         return jsonify({'error': 'Please enter a table name'}), 400
+    if pagination not in ('keyset', 'offset'):
+        return jsonify({'error': 'pagination must be keyset or offset'}), 400
+    if export_engine not in ('pandas', 'copy'):
+        return jsonify({'error': 'export_engine must be pandas or copy'}), 400
+    if output_format not in OUTPUT_FORMATS:
+        return jsonify({'error': f"output_format must be one of {', '.join(OUTPUT_FORMATS)}"}), 400
+    
+    # 欄位投影（逗號分隔）、過濾條件（JSON 列表）、日期範圍和行數上限
+    columns = [col.strip() for col in request.form.get('columns', '').split(',') if col.strip()] or None
+    try:
+        filters = json.loads(request.form.get('filters') or '[]')
+    except ValueError:
+        return jsonify({'error': 'filters must be a JSON list'}), 400
+    if not isinstance(filters, list):
+        return jsonify({'error': 'filters must be a JSON list'}), 400
+    start_date = request.form.get('start_date')
+    end_date = request.form.get('end_date')
+    if start_date or end_date:
+        date_column = request.form.get('date_column')
+        if not date_column:
+            return jsonify({'error': 'date_column is required with start_date/end_date'}), 400
+        filters += date_range_filters(date_column, start_date, end_date)
+    limit = request.form.get('limit') or None
     
-    # 重置狀態
-    reset_status()
+    # 提交任務之前對照表格欄位驗證，錯誤直接返回給使用者
+    if columns or filters or limit:
+        if '.' not in table_name:
+            return jsonify({'error': "Please use the 'schema.table_name' format"}), 400
+        schema_name, name = table_name.split('.', 1)
+        try:
+            table_columns = cached_metadata(('table_columns', schema_name, name),
+                                            lambda: load_table_columns(schema_name, name))
+            spec = SelectSpec(table_columns, columns, filters, limit)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        limit = spec.limit
     
-    # 在背景執行下載
-    thread = threading.Thread(target=fetch_wrds_data, args=(table_name,))
-    thread.start()
+    # 登記任務，由線程池在背景執行
+    job = download_jobs.submit(table_name,
+                               pagination=pagination,
+                               export_engine=export_engine,
+                               output_format=output_format,
+                               exact_count=exact_count,
+                               columns=columns,
+                               filters=filters,
+                               limit=limit,
+                               use_cache=use_cache,
+                               compact_dtypes=compact_dtypes)
     
-    return jsonify({'status': 'processing'})
+    return jsonify({'status': job.state, 'job_id': job.id})
 
 @app.route('/progress')
 def progress():
-    return jsonify(download_status)
+    job_id = request.args.get('job_id')
+    job = download_jobs.get(job_id) if job_id else download_jobs.latest()
+    if job is None:
+        return jsonify({'status': 'idle', 'step': 0, 'progress': 0, 'filename': '', 'error': None})
+    return jsonify(job.to_dict())
 
 @app.route('/download_file')
 def download_file():
-    if download_status['status'] != 'complete':
-        return jsonify({'error': 'No completed download available'}), 400
+    job_id = request.args.get('job_id')
+    job = download_jobs.get(job_id) if job_id else download_jobs.latest()
+    return send_job_file(job)
+
+@app.route('/jobs')
+def list_jobs():
+    return jsonify({
+        'summary': download_jobs.summary(),
+        'jobs': [job.to_dict() for job in download_jobs.list_jobs()]
+    })
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    job = download_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """以 Server-Sent Events 推送任務進度，只有狀態變化時才發送"""
+    job = download_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
     
-    filename = download_status['filename']
-    file_path = os.path.join('downloads', filename)
+    def generate():
+        version = -1
+        while True:
+            new_version = job.wait_for_change(version, timeout=SSE_HEARTBEAT_SECONDS)
+            if new_version == version:
+                # 保持連接的心跳註釋
+                yield ": keep-alive\n\n"
+                continue
+            version = new_version
+            yield f"data: {json.dumps(job.to_dict(), ensure_ascii=False)}\n\n"
+            if job.is_finished:
+                break
     
-    if not os.path.exists(file_path):
-        return jsonify({'error': 'File not found'}), 404
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/jobs/<job_id>/file')
+def get_job_file(job_id):
+    job = download_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return send_job_file(job)
+
+@app.route('/stream_export')
+def stream_export():
+    """以 COPY TO STDOUT 直接把整個表格串流為 CSV 回應，不落地成文件"""
+    table_name = request.args.get('table_name', '')
+    if table_name.count('.') != 1:
+        return jsonify({'error': "請使用 'schema.table_name' 格式"}), 400
+    schema_name, table_name = table_name.split('.')
+    
+    try:
+        engine = get_engine()
+        check_query = text("""
+            SELECT EXISTS (
+                SELECT 1 
+                FROM information_schema.tables 
+                WHERE table_schema = :schema 
+                AND table_name = :table
+            )
+        """)
+        with engine.connect() as conn:
+            if not conn.execute(check_query, {"schema": schema_name, "table": table_name}).scalar():
+                return jsonify({'error': f'表格 {schema_name}.{table_name} 不存在'}), 404
+    except Exception as e:
+        error_msg = f"串流匯出錯誤: {str(e)}"
+        log_error(error_msg, e)
+        return jsonify({'error': error_msg}), 500
     
-    return send_file(
-        file_path,
+    output_filename = f"{schema_name}_{table_name}_{datetime.now().strftime('%Y%m%d')}.csv"
+    chunks = iter_copy_export(engine, f"SELECT * FROM {schema_name}.{table_name}")
+    return Response(
+        stream_with_context(chunks),
         mimetype='text/csv',
-        as_attachment=True,
-        download_name=filename
+        headers={'Content-Disposition': f'attachment; filename={output_filename}'}
     )
 
 @app.route('/tables')
 def get_tables():
     try:
-        tables = get_available_tables()
-        return jsonify(tables.to_dict(orient='records'))
+        tables = cached_metadata(('tables',), lambda: get_available_tables().to_dict(orient='records'))
+        return jsonify(tables)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/wrds_libraries')
 def get_wrds_libraries():
     try:
-        conn = get_wrds_connection()
-        if conn is None:
-            return jsonify({
-                'status': 'error',
-                'error': '無法連接到 WRDS 數據庫，請檢查連接設置'
-            })
+        libraries = cached_metadata(('wrds_libraries',), load_wrds_libraries)
         
+        return jsonify({
+            'status': 'success',
+            'libraries': libraries
+        })
+        
+    except Exception as e:
+        error_msg = f"獲取 WRDS 數據庫列表錯誤: {str(e)}"
+        log_error(error_msg, e)
+        return jsonify({
+            'status': 'error',
+            'error': error_msg
+        })
+
+def load_wrds_libraries():
+    """查詢 WRDS 上的所有數據庫及其類型"""
+    conn = get_wrds_connection()
+    if conn is None:
+        raise ConnectionError('無法連接到 WRDS 數據庫，請檢查連接設置')
+    
+    try:
         cursor = conn.cursor()
         
         # 使用子查詢來處理排序
@@ -332,55 +721,100 @@ def get_wrds_libraries():
         libraries = [{'library_name': row[0], 'type': row[1]} for row in cursor.fetchall()]
         
         cursor.close()
+        return libraries
+    finally:
         conn.close()
+
+@app.route('/database_tables/<schema_name>')
+def get_database_tables(schema_name):
+    try:
+        tables = cached_metadata(('database_tables', schema_name), lambda: load_database_tables(schema_name))
         
         return jsonify({
             'status': 'success',
-            'libraries': libraries
+            'tables': tables,
+            'total_count': len(tables)
         })
         
     except Exception as e:
-        error_msg = f"獲取 WRDS 數據庫列表錯誤: {str(e)}"
+        error_msg = f"獲取表格列表錯誤: {str(e)}"
         log_error(error_msg, e)
         return jsonify({
             'status': 'error',
             'error': error_msg
-        })
+        }), 500
 
-@app.route('/database_tables/<schema_name>')
-def get_database_tables(schema_name):
-    try:
-        conn = get_wrds_connection()
-        
-        # 查詢指定數據庫中的所有表格
-        query = text("""
-            SELECT 
-                table_name,
-                pg_size_pretty(pg_total_relation_size(quote_ident(table_schema) || '.' || quote_ident(table_name))) as size,
-                obj_description((quote_ident(table_schema) || '.' || quote_ident(table_name))::regclass, 'pg_class') as description
-            FROM information_schema.tables 
-            WHERE table_schema = :schema
-            AND table_type = 'BASE TABLE'
-            ORDER BY table_name;
-        """)
-        
+def load_database_tables(schema_name):
+    """查詢指定數據庫中所有表格的大小和描述"""
+    query = text("""
+        SELECT 
+            table_name,
+            pg_size_pretty(pg_total_relation_size(quote_ident(table_schema) || '.' || quote_ident(table_name))) as size,
+            obj_description((quote_ident(table_schema) || '.' || quote_ident(table_name))::regclass, 'pg_class') as description
+        FROM information_schema.tables 
+        WHERE table_schema = :schema
+        AND table_type = 'BASE TABLE'
+        ORDER BY table_name;
+    """)
+    
+    with get_engine().connect() as conn:
         result = pd.read_sql_query(query, conn, params={"schema": schema_name})
-        conn.close()
-        
+    return result.to_dict('records')
+
+@app.route('/table_columns/<schema_name>/<table_name>')
+def get_table_columns(schema_name, table_name):
+    try:
+        columns = cached_metadata(('table_columns', schema_name, table_name),
+                                  lambda: load_table_columns(schema_name, table_name))
         return jsonify({
             'status': 'success',
-            'tables': result.to_dict('records'),
-            'total_count': len(result)
+            'columns': [{'column_name': name, 'data_type': data_type} for name, data_type in columns],
+            'total_count': len(columns)
         })
-        
     except Exception as e:
-        error_msg = f"獲取表格列表錯誤: {str(e)}"
+        error_msg = f"獲取欄位列表錯誤: {str(e)}"
         log_error(error_msg, e)
         return jsonify({
             'status': 'error',
             'error': error_msg
         }), 500
 
+def load_table_columns(schema_name, table_name):
+    """查詢表格的欄位名稱和類型"""
+    with get_engine().connect() as conn:
+        return get_column_types(conn, schema_name, table_name)
+
+@app.route('/metadata/refresh', methods=['POST'])
+def refresh_metadata():
+    """使元數據緩存失效：可指定 endpoint（tables / wrds_libraries / database_tables / table_columns）和 schema"""
+    endpoint = request.values.get('endpoint')
+    schema_name = request.values.get('schema')
+    if endpoint and endpoint not in METADATA_TTLS:
+        return jsonify({'error': f"endpoint must be one of {', '.join(METADATA_TTLS)}"}), 400
+    
+    key = tuple(part for part in (endpoint, schema_name) if part)
+    removed = metadata_cache.invalidate(*key)
+    return jsonify({'status': 'success', 'invalidated': removed})
+
+@app.route('/metadata/stats')
+def metadata_stats():
+    return jsonify(metadata_cache.stats())
+
+@app.route('/result_cache/invalidate', methods=['POST'])
+def invalidate_result_cache():
+    """刪除下載結果緩存：可指定 table（schema.table），不指定時清空全部"""
+    table_name = request.values.get('table')
+    removed = result_cache.invalidate(table_name)
+    return jsonify({'status': 'success', 'invalidated': removed})
+
+@app.route('/result_cache/stats')
+def result_cache_stats():
+    return jsonify(result_cache.stats())
+
+@app.route('/pool_status')
+def pool_status():
+    return jsonify(get_pool_status())
+
 @app.route('/error_log')
 def error_log():
     return render_template('error_log.html', errors=list(error_logs))
@@ -399,4 +833,5 @@ if __name__ == '__main__':
     except Exception as e:
         print(f"WRDS 連接測試失敗：{str(e)}")
     
-    serve(app, host='0.0.0.0', port=5006) 
\ No newline at end of file
+    # 每個進度事件流會佔用一個線程，因此預留比默認更多的線程
+    serve(app, host='0.0.0.0', port=5006, threads=int(os.getenv('WAITRESS_THREADS', '16'))) 
\ No newline at end of file
@@ -0,0 +1,413 @@
+"""匯出效能測試：在本機 PostgreSQL 生成模擬 WRDS 結構的表格，逐一執行 app.py 和 download_all_tables.py
+的匯出路徑，把 rows/s、MB/s、峰值記憶體和首批數據寫出時間輸出為 JSON，用於比較不同 commit 的效能
+
+    python benchmarks/run_benchmarks.py run --dsn postgresql://postgres@localhost/postgres --sizes 1M,10M
+    python benchmarks/run_benchmarks.py compare benchmarks/results/舊.json benchmarks/results/新.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import pandas as pd
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from synthetic_schema import DATASETS, SIZES, parse_size, build_dataset, dataset_info
+
+# 結果 JSON 的格式版本
+RESULT_VERSION = 1
+
+DEFAULT_DSN = os.getenv('BENCHMARK_DSN', 'postgresql://postgres@localhost:5432/postgres')
+DEFAULT_RESULTS_DIR = os.path.join(BENCHMARK_DIR, 'results')
+
+# 輸出文件超過此大小才算寫出了第一批數據（不計 CSV 標題行和 Parquet 文件頭）
+FIRST_BYTE_MIN_BYTES = 64 * 1024
+FIRST_BYTE_POLL_SECONDS = 0.005
+
+# raw 路徑一次把整個表格讀入記憶體，超過此行數時除非在 --paths 中明確指定，否則跳過
+RAW_MAX_ROWS = 10000000
+
+# 匯出路徑: 名稱 -> (模組, 說明)
+PATHS = {
+    'app-offset': ('app', 'fetch_wrds_data: LIMIT/OFFSET 分批，CSV'),
+    'app-keyset': ('app', 'fetch_wrds_data: keyset 分批，CSV'),
+    'app-copy': ('app', 'fetch_wrds_data: COPY TO STDOUT，CSV'),
+    'app-parquet': ('app', 'fetch_wrds_data: keyset 分批，Parquet'),
+    'app-feather': ('app', 'fetch_wrds_data: keyset 分批，Feather'),
+    'bulk-raw': ('download_all_tables', 'download_table: raw_sql 一次讀取整個表格，CSV'),
+    'bulk-stream': ('download_all_tables', 'download_table: stream 引擎（按主鍵分批），CSV'),
+    'bulk-cursor': ('download_all_tables', 'export_query: 伺服器端游標串流，CSV'),
+    'bulk-copy': ('download_all_tables', 'download_table: copy 引擎（按主鍵分批 COPY），CSV'),
+    'bulk-parquet': ('download_all_tables', 'download_table: 伺服器端游標串流，Parquet'),
+    'bulk-feather': ('download_all_tables', 'download_table: 伺服器端游標串流，Feather'),
+}
+
+class LocalConnection:
+    """代替 wrds.Connection 連接本機 PostgreSQL，提供 download_all_tables.py 使用的 engine、connection 和 raw_sql"""
+
+    def __init__(self, dsn):
+        self.engine = create_engine(dsn)
+        self.connection = self.engine.connect()
+
+    def raw_sql(self, sql, params=None, **kwargs):
+        return pd.read_sql_query(text(sql), self.connection, params=params)
+
+    def close(self):
+        self.connection.close()
+        self.engine.dispose()
+
+def set_wrds_environment(dsn):
+    """讓 db_pool.get_engine()（app.py 使用）連接到 dsn 指定的資料庫"""
+    url = make_url(dsn)
+    os.environ.update({
+        'WRDS_USERNAME': url.username or 'postgres',
+        # db_pool 要求設置密碼；本機 trust 認證時不會用到
+        'WRDS_PASSWORD': url.password or 'benchmark',
+        'WRDS_HOST': url.host or url.query.get('host', 'localhost'),
+        'WRDS_PORT': str(url.port or 5432),
+        'WRDS_DB': url.database or 'postgres',
+        'WRDS_SSLMODE': url.query.get('sslmode', 'prefer'),
+        # 每次都實際下載，不使用結果緩存
+        'RESULT_CACHE_MAX_BYTES': '0',
+    })
+
+def peak_rss_bytes():
+    """目前進程的峰值常駐記憶體；不支援的平台返回 None"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KB 為單位，macOS 以位元組為單位
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class FirstByteWatcher:
+    """輪詢工作目錄，記錄輸出文件（包括 .part 臨時文件）第一次超過 FIRST_BYTE_MIN_BYTES 的時間"""
+
+    def __init__(self, directory, extension):
+        self.directory = directory
+        self.extension = extension
+        self.seconds = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _output_bytes(self):
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if self.extension in name and not name.endswith('.json'):
+                    try:
+                        total += os.path.getsize(os.path.join(root, name))
+                    except OSError:
+                        pass
+        return total
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self._output_bytes() >= FIRST_BYTE_MIN_BYTES:
+                self.seconds = time.perf_counter() - self.started
+                return
+            time.sleep(FIRST_BYTE_POLL_SECONDS)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+class StatusRecorder:
+    """傳給 app.fetch_wrds_data 的 job，保存最後的下載狀態（行數、各階段耗時）"""
+
+    def __init__(self):
+        self.status = {}
+
+    def update(self, **kwargs):
+        self.status.update(kwargs)
+
+def run_case(case):
+    """在子進程中執行一個匯出路徑，返回該次的測量結果"""
+    set_wrds_environment(case['dsn'])
+    work_dir = case['work_dir']
+    os.chdir(work_dir)
+    schema_name, table = case['table'].split('.')
+    path = case['path']
+    output_format = {'app-parquet': 'parquet', 'app-feather': 'feather',
+                     'bulk-parquet': 'parquet', 'bulk-feather': 'feather'}.get(path, 'csv')
+
+    # 先載入模組，峰值記憶體中的基線部分另外記錄
+    if PATHS[path][0] == 'app':
+        import app
+    else:
+        import download_all_tables
+        from wrds_export import get_column_types, get_distinct_ratios
+        from dtype_mapper import DtypeMapper
+        db = LocalConnection(case['dsn'])
+    from output_formats import file_extension
+    baseline_rss = peak_rss_bytes()
+
+    watcher = FirstByteWatcher(work_dir, file_extension(output_format))
+    watcher.start()
+    start = time.perf_counter()
+    recorder = StatusRecorder()
+    if path.startswith('app-'):
+        pagination = 'offset' if path == 'app-offset' else 'keyset'
+        export_engine = 'copy' if path == 'app-copy' else 'pandas'
+        output_path, _ = app.fetch_wrds_data(case['table'], pagination=pagination, export_engine=export_engine,
+                                             output_format=output_format, use_cache=False, job=recorder)
+        rows = recorder.status['total_rows']
+    elif path == 'bulk-cursor':
+        columns = get_column_types(db.connection, schema_name, table)
+        dtypes = DtypeMapper(columns, get_distinct_ratios(db.connection, schema_name, table))
+        output_path = os.path.join(work_dir, f'{table}{file_extension(output_format)}')
+        rows = download_all_tables.export_query(db, f"SELECT * FROM {case['table']}", output_path,
+                                                export_engine='stream', output_format=output_format,
+                                                dtypes=dtypes)
+    else:
+        export_engine = {'bulk-raw': 'raw', 'bulk-copy': 'copy'}.get(path, 'stream')
+        ok, output_path, rows, _ = download_all_tables.download_table(
+            db, schema_name, table, work_dir, total_rows=case['rows'], export_engine=export_engine,
+            output_format=output_format)
+        if not ok:
+            raise Exception(f"{path} 下載失敗")
+    seconds = time.perf_counter() - start
+    watcher.stop()
+    peak_rss = peak_rss_bytes()
+
+    output_bytes = os.path.getsize(output_path)
+    return {
+        'rows': rows,
+        'output_bytes': output_bytes,
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(rows / seconds, 1),
+        # MB 以 1024 * 1024 位元組計
+        'mb_per_second': round(output_bytes / 1024 ** 2 / seconds, 2),
+        'first_byte_seconds': round(watcher.seconds, 3) if watcher.seconds is not None else None,
+        'peak_rss_bytes': peak_rss,
+        'baseline_rss_bytes': baseline_rss,
+        # app.py 分批下載時抓取、轉換、寫入各階段的耗時
+        'stages': recorder.status.get('timings'),
+    }
+
+def run_case_subprocess(case, timeout=None, keep_files=False):
+    """每次測量使用新的子進程，峰值記憶體互不影響；失敗時返回包含錯誤信息的結果"""
+    case = dict(case, work_dir=tempfile.mkdtemp(prefix=f"wrds_bench_{case['path']}_"))
+    log_path = os.path.join(case['work_dir'], 'benchmark.log')
+    result_path = os.path.join(case['work_dir'], 'result.json')
+    try:
+        with open(log_path, 'w', encoding='utf-8') as log:
+            process = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), 'case', json.dumps(case), '--result-file', result_path],
+                stdout=log, stderr=subprocess.STDOUT, timeout=timeout,
+                env=dict(os.environ, PYTHONIOENCODING='utf-8'))
+        if process.returncode == 0 and os.path.exists(result_path):
+            with open(result_path, encoding='utf-8') as f:
+                return dict(json.load(f), status='ok')
+        with open(log_path, encoding='utf-8', errors='replace') as f:
+            tail = f.read()[-2000:]
+        return {'status': 'error', 'returncode': process.returncode, 'log_tail': tail}
+    except subprocess.TimeoutExpired:
+        return {'status': 'timeout', 'timeout': timeout}
+    finally:
+        if keep_files:
+            print(f"    工作目錄: {case['work_dir']}")
+        else:
+            shutil.rmtree(case['work_dir'], ignore_errors=True)
+
+def summarize_runs(runs):
+    """多次測量取中位數；有任何一次失敗時返回該次的狀態"""
+    failed = [run for run in runs if run['status'] != 'ok']
+    if failed:
+        return dict(failed[0], runs=runs)
+    summary = {'status': 'ok', 'rows': runs[0]['rows'], 'output_bytes': runs[0]['output_bytes']}
+    for field in ('seconds', 'rows_per_second', 'mb_per_second', 'first_byte_seconds', 'peak_rss_bytes'):
+        values = [run[field] for run in runs if run.get(field) is not None]
+        summary[field] = round(statistics.median(values), 3) if values else None
+    if summary['peak_rss_bytes'] is not None:
+        summary['peak_rss_bytes'] = int(summary['peak_rss_bytes'])
+    summary['runs'] = runs
+    return summary
+
+def git_info():
+    def git(*args):
+        try:
+            return subprocess.run(['git', *args], cwd=REPO_DIR, capture_output=True, text=True,
+                                  check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+    return {
+        'commit': git('rev-parse', 'HEAD'),
+        'branch': git('rev-parse', '--abbrev-ref', 'HEAD'),
+        'subject': git('log', '-1', '--format=%s'),
+        # 有未提交的修改時結果不完全對應該 commit
+        'dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+    }
+
+def environment_info(engine):
+    import sqlalchemy
+    import pyarrow
+    import psycopg2
+    with engine.connect() as conn:
+        server_version = conn.execute(text("SHOW server_version")).scalar()
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'pandas': pd.__version__,
+        'pyarrow': pyarrow.__version__,
+        'sqlalchemy': sqlalchemy.__version__,
+        'psycopg2': psycopg2.__version__,
+        'postgresql': server_version,
+    }
+
+def parse_list(value, choices, name):
+    items = [item.strip() for item in value.split(',') if item.strip()]
+    if items == ['all']:
+        return list(choices)
+    unknown = [item for item in items if item not in choices]
+    if unknown:
+        raise SystemExit(f"未知的{name}: {', '.join(unknown)}（可選: {', '.join(choices)}）")
+    return items
+
+def run_benchmarks(args):
+    datasets = parse_list(args.datasets, DATASETS, '數據集')
+    paths = parse_list(args.paths, PATHS, '匯出路徑')
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    engine = create_engine(args.dsn)
+
+    report = {
+        'version': RESULT_VERSION,
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'git': git_info(),
+        'environment': environment_info(engine),
+        'settings': {'datasets': datasets, 'paths': paths, 'sizes': [label for label, _ in sizes],
+                     'repeat': args.repeat, 'first_byte_min_bytes': FIRST_BYTE_MIN_BYTES},
+        'datasets': [],
+        'results': [],
+    }
+    for size_label, rows in sizes:
+        for dataset in datasets:
+            full_name = build_dataset(engine, dataset, size_label, rows, rebuild=args.rebuild)
+            with engine.connect() as conn:
+                report['datasets'].append(dict(dataset_info(conn, full_name), dataset=dataset, size=size_label))
+            for path in paths:
+                result = {'dataset': dataset, 'size': size_label, 'path': path, 'table': full_name}
+                if path == 'bulk-raw' and rows > RAW_MAX_ROWS and 'bulk-raw' not in args.paths.split(','):
+                    print(f"  跳過 {path}: {rows:,} 行超過 {RAW_MAX_ROWS:,} 行")
+                    report['results'].append(dict(result, status='skipped'))
+                    continue
+                print(f"  {full_name} {path}（{PATHS[path][1]}）")
+                case = {'dsn': args.dsn, 'table': full_name, 'rows': rows, 'path': path}
+                runs = []
+                for _ in range(args.repeat):
+                    run = run_case_subprocess(case, timeout=args.timeout, keep_files=args.keep_files)
+                    runs.append(run)
+                    if run['status'] != 'ok':
+                        print(f"    失敗: {run['status']} {run.get('log_tail', '')[-500:]}")
+                        break
+                    print(f"    {run['seconds']:.2f} 秒，{run['rows_per_second']:,.0f} 行/秒，"
+                          f"{run['mb_per_second']:.1f} MB/秒，首批數據 {run['first_byte_seconds']} 秒，"
+                          f"峰值記憶體 {(run['peak_rss_bytes'] or 0) / 1024 ** 2:.0f} MB")
+                report['results'].append(dict(result, **summarize_runs(runs)))
+    engine.dispose()
+
+    output = args.output
+    if output is None:
+        commit = (report['git']['commit'] or 'nogit')[:8]
+        output = os.path.join(DEFAULT_RESULTS_DIR, f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n結果已保存到: {output}")
+    return report
+
+def compare_results(baseline_path, current_path, threshold):
+    """按 (數據集, 規模, 匯出路徑) 比較兩次結果的耗時，返回變慢超過 threshold 的項目數"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(current_path, encoding='utf-8') as f:
+        current = json.load(f)
+    baseline_results = {(r['dataset'], r['size'], r['path']): r for r in baseline['results']}
+
+    def commit(report):
+        git = report.get('git') or {}
+        return f"{(git.get('commit') or '?')[:8]}{' (dirty)' if git.get('dirty') else ''}"
+
+    print(f"基準: {commit(baseline)}  {baseline['created_at']}")
+    print(f"對比: {commit(current)}  {current['created_at']}\n")
+    print(f"{'數據集':<12}{'規模':<6}{'匯出路徑':<14}{'基準秒數':>10}{'對比秒數':>10}{'變化':>9}"
+          f"{'首批數據':>10}{'峰值記憶體(MB)':>18}")
+    regressions = 0
+    for result in current['results']:
+        key = (result['dataset'], result['size'], result['path'])
+        old = baseline_results.get(key)
+        if old is None or old['status'] != 'ok' or result['status'] != 'ok':
+            status = result['status'] if old is not None else '無基準'
+            print(f"{key[0]:<12}{key[1]:<6}{key[2]:<14}{status:>10}")
+            continue
+        change = result['seconds'] / old['seconds'] - 1
+        flag = ''
+        if change > threshold:
+            regressions += 1
+            flag = ' 變慢'
+        first_byte = f"{old['first_byte_seconds'] or 0:.2f}->{result['first_byte_seconds'] or 0:.2f}"
+        rss = f"{(old['peak_rss_bytes'] or 0) / 1024 ** 2:.0f}->{(result['peak_rss_bytes'] or 0) / 1024 ** 2:.0f}"
+        print(f"{key[0]:<12}{key[1]:<6}{key[2]:<14}{old['seconds']:>10.2f}{result['seconds']:>10.2f}"
+              f"{change:>+9.1%}{first_byte:>14}{rss:>16}{flag}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="匯出路徑效能測試（本機 PostgreSQL 模擬 WRDS 表格）")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="生成測試表格並執行匯出路徑")
+    run_parser.add_argument("--dsn", default=DEFAULT_DSN,
+                            help="本機 PostgreSQL 的 SQLAlchemy 連接字串（預設: 環境變量 BENCHMARK_DSN 或 "
+                                 "postgresql://postgres@localhost:5432/postgres）")
+    run_parser.add_argument("--sizes", default='1M',
+                            help=f"數據規模，逗號分隔，例如 {','.join(SIZES)} 或行數 (預設: 1M)")
+    run_parser.add_argument("--datasets", default='all',
+                            help=f"數據集，逗號分隔: {', '.join(DATASETS)} (預設: all)")
+    run_parser.add_argument("--paths", default='all',
+                            help=f"匯出路徑，逗號分隔: {', '.join(PATHS)} (預設: all；超過 {RAW_MAX_ROWS:,} 行的表格"
+                                 f"只在明確指定時執行 bulk-raw)")
+    run_parser.add_argument("--repeat", type=int, default=3, help="每個路徑測量的次數，結果取中位數 (預設: 3)")
+    run_parser.add_argument("--timeout", type=int, default=None, help="每次測量的秒數上限 (預設: 不限制)")
+    run_parser.add_argument("--rebuild", action="store_true", help="重新生成測試表格")
+    run_parser.add_argument("--keep-files", action="store_true", help="保留每次測量的工作目錄和日誌")
+    run_parser.add_argument("--output", default=None,
+                            help="結果 JSON 的路徑 (預設: benchmarks/results/<時間>_<commit>.json)")
+
+    compare_parser = subparsers.add_parser('compare', help="比較兩次測試結果")
+    compare_parser.add_argument("baseline", help="基準結果 JSON")
+    compare_parser.add_argument("current", help="對比結果 JSON")
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="耗時增加超過此比例時標記為變慢，並以非零狀態碼結束 (預設: 0.1)")
+
+    # 子進程內部使用：執行單次測量
+    case_parser = subparsers.add_parser('case')
+    case_parser.add_argument("spec")
+    case_parser.add_argument("--result-file", required=True)
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run_benchmarks(args)
+    elif args.command == 'compare':
+        sys.exit(1 if compare_results(args.baseline, args.current, args.threshold) else 0)
+    else:
+        result = run_case(json.loads(args.spec))
+        with open(args.result_file, 'w', encoding='utf-8') as f:
+            json.dump(result, f)
@@ -0,0 +1,182 @@
+import json
+import time
+from sqlalchemy import text
+
+# 數據生成方式改變時遞增，舊版本生成的表格會被重建，確保不同 commit 的測試使用相同的數據
+SCHEMA_VERSION = 1
+
+# 每次 INSERT 生成的行數
+BUILD_CHUNK_ROWS = 5000000
+
+# 預設的數據規模
+SIZES = {'1M': 1000000, '10M': 10000000, '50M': 50000000}
+
+def _hash(salt):
+    """由行號 i 決定的偽隨機數（0 ~ 1000002），同一規模每次生成的數據完全相同"""
+    return f"(i * 2654435761 % 1000003 * {salt * 7919 + 1} % 1000003)"
+
+def _nullable(expression, salt, every):
+    """大約每 every 行有一行為 NULL"""
+    return f"CASE WHEN {_hash(salt)} % {every} = 0 THEN NULL ELSE {expression} END"
+
+# CRSP 日度面板：每個 permno 連續 2520 個交易日，主鍵 (permno, date)
+_DAYS = 2520
+_PERMNO = f"(10000 + i / {_DAYS})::integer"
+_PRICE = f"(5 + {_hash(1)} / 5000.0)"
+
+CRSP_DSF_COLUMNS = [
+    ('cusip', 'varchar(8)', f"lpad(((i / {_DAYS}) * 7919 % 100000000)::text, 8, '0')"),
+    ('permno', 'integer', _PERMNO),
+    ('permco', 'integer', f"(20000 + i / {_DAYS} / 2)::integer"),
+    ('issuno', 'integer', f"(i / {_DAYS} % 90000)::integer"),
+    ('hexcd', 'smallint', f"(1 + i / {_DAYS} % 3)::smallint"),
+    ('hsiccd', 'integer', f"(1000 + i / {_DAYS} * 37 % 8000)::integer"),
+    ('date', 'date', f"DATE '2000-01-03' + (i % {_DAYS})::integer"),
+    ('bidlo', 'double precision', _nullable(f"{_PRICE} * 0.98", 2, 50)),
+    ('askhi', 'double precision', _nullable(f"{_PRICE} * 1.02", 2, 50)),
+    ('prc', 'double precision', _nullable(_PRICE, 2, 50)),
+    ('vol', 'double precision', f"({_hash(3)} % 100000) * 100"),
+    ('ret', 'double precision', _nullable(f"({_hash(4)} - 500001) / 10000000.0", 5, 97)),
+    ('bid', 'double precision', f"{_PRICE} - 0.01"),
+    ('ask', 'double precision', f"{_PRICE} + 0.01"),
+    ('shrout', 'double precision', f"1000 + i / {_DAYS} % 500 * 100"),
+    ('cfacpr', 'double precision', "1.0"),
+    ('cfacshr', 'double precision', "1.0"),
+    ('openprc', 'double precision', _nullable(f"{_PRICE} * 0.995", 6, 20)),
+    ('numtrd', 'integer', _nullable(f"({_hash(7)} % 5000)::integer", 8, 20)),
+    ('retx', 'double precision', _nullable(f"({_hash(4)} - 500001) / 10000000.0 - 0.0001", 5, 97)),
+]
+
+# Compustat 年度基本面：每個 gvkey 40 個財政年度，公司層級的長文字欄位在各年度重複
+_YEARS = 40
+_FIRM = f"(1000 + i / {_YEARS})"
+_WORDS = ("ARRAY['manufactures', 'develops', 'distributes', 'provides', 'operates', 'designs', "
+          "'markets', 'invests in']")
+_PRODUCTS = ("ARRAY['semiconductor equipment', 'regional banking services', 'specialty chemicals', "
+             "'commercial real estate', 'medical devices', 'enterprise software', 'industrial machinery', "
+             "'consumer packaged goods', 'oil and gas exploration', 'wireless communications']")
+_CITIES = ("ARRAY['NEW YORK', 'CHICAGO', 'HOUSTON', 'SAN FRANCISCO', 'BOSTON', 'ATLANTA', 'SEATTLE', "
+           "'TORONTO']")
+
+COMP_FUNDA_COLUMNS = [
+    ('gvkey', 'varchar(6)', f"lpad({_FIRM}::text, 6, '0')"),
+    ('datadate', 'date', f"make_date((1980 + i % {_YEARS})::integer, 12, 31)"),
+    ('fyear', 'smallint', f"(1980 + i % {_YEARS})::smallint"),
+    ('indfmt', 'varchar(12)', "'INDL'"),
+    ('consol', 'varchar(2)', "'C'"),
+    ('popsrc', 'varchar(1)', "'D'"),
+    ('datafmt', 'varchar(12)', "'STD'"),
+    ('tic', 'varchar(8)', f"'T' || {_FIRM}::text"),
+    ('cusip', 'varchar(9)', f"lpad(({_FIRM} * 104729 % 1000000000)::text, 9, '0')"),
+    ('cik', 'varchar(10)', f"lpad(({_FIRM} * 7907 % 10000000000)::text, 10, '0')"),
+    ('conm', 'varchar(100)', f"'COMPANY ' || {_FIRM}::text || ' HOLDINGS INC'"),
+    ('curcd', 'varchar(3)', f"CASE WHEN {_FIRM} % 10 = 0 THEN 'CAD' ELSE 'USD' END"),
+    ('fyr', 'smallint', f"(1 + {_FIRM} % 12)::smallint"),
+    ('sic', 'varchar(4)', f"(1000 + {_FIRM} * 37 % 8000)::text"),
+    ('add1', 'varchar(100)', f"({_FIRM} % 9000 + 1)::text || ' MARKET STREET, SUITE ' || ({_FIRM} % 400)::text"),
+    ('city', 'varchar(100)', f"({_CITIES})[({_FIRM} % 8 + 1)::integer]"),
+    ('weburl', 'varchar(100)', f"'www.company' || {_FIRM}::text || '.com'"),
+    ('busdesc', 'text',
+     f"'Company ' || {_FIRM}::text || ' ' || ({_WORDS})[({_FIRM} % 8 + 1)::integer] || ' ' || "
+     f"({_PRODUCTS})[({_FIRM} % 10 + 1)::integer] || ' and ' || ({_PRODUCTS})[({_FIRM} % 7 + 1)::integer] || "
+     f"'. The company was founded in ' || (1900 + {_FIRM} % 100)::text || ' and is headquartered in ' || "
+     f"initcap(({_CITIES})[({_FIRM} % 8 + 1)::integer]) || '. It serves customers in North America, Europe and "
+     f"Asia through direct sales and a network of distributors.'"),
+]
+# 財務項目：double precision，部分為 NULL
+for salt, name in enumerate(['act', 'at', 'capx', 'ceq', 'che', 'cogs', 'csho', 'dlc', 'dltt', 'dp', 'dv',
+                             'ebit', 'ebitda', 'emp', 'ib', 'invt', 'lct', 'lt', 'ni', 'oiadp', 'ppent', 're',
+                             'rect', 'revt', 'sale', 'seq', 'txt', 'xint', 'xrd', 'xsga'], start=10):
+    COMP_FUNDA_COLUMNS.append((name, 'double precision',
+                               _nullable(f"({_hash(salt)} - 200000) / 100.0", salt + 100, 9)))
+
+DATASETS = {
+    'crsp_dsf': {
+        'schema': 'bench_crsp',
+        'table': 'dsf',
+        'columns': CRSP_DSF_COLUMNS,
+        'primary_key': ['permno', 'date'],
+    },
+    'comp_funda': {
+        'schema': 'bench_comp',
+        'table': 'funda',
+        'columns': COMP_FUNDA_COLUMNS,
+        'primary_key': ['gvkey', 'datadate', 'indfmt', 'consol', 'popsrc', 'datafmt'],
+    },
+}
+
+def parse_size(label):
+    """'1M' / '10M' / '50M' 或行數，返回 (標籤, 行數)"""
+    label = label.strip().upper()
+    if label in SIZES:
+        return label, SIZES[label]
+    if label.endswith('K'):
+        return label, int(float(label[:-1]) * 1000)
+    if label.endswith('M'):
+        return label, int(float(label[:-1]) * 1000000)
+    return label, int(label)
+
+def table_name(dataset, size_label):
+    return f"{DATASETS[dataset]['table']}_{size_label.lower()}"
+
+def _table_comment(dataset, rows):
+    return json.dumps({'benchmark_schema': SCHEMA_VERSION, 'dataset': dataset, 'rows': rows}, sort_keys=True)
+
+def dataset_ready(conn, dataset, size_label, rows):
+    """表格已存在、且是用目前的生成方式生成的相同行數"""
+    spec = DATASETS[dataset]
+    comment = conn.execute(text("""
+        SELECT obj_description(c.oid, 'pg_class')
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = :schema AND c.relname = :table
+    """), {'schema': spec['schema'], 'table': table_name(dataset, size_label)}).scalar()
+    return comment == _table_comment(dataset, rows)
+
+def build_dataset(engine, dataset, size_label, rows, rebuild=False):
+    """在本機 PostgreSQL 中生成模擬 WRDS 結構的表格（已是最新時跳過），返回 schema.table"""
+    spec = DATASETS[dataset]
+    schema, table = spec['schema'], table_name(dataset, size_label)
+    full_name = f"{schema}.{table}"
+    with engine.connect() as conn:
+        if not rebuild and dataset_ready(conn, dataset, size_label, rows):
+            print(f"已有測試表格 {full_name}（{rows:,} 行）")
+            return full_name
+
+    print(f"正在生成測試表格 {full_name}（{rows:,} 行）...")
+    start = time.time()
+    column_defs = ", ".join(f"{name} {pg_type}" for name, pg_type, _ in spec['columns'])
+    select_list = ", ".join(f"{expression} AS {name}" for name, _, expression in spec['columns'])
+    with engine.begin() as conn:
+        conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {schema}"))
+        conn.execute(text(f"DROP TABLE IF EXISTS {full_name}"))
+        conn.execute(text(f"CREATE TABLE {full_name} ({column_defs})"))
+    for chunk_start in range(0, rows, BUILD_CHUNK_ROWS):
+        chunk_end = min(rows, chunk_start + BUILD_CHUNK_ROWS) - 1
+        with engine.begin() as conn:
+            conn.execute(text(f"""
+                INSERT INTO {full_name}
+                SELECT {select_list}
+                FROM generate_series(CAST(:start AS bigint), CAST(:end AS bigint)) AS g(i)
+            """), {'start': chunk_start, 'end': chunk_end})
+        print(f"  - 已生成 {chunk_end + 1:,}/{rows:,} 行")
+
+    # 主鍵在載入數據後才建立，速度較快
+    with engine.begin() as conn:
+        conn.execute(text(f"ALTER TABLE {full_name} ADD PRIMARY KEY ({', '.join(spec['primary_key'])})"))
+        conn.execute(text(f"COMMENT ON TABLE {full_name} IS :comment"),
+                     {'comment': _table_comment(dataset, rows)})
+    # 更新統計信息和可見性映射，與 WRDS 上已 VACUUM 的表格一致
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.execute(text(f"VACUUM ANALYZE {full_name}"))
+    print(f"✓ 生成完成，耗時 {time.time() - start:.1f} 秒")
+    return full_name
+
+def dataset_info(conn, full_name):
+    """表格的行數估算值和磁碟大小（包含索引）"""
+    row = conn.execute(text("""
+        SELECT c.reltuples::bigint AS rows, pg_total_relation_size(c.oid) AS bytes
+        FROM pg_class c
+        WHERE c.oid = CAST(:name AS regclass)
+    """), {'name': full_name}).mappings().one()
+    return {'table': full_name, 'rows': int(row['rows']), 'bytes': int(row['bytes'])}
@@ -0,0 +1,116 @@
+import json
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+
+PARTIAL_SUFFIX = '.part'
+CHECKPOINT_SUFFIX = '.checkpoint.json'
+
+def timestamped_name_pattern(prefix, extension):
+    """匹配「前綴 + 日期/時間戳 + 副檔名」的下載文件名"""
+    return re.compile(re.escape(prefix) + r'\d{8}(_\d{6})?' + re.escape(extension) + '$')
+
+def find_partial_download(directory, prefix, extension, exclude=()):
+    """尋找上次中斷、留有檢查點的下載，返回其最終文件路徑（不包括 exclude 中的路徑）；沒有時返回 None"""
+    if not os.path.isdir(directory):
+        return None
+    pattern = timestamped_name_pattern(prefix, extension)
+    candidates = []
+    for name in os.listdir(directory):
+        if not name.endswith(CHECKPOINT_SUFFIX):
+            continue
+        final_name = name[:-len(CHECKPOINT_SUFFIX)]
+        path = os.path.join(directory, final_name)
+        if pattern.match(final_name) and path not in exclude and os.path.exists(path + PARTIAL_SUFFIX):
+            candidates.append(path)
+    return max(candidates, key=lambda path: os.path.getmtime(path + CHECKPOINT_SUFFIX), default=None)
+
+# 本進程中正在寫入的下載（最終文件路徑），其他任務不能續傳、清除或改名這些文件
+_claimed_paths = set()
+_claimed_lock = threading.Lock()
+
+def claim_download(directory, prefix, extension):
+    """為一個下載任務選定並佔用最終文件路徑：優先沿用上次中斷、且沒有其他任務在寫入的下載，
+    否則使用當天日期的文件名，該文件名正被其他任務佔用時加上時間；完成或失敗後調用 release_download"""
+    with _claimed_lock:
+        path = find_partial_download(directory, prefix, extension, exclude=_claimed_paths)
+        if path is None:
+            now = datetime.now()
+            path = os.path.join(directory, f"{prefix}{now:%Y%m%d}{extension}")
+            offset = 0
+            while path in _claimed_paths:
+                path = os.path.join(directory, f"{prefix}{now + timedelta(seconds=offset):%Y%m%d_%H%M%S}{extension}")
+                offset += 1
+        _claimed_paths.add(path)
+        return path
+
+def release_download(path):
+    """解除 claim_download 對文件路徑的佔用"""
+    with _claimed_lock:
+        _claimed_paths.discard(path)
+
+class DownloadCheckpoint:
+    """可續傳的下載：數據先寫入 <文件>.part，每批寫完後把進度保存到 <文件>.checkpoint.json，
+    完成時原子地改名為最終文件，因此只有完整的文件才會以最終文件名出現"""
+
+    def __init__(self, path, signature):
+        self.path = path
+        self.part_path = path + PARTIAL_SUFFIX
+        self.checkpoint_path = path + CHECKPOINT_SUFFIX
+        # 決定能否續傳的下載設定（表格、格式、排序鍵、批次大小等），與上次不同時重新下載
+        self.signature = signature
+        self.state = {}
+
+    def load(self):
+        """讀取上次的進度；沒有檢查點、設定不同或臨時文件比記錄的短時返回 None"""
+        try:
+            with open(self.checkpoint_path, encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state.get('signature') != self.signature:
+            return None
+        if not os.path.exists(self.part_path) or os.path.getsize(self.part_path) < state.get('bytes', 0):
+            return None
+        return state
+
+    def resume(self):
+        """返回可續傳的進度，並把臨時文件截斷到最後一次提交的位置；不能續傳時清除舊文件並返回 None"""
+        state = self.load()
+        if state is None:
+            self.discard()
+            return None
+        # 檢查點之後寫入的半個批次丟棄，從記錄的位置繼續寫
+        with open(self.part_path, 'r+b') as f:
+            f.truncate(state['bytes'])
+        self.state = state
+        return state
+
+    def save(self, **state):
+        """更新進度並原子地寫入檢查點（先寫臨時文件再改名）；未傳入的字段保留上次的值"""
+        self.state.update(state, signature=self.signature)
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, ensure_ascii=False, default=str)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def finish(self):
+        """下載完成：把臨時文件改名為最終文件並刪除檢查點"""
+        os.replace(self.part_path, self.path)
+        self._remove(self.checkpoint_path)
+
+    def discard(self):
+        """刪除臨時文件和檢查點"""
+        self.state = {}
+        self._remove(self.part_path)
+        self._remove(self.checkpoint_path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,111 @@
+import os
+import threading
+import time
+from sqlalchemy import create_engine, exc
+from sqlalchemy.engine import URL
+from sqlalchemy.pool import QueuePool
+from query_cassette import get_cassette
+
+def get_pool_settings():
+    """讀取連接池設定（環境變量 WRDS_POOL_*，在 load_dotenv 之後讀取）"""
+    return {
+        'pool_size': int(os.getenv('WRDS_POOL_SIZE', '5')),
+        'max_overflow': int(os.getenv('WRDS_POOL_MAX_OVERFLOW', '5')),
+        'pool_timeout': int(os.getenv('WRDS_POOL_TIMEOUT', '30')),     # 等待可用連接的秒數
+        'pool_recycle': int(os.getenv('WRDS_POOL_RECYCLE', '1800')),   # 連接最長使用秒數，避免被伺服器斷開
+    }
+
+class PoolStats:
+    """統計從連接池取得連接的次數和等待時間"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def snapshot(self):
+        with self._lock:
+            attempts = self.checkouts + self.timeouts
+            return {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'avg_wait_ms': round(self.total_wait / attempts * 1000, 2) if attempts else 0.0,
+                'max_wait_ms': round(self.max_wait * 1000, 2),
+            }
+
+pool_stats = PoolStats()
+
+class TimedQueuePool(QueuePool):
+    """記錄每次取得連接等待時間的 QueuePool"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            pool_stats.record(time.perf_counter() - start, timed_out=True)
+            raise
+        pool_stats.record(time.perf_counter() - start)
+        return conn
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """返回整個進程共用的 WRDS 連接池引擎（第一次使用時建立）"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                username = os.getenv('WRDS_USERNAME')
+                password = os.getenv('WRDS_PASSWORD')
+                # 設置了 WRDS_CASSETTE 時錄製查詢，或在不連接 WRDS 的情況下重播錄製的結果
+                cassette = get_cassette()
+                if (not username or not password) and not (cassette and cassette.replaying):
+                    raise ValueError("未設置 WRDS 帳號或密碼")
+                url = URL.create(
+                    'postgresql',
+                    username=username,
+                    password=password,
+                    host=os.getenv('WRDS_HOST', 'wrds-pgdata.wharton.upenn.edu'),
+                    port=int(os.getenv('WRDS_PORT', '9737')),
+                    database=os.getenv('WRDS_DB', 'wrds')
+                )
+                _engine = (cassette.create_engine if cassette else create_engine)(
+                    url,
+                    poolclass=TimedQueuePool,
+                    pool_pre_ping=True,
+                    # 本機的 PostgreSQL（例如效能測試）可以用 WRDS_SSLMODE=disable 連接
+                    connect_args={'sslmode': os.getenv('WRDS_SSLMODE', 'require')},
+                    **get_pool_settings()
+                )
+    return _engine
+
+def get_pool_status():
+    """返回連接池佔用情況和等待時間統計"""
+    status = get_pool_settings()
+    status.update({
+        'checked_out': 0,
+        'checked_in': 0,
+        'overflow': 0,
+    })
+    if _engine is not None:
+        pool = _engine.pool
+        status.update({
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0),
+        })
+    status.update(pool_stats.snapshot())
+    return status
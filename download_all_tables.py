@@ -1,13 +1,49 @@
-import wrds
 import configparser
 import sys
 import traceback
 import os
-from datetime import datetime, timedelta
+from datetime import datetime
 import pandas as pd
-from tqdm import tqdm
-import time
-import random
+import argparse
+from sqlalchemy import text
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from wrds_export import (stream_query, copy_export, get_column_types, scan_catalog, SchemaAccess,
+                         find_pagination_key, build_keyset_query, pop_last_key, find_batch_upper_key,
+                         build_key_range_sql, find_watermark_column, get_column_max, quote_ident,
+                         plan_partitions, build_partition_query, get_distinct_ratios, get_schema_column_types,
+                         CTID_KEY)
+from watermarks import WatermarkStore
+from checkpoint import DownloadCheckpoint, find_partial_download, PARTIAL_SUFFIX
+from manifest import get_manifest, file_checksum, schema_hash
+from rate_limiter import RateLimiter
+from dtype_mapper import DtypeMapper
+from pipeline import run_pipeline
+from query_cassette import connect_wrds, get_cassette, replaying
+from output_formats import (OUTPUT_FORMATS, open_writer, file_extension, count_rows, arrow_schema_from_columns,
+                            supports_resume, merge_files, column_max)
+
+# 串流模式下每次從伺服器端游標取回的行數
+DEFAULT_FETCH_SIZE = 100000
+
+# 目錄文件的欄位（舊版目錄只有前五欄）
+CATALOG_COLUMNS = ["資料庫", "表格名稱", "大小", "行數", "上次掃描時間", "大小(位元組)", "描述"]
+
+# 匯出引擎: copy（COPY TO STDOUT）、stream（伺服器端游標 + pandas）、raw（一次讀取整個表格）
+EXPORT_ENGINES = ('copy', 'stream', 'raw')
+
+# 並行下載的線程數：默認值和全局上限（每個線程的所有查詢，包括 COPY 和串流，都在自己的一個 WRDS 連接上執行，
+# 分區下載的額外連接也計入上限；主線程讀取目錄的連接另計）
+DEFAULT_WORKERS = 4
+MAX_WORKERS = 8
+
+# 單個表格按範圍並行下載：分區數上限、啟用分區下載的最小行數，以及估算行數的容許誤差
+MAX_PARTITIONS = 8
+DEFAULT_PARTITION_MIN_ROWS = 10000000
+ROW_COUNT_TOLERANCE = 0.1
+
+# 所有線程合計每分鐘的查詢上限
+DEFAULT_QUERIES_PER_MINUTE = 60
 
 def print_progress_header():
     """打印進度標題"""
@@ -40,165 +76,146 @@ def print_error(error_msg, error_obj=None):
         print(traceback.format_exc())
     print("="*50 + "\n")
 
+def open_wrds_connection():
+    """使用 config.ini 中的帳號建立一個新的 WRDS 連接（設置了 WRDS_CASSETTE 時錄製或重播查詢）"""
+    if replaying():
+        print(f"正在重播錄製的查詢: {get_cassette().path}")
+        return connect_wrds()
+    
+    # 讀取配置文件
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+    
+    # 從配置文件獲取認證信息
+    username = config['WRDS']['username']
+    password = config['WRDS']['password']
+    
+    print(f"正在使用帳號 {username} 連接到 WRDS...")
+    return connect_wrds(wrds_username=username, 
+                        wrds_password=password, 
+                        autoconnect=True)
+
 def get_wrds_connection():
     try:
         print_step(1, 5, "連接到 WRDS 數據庫")
-        # 讀取配置文件
-        config = configparser.ConfigParser()
-        config.read('config.ini')
-        
-        # 從配置文件獲取認證信息
-        username = config['WRDS']['username']
-        password = config['WRDS']['password']
-        
-        print(f"正在使用帳號 {username} 連接到 WRDS...")
-        db = wrds.Connection(wrds_username=username, 
-                           wrds_password=password, 
-                           autoconnect=True)
+        db = open_wrds_connection()
         print("✓ 成功連接到 WRDS 數據庫")
         return db
     except Exception as e:
         print_error(f"錯誤: 連接 WRDS 失敗", e)
         sys.exit(1)
 
-def check_access(db, library):
-    """檢查是否有訪問權限"""
-    try:
-        sql = f"""
-        SELECT 1
-        FROM information_schema.schemata
-        WHERE schema_name = '{library}'
-        AND has_schema_privilege(current_user, schema_name, 'USAGE')
-        """
-        result = db.raw_sql(sql)
-        return len(result) > 0
-    except:
-        return False
-
-def get_table_list(db, library):
-    """獲取資料庫中的表格列表"""
+def get_table_list(db, library, exact_counts=False):
+    """獲取資料庫中的表格列表（行數默認為統計信息估算值）"""
     try:
-        # 首先獲取表格列表
-        sql = f"""
-        SELECT table_name
-        FROM information_schema.tables 
-        WHERE table_schema = '{library}'
-        AND table_type = 'BASE TABLE'
-        ORDER BY table_name
-        """
-        tables = db.raw_sql(sql)
-        
-        result = []
-        # 對每個表格分別獲取大小和行數
-        for table in tables.values:
-            table_name = table[0]
-            try:
-                # 獲取表格大小
-                size_sql = f"""
-                SELECT pg_size_pretty(pg_total_relation_size('{library}.{table_name}')) as size,
-                       pg_total_relation_size('{library}.{table_name}') as size_bytes
-                """
-                size_result = db.raw_sql(size_sql)
-                
-                # 獲取行數
-                count_sql = f"""
-                SELECT COUNT(*) as row_count 
-                FROM {library}.{table_name}
-                """
-                count_result = db.raw_sql(count_sql)
-                
-                if not size_result.empty and not count_result.empty:
-                    size_pretty = size_result.iloc[0]['size']
-                    size_bytes = size_result.iloc[0]['size_bytes']
-                    row_count = count_result.iloc[0]['row_count']
-                    result.append((table_name, size_pretty, size_bytes, row_count))
-                    
-            except Exception as table_error:
-                print(f"  - 警告: 獲取表格 {library}.{table_name} 的詳細信息時出錯: {str(table_error)}")
-                continue
-                
-        return result
+        tables = scan_catalog(db.connection, [library], exact_counts=exact_counts)
+        return [(table_name, size, size_bytes, row_count)
+                for _, table_name, size, size_bytes, row_count, _ in tables]
     except Exception as e:
         print(f"獲取 {library} 的表格列表時出錯: {str(e)}")
         return []
 
-def check_existing_download(output_dir, library, table):
-    """檢查表格是否已經下載過"""
+def check_existing_download(output_dir, library, table, output_format='csv', columns=None):
+    """檢查表格是否已經下載過（查詢下載索引，不掃描目錄也不讀取文件內容）；
+    傳入表格目前的欄位 columns 時，結構與下載時不同的表格視為未下載"""
     try:
-        db_dir = os.path.join(output_dir, library)
-        if not os.path.exists(db_dir):
+        manifest = get_manifest(output_dir)
+        entry = manifest.latest(library, table, output_format)
+        if entry is None:
             return False, None
-            
-        # 檢查是否有該表格的任何下載文件
-        files = [f for f in os.listdir(db_dir) if f.startswith(f"{table}_") and f.endswith(".csv")]
-        if not files:
+        
+        if columns and entry['schema_hash'] and entry['schema_hash'] != schema_hash(columns):
+            print(f"  - {library}.{table} 的欄位結構已改變，將重新下載")
             return False, None
-            
-        # 獲取最新的下載文件
-        latest_file = max(files, key=lambda x: os.path.getctime(os.path.join(db_dir, x)))
-        file_path = os.path.join(db_dir, latest_file)
         
-        # 檢查文件是否有效
+        # 文件已被刪除，或大小與完成時登記的不同（被截斷或修改），視為未下載
         try:
-            df = pd.read_csv(file_path, nrows=1)  # 只讀取第一行來驗證文件
-            if df is not None and not df.empty:
-                return True, file_path
-        except:
+            size = os.path.getsize(entry['path'])
+        except OSError:
+            size = None
+        if size != entry['bytes']:
+            print(f"  - 警告: {entry['path']} 已不存在或大小不符，將重新下載")
+            manifest.remove(entry['path'])
             return False, None
             
-        return False, None
+        return True, entry['path']
     except Exception as e:
         print(f"  - 警告: 檢查已存在的下載時出錯: {str(e)}")
         return False, None
 
-def get_random_delay():
-    """獲取隨機延遲時間"""
-    return random.uniform(1.5, 3.5)
-
-def should_take_break(downloads_count):
-    """判斷是否需要休息"""
-    return downloads_count > 0 and downloads_count % 5 == 0
-
-def take_break():
-    """休息一段時間"""
-    delay = random.uniform(30, 60)
-    print(f"\n為避免頻繁訪問，休息 {delay:.1f} 秒...")
-    time.sleep(delay)
-
-def get_next_download_time(last_download_time):
-    """獲取下次允許下載的時間"""
-    min_interval = timedelta(seconds=2)
-    return last_download_time + min_interval
+def verify_existing_download(output_dir, entry, total_rows=None, rows_exact=False):
+    """返回已下載文件的行數；下載索引建立之前登記的文件（未驗證）先讀取一遍確認沒有被截斷，
+    文件不完整或行數與目錄不符時從索引中移除並返回 None"""
+    if entry['verified']:
+        return entry['rows']
+    manifest = get_manifest(output_dir)
+    print(f"  - 正在檢查之前下載的文件: {entry['path']}")
+    try:
+        rows = count_rows(entry['path'])
+    except Exception as e:
+        print(f"  - 警告: 現有文件可能已損壞 ({str(e)})，將重新下載")
+        manifest.remove(entry['path'])
+        return None
+    if not verify_row_count(rows, total_rows, rows_exact):
+        print(f"  - 警告: 現有文件只有 {rows:,} 行，與目錄記錄的 {total_rows:,} 不符，將重新下載")
+        manifest.remove(entry['path'])
+        return None
+    manifest.mark_verified(entry['path'], rows)
+    return rows
 
-def download_table(db, library, table, output_dir, total_rows=None, max_rows=None, last_download_time=None):
-    """下載指定的表格"""
+def download_table(db, library, table, output_dir, total_rows=None, max_rows=None, rate_limiter=None,
+                   export_engine='copy', fetch_size=DEFAULT_FETCH_SIZE, output_format='csv', watermarks=None,
+                   partitions=1, partition_min_rows=DEFAULT_PARTITION_MIN_ROWS, rows_exact=False, compact_dtypes=True,
+                   partition_slots=None):
+    """下載指定的表格；傳入 watermarks 時為增量同步模式，partitions > 1 時大表格按範圍並行下載，
+    partition_slots 為多個線程共用的信號量時，同時執行的分區查詢數受其限制"""
     try:
-        # 檢查是否需要等待
-        if last_download_time:
-            next_download_time = get_next_download_time(last_download_time)
-            wait_time = (next_download_time - datetime.now()).total_seconds()
-            if wait_time > 0:
-                print(f"  - 等待 {wait_time:.1f} 秒...")
-                time.sleep(wait_time)
-
-        # 檢查是否已經下載過
-        already_exists, existing_file = check_existing_download(output_dir, library, table)
+        # 檢查是否已經下載過；欄位結構改變的表格重新下載
+        columns = get_column_types(db.connection, library, table)
+        already_exists, existing_file = check_existing_download(output_dir, library, table, output_format, columns)
+        existing_rows = None
         if already_exists:
+            entry = get_manifest(output_dir).latest(library, table, output_format)
+            existing_rows = verify_existing_download(output_dir, entry, total_rows, rows_exact)
+        if existing_rows is not None and watermarks is not None and watermarks.get(library, table) is None:
+            # 增量同步之前完整下載的表格：由現有文件建立水位線，取不到時重新完整下載
+            if rate_limiter:
+                rate_limiter.acquire_query()
+            watermark_column = find_watermark_column(db.connection, library, table)
+            if watermark_column is None:
+                print("  - 找不到可作為水位線的日期或鍵值欄位，此表格無法增量同步")
+            elif start_watermark(library, table, watermark_column, columns, existing_file, watermarks) is None:
+                print(f"  - 無法從現有文件取得 {watermark_column} 的最大值，重新完整下載以建立水位線")
+                existing_rows = None
+        if existing_rows is not None:
+            # 增量同步：已有水位線的表格只下載新增的行
+            mark = watermarks.get(library, table) if watermarks is not None else None
+            if mark:
+                result = download_delta(
+                    db, library, table, output_dir, mark, watermarks,
+                    export_engine=export_engine,
+                    fetch_size=fetch_size,
+                    output_format=output_format,
+                    rate_limiter=rate_limiter,
+                    compact_dtypes=compact_dtypes
+                )
+                if rate_limiter:
+                    rate_limiter.record_success()
+                return result
             print(f"  - 表格已存在: {existing_file}")
-            try:
-                df = pd.read_csv(existing_file)
-                return True, existing_file, len(df), datetime.now()
-            except:
-                print("  - 警告: 現有文件可能已損壞，將重新下載")
+            return True, existing_file, existing_rows, datetime.now()
         
         # 如果沒有下載過或文件損壞，執行下載
         # 創建資料庫目錄
         db_dir = os.path.join(output_dir, library)
         os.makedirs(db_dir, exist_ok=True)
         
-        # 設定輸出文件名
-        current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_file = os.path.join(db_dir, f"{table}_{current_time}.csv")
+        # 設定輸出文件名；上次中斷的下載沿用原來的文件名
+        extension = file_extension(output_format)
+        output_file = find_partial_download(db_dir, f"{table}_", extension)
+        if output_file is None:
+            current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
+            output_file = os.path.join(db_dir, f"{table}_{current_time}{extension}")
         
         # 構建查詢
         if max_rows:
@@ -213,35 +230,467 @@ def download_table(db, library, table, output_dir, total_rows=None, max_rows=Non
             FROM {library}.{table}
             """
         
+        # 列式格式使用由表格欄位類型固定的 schema；COPY 只能輸出 CSV
+        arrow_schema = None
+        if output_format != 'csv':
+            arrow_schema = arrow_schema_from_columns(columns)
+            if export_engine == 'copy':
+                export_engine = 'stream'
+        
+        # 經過 pandas 的引擎按欄位類型把每批數據轉換成緊湊的 dtype（可空整數、category 等）
+        dtypes = None
+        if compact_dtypes and export_engine != 'copy':
+            dtypes = DtypeMapper(columns, get_distinct_ratios(db.connection, library, table), row_count=total_rows)
+        
+        # 很大的表格按 ctid 數據頁或鍵值範圍切分，用多個連接並行下載
+        partitioned = (partitions > 1 and not max_rows and export_engine != 'raw'
+                       and (total_rows or 0) >= partition_min_rows)
+        
+        # 有主鍵或唯一索引的 CSV 下載按鍵值分批，每批之後保存檢查點，中斷後可以續傳
+        key_columns = None
+        if not partitioned and not max_rows and export_engine != 'raw' and supports_resume(output_format):
+            key_columns = find_pagination_key(db.connection, library, table)
+            if key_columns == [CTID_KEY]:
+                key_columns = None
+        
+        # 數據先寫入 .part 臨時文件，完成後才改名為最終文件
+        checkpoint = DownloadCheckpoint(output_file, {
+            'table': f"{library}.{table}",
+            'format': output_format,
+            'engine': export_engine,
+            'key_columns': key_columns,
+            'batch_size': fetch_size,
+            'partitions': partitions if partitioned else None,
+            'compact_dtypes': dtypes is not None,
+        })
+        state = checkpoint.resume() if key_columns or partitioned else None
+        
+        # 增量同步模式下，在完整下載之前記錄水位線欄位的最大值，下載期間新增的行留到下次同步
+        watermark_column = None
+        if watermarks is not None and not max_rows:
+            watermark_column = find_watermark_column(db.connection, library, table)
+        
+        if state is None:
+            checkpoint.discard()
+            watermark = get_column_max(db.connection, library, table, watermark_column) if watermark_column else None
+            checkpoint.save(last_key=None, rows=0, bytes=0, watermark=watermark)
+            if partitioned:
+                # 分區全部完成後才合併寫入臨時文件，先建立空文件以便續傳時找到檢查點
+                open(checkpoint.part_path, 'wb').close()
+        else:
+            # 續傳時沿用開始下載時記錄的水位線
+            watermark = state.get('watermark')
+        
         # 執行查詢並保存
-        print(f"  - 正在查詢數據 ({total_rows:,} 行)...")
-        df = db.raw_sql(sql)
+        if rate_limiter:
+            waited = rate_limiter.acquire_query()
+            if waited >= 1:
+                print(f"  - 限速等待 {waited:.1f} 秒")
+        print(f"  - 正在查詢數據 (預計 {total_rows:,} 行)...")
+        plan = None
+        if partitioned:
+            plan = state.get('plan') if state else None
+            if plan is None:
+                plan = plan_partitions(db.connection, library, table, partitions)
+                checkpoint.save(plan=plan, done={})
+            if plan is None:
+                print("  - 無法切分此表格，改為單連接下載")
+        if plan:
+            print(f"  - 分成 {len(plan)} 個範圍並行下載 (按 {plan[0]['column']})")
+            downloaded_rows = download_partitions(
+                db, library, table, plan, checkpoint,
+                export_engine=export_engine,
+                output_format=output_format,
+                arrow_schema=arrow_schema,
+                fetch_size=fetch_size,
+                rate_limiter=rate_limiter,
+                dtypes=dtypes,
+                slots=partition_slots
+            )
+            if not verify_row_count(downloaded_rows, total_rows, rows_exact):
+                checkpoint.discard()
+                raise Exception(f"合併後的行數 {downloaded_rows:,} 與目錄記錄的 {total_rows:,} 不符")
+        elif key_columns:
+            if state:
+                print(f"  - 從上次中斷處繼續下載 (已完成 {state['rows']:,} 行)")
+            downloaded_rows = download_key_batches(
+                db, library, table, key_columns, checkpoint, state,
+                export_engine=export_engine,
+                fetch_size=fetch_size,
+                rate_limiter=rate_limiter,
+                dtypes=dtypes
+            )
+        else:
+            downloaded_rows = export_query(
+                db, sql, checkpoint.part_path,
+                export_engine=export_engine,
+                output_format=output_format,
+                arrow_schema=arrow_schema,
+                fetch_size=fetch_size,
+                rate_limiter=rate_limiter,
+                dtypes=dtypes
+            )
         
-        # 如果數據為空，返回失敗
-        if df is None or df.empty:
+        if downloaded_rows == 0:
+            checkpoint.discard()
             print("  - 警告: 查詢返回空數據")
             return False, None, 0, datetime.now()
-            
-        print(f"  - 正在保存到文件...")
-        df.to_csv(output_file, index=False)
+        checkpoint.finish()
+        get_manifest(output_dir).record(
+            library, table, output_format, output_file, downloaded_rows,
+            checksum=file_checksum(output_file),
+            schema_hash=schema_hash(columns)
+        )
+        if watermark_column and watermark is not None:
+            watermarks.update(library, table, watermark_column, watermark)
         
-        # 添加隨機延遲
-        delay = get_random_delay()
-        print(f"  - 延遲 {delay:.1f} 秒...")
-        time.sleep(delay)
-        
-        return True, output_file, len(df), datetime.now()
+        if rate_limiter:
+            rate_limiter.record_success()
+        return True, output_file, downloaded_rows, datetime.now()
     except Exception as e:
+        if rate_limiter:
+            backoff = rate_limiter.record_error(e)
+            if backoff:
+                print(f"  - 連接或伺服器負載出錯，所有線程暫停 {backoff:.0f} 秒")
         print_error(f"下載表格 {library}.{table} 時出錯", e)
         return False, None, 0, datetime.now()
 
+def start_watermark(library, table, column, columns, path, watermarks):
+    """以已下載文件中水位線欄位的最大值建立水位線，完整下載之後新增的行在本次同步中補上；
+    文件中沒有該欄位或讀取失敗時返回 None"""
+    try:
+        value = column_max(path, column, dict(columns).get(column, ''))
+    except Exception as e:
+        print(f"  - 警告: 讀取 {path} 的 {column} 欄位時出錯: {str(e)}")
+        return None
+    if value is None:
+        return None
+    watermarks.update(library, table, column, value)
+    print(f"  - 以現有文件中 {column} 的最大值 {value} 作為水位線")
+    return watermarks.get(library, table)
+
+def delta_directory(output_dir, library, table):
+    """增量同步下載的新增數據所在的目錄"""
+    return os.path.join(output_dir, library, f"{table}_delta")
+
+def download_delta(db, library, table, output_dir, mark, watermarks, export_engine='copy',
+                   fetch_size=DEFAULT_FETCH_SIZE, output_format='csv', rate_limiter=None, compact_dtypes=True):
+    """增量同步：只下載水位線欄位大於上次記錄值的行，另存為 <表格>_delta 目錄下的一個新文件"""
+    column, low = mark['column'], mark['value']
+    if rate_limiter:
+        rate_limiter.acquire_query()
+    high = get_column_max(db.connection, library, table, column, above=low)
+    if high is None:
+        print(f"  - 沒有新數據 ({column} > {low})")
+        return True, None, 0, datetime.now()
+    
+    delta_dir = delta_directory(output_dir, library, table)
+    os.makedirs(delta_dir, exist_ok=True)
+    extension = file_extension(output_format)
+    output_file = find_partial_download(delta_dir, f"{table}_", extension)
+    if output_file is None:
+        current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
+        output_file = os.path.join(delta_dir, f"{table}_{current_time}{extension}")
+    
+    columns = get_column_types(db.connection, library, table)
+    arrow_schema = None
+    if output_format != 'csv':
+        arrow_schema = arrow_schema_from_columns(columns)
+        if export_engine == 'copy':
+            export_engine = 'stream'
+    dtypes = None
+    if compact_dtypes and export_engine != 'copy':
+        dtypes = DtypeMapper(columns, get_distinct_ratios(db.connection, library, table))
+    
+    # 範圍上界固定為查詢時的最大值，之後新增的行留到下次同步
+    quoted = quote_ident(column)
+    query = text(f"""
+        SELECT *
+        FROM {library}.{table}
+        WHERE {quoted} > :low
+        AND {quoted} <= :high
+    """)
+    checkpoint = DownloadCheckpoint(output_file, {'table': f"{library}.{table}", 'delta': column})
+    checkpoint.discard()
+    checkpoint.save(rows=0, bytes=0)
+    
+    print(f"  - 增量下載 {column} > {low} (至 {high})...")
+    if rate_limiter:
+        rate_limiter.acquire_query()
+    rows = export_query(
+        db, query, checkpoint.part_path,
+        export_engine=export_engine,
+        output_format=output_format,
+        arrow_schema=arrow_schema,
+        fetch_size=fetch_size,
+        rate_limiter=rate_limiter,
+        params={"low": low, "high": high},
+        dtypes=dtypes
+    )
+    checkpoint.finish()
+    get_manifest(output_dir).record(
+        library, table, output_format, output_file, rows,
+        kind='delta',
+        checksum=file_checksum(output_file),
+        schema_hash=schema_hash(columns)
+    )
+    watermarks.update(library, table, column, high)
+    print(f"  - 新增 {rows:,} 行 -> {output_file}")
+    return True, output_file, rows, datetime.now()
+
+def verify_row_count(downloaded_rows, expected_rows, exact=False):
+    """檢查下載的行數與目錄記錄是否一致；目錄行數為估算值時只在差異超過容許範圍時警告"""
+    if expected_rows is None or downloaded_rows == expected_rows:
+        return True
+    if exact:
+        return False
+    if abs(downloaded_rows - expected_rows) > expected_rows * ROW_COUNT_TOLERANCE:
+        print(f"  - 警告: 下載 {downloaded_rows:,} 行，目錄估算約 {expected_rows:,} 行")
+    return True
+
+def download_partitions(db, library, table, plan, checkpoint, export_engine='copy', output_format='csv',
+                        arrow_schema=None, fetch_size=DEFAULT_FETCH_SIZE, rate_limiter=None, dtypes=None, slots=None):
+    """並行下載各個範圍分區（各自使用一個額外的連接，全部完成後關閉），再按順序合併到臨時文件，返回總行數；
+    slots 為信號量時每個分區查詢先取得一個名額"""
+    part_files = [f"{checkpoint.path}.p{i}" for i in range(len(plan))]
+    # 檢查點中記錄已完成的分區，續傳時跳過
+    done = {i: rows for i, rows in checkpoint.state.get('done', {}).items() if os.path.exists(part_files[int(i)])}
+    pending = [i for i in range(len(plan)) if str(i) not in done]
+    if done:
+        print(f"  - {len(done)} 個分區已在上次完成")
+    
+    def fetch_partition(i):
+        if slots is not None:
+            slots.acquire()
+        try:
+            if rate_limiter:
+                rate_limiter.acquire_query()
+            query, params = build_partition_query(library, table, plan[i])
+            partial = part_files[i] + PARTIAL_SUFFIX
+            with db.engine.connect() as conn:
+                rows = export_query(
+                    db, query, partial,
+                    export_engine=export_engine,
+                    output_format=output_format,
+                    arrow_schema=arrow_schema,
+                    fetch_size=fetch_size,
+                    rate_limiter=rate_limiter,
+                    params=params,
+                    dtypes=dtypes,
+                    connection=conn
+                )
+        finally:
+            if slots is not None:
+                slots.release()
+        os.replace(partial, part_files[i])
+        return rows
+    
+    if pending:
+        errors = []
+        try:
+            with ThreadPoolExecutor(max_workers=min(len(pending), MAX_WORKERS),
+                                    thread_name_prefix=f"{table}-part") as executor:
+                futures = {executor.submit(fetch_partition, i): i for i in pending}
+                for future in as_completed(futures):
+                    i = futures[future]
+                    try:
+                        done[str(i)] = future.result()
+                    except Exception as e:
+                        errors.append(e)
+                        continue
+                    # 其他分區出錯時也記錄已完成的分區，續傳時不必重新下載
+                    checkpoint.save(done=done)
+                    print(f"  - 分區 {i + 1}/{len(plan)} 完成: {done[str(i)]:,} 行")
+        finally:
+            # 關閉連接池中閒置的分區連接，只保留工作線程自己的連接（db.connection 不受影響）
+            db.engine.dispose()
+        if errors:
+            raise errors[0]
+    
+    print("  - 正在合併分區文件...")
+    merge_files(output_format, part_files, checkpoint.part_path)
+    for path in part_files:
+        os.remove(path)
+    return sum(done.values())
+
+def export_query(db, query, path, export_engine='copy', output_format='csv', arrow_schema=None,
+                 fetch_size=DEFAULT_FETCH_SIZE, rate_limiter=None, params=None, dtypes=None, connection=None):
+    """用指定的匯出引擎把查詢結果寫入文件，返回行數；dtypes 為 DtypeMapper 時每批寫入前轉換欄位類型。
+    查詢在 connection 上執行（分區查詢傳入各自的連接），默認使用工作線程的 db.connection，不另開連接"""
+    if connection is None:
+        connection = db.connection
+    if export_engine == 'copy':
+        # 使用 COPY TO STDOUT 直接寫出 CSV，不經過 pandas
+        with open(path, 'wb') as f:
+            return copy_export(connection, query, rate_limiter.wrap_file(f) if rate_limiter else f, params=params)
+    
+    if export_engine == 'stream':
+        # 使用伺服器端游標分塊讀取；讀取下一塊與轉換、寫入本塊同時進行，記憶體只保留幾個區塊
+        def fetch_chunks():
+            for chunk in stream_query(connection, query, params=params, fetch_size=fetch_size):
+                yield chunk
+                # 伺服器端游標每讀取一塊都要向伺服器執行一次 FETCH
+                if rate_limiter:
+                    rate_limiter.acquire_query()
+        
+        with open_writer(output_format, path, arrow_schema) as writer:
+            # 按實際寫出的位元組數限速；寫入變慢時有界隊列也會讓抓取停下
+            meter = rate_limiter.meter_writer(writer) if rate_limiter else None
+            
+            def write_chunk(chunk):
+                writer.write_batch(chunk)
+                if meter:
+                    meter.charge()
+                print(f"  - 已寫入 {writer.rows_written:,} 行")
+            
+            timings = run_pipeline(fetch_chunks(), write_chunk,
+                                   transform=dtypes.apply if dtypes is not None else None)
+        print(f"  - 各階段耗時: {timings.summary()}")
+        return writer.rows_written
+    
+    if connection is db.connection:
+        df = db.raw_sql(query, params=params)
+    else:
+        df = pd.read_sql_query(query, connection, params=params)
+    
+    # 如果數據為空，返回 0 行
+    if df is None or df.empty:
+        return 0
+        
+    if dtypes is not None:
+        df = dtypes.apply(df)
+    print(f"  - 正在保存到文件...")
+    with open_writer(output_format, path, arrow_schema) as writer:
+        meter = rate_limiter.meter_writer(writer) if rate_limiter else None
+        writer.write_batch(df)
+        if meter:
+            meter.charge()
+    return len(df)
+
+def download_key_batches(db, library, table, key_columns, checkpoint, state, export_engine='copy',
+                         fetch_size=DEFAULT_FETCH_SIZE, rate_limiter=None, dtypes=None):
+    """按鍵值順序分批下載到 CSV 臨時文件，每批寫入磁碟後更新檢查點；state 為上次的進度時從該處繼續"""
+    last_key = state['last_key'] if state else None
+    rows = state['rows'] if state else 0
+    
+    if export_engine == 'copy':
+        # 先從索引找出本批的上界鍵值，再用 COPY 匯出 (last_key, upper_key] 範圍內的行
+        with open(checkpoint.part_path, 'ab' if state else 'wb') as f:
+            out = rate_limiter.wrap_file(f) if rate_limiter else f
+            while True:
+                # 每批執行兩個查詢：在索引上找上界鍵值，再 COPY 該範圍
+                if rate_limiter:
+                    rate_limiter.acquire_query()
+                upper_key = find_batch_upper_key(db.connection, library, table, key_columns, last_key, fetch_size)
+                sql, params = build_key_range_sql(library, table, key_columns, last_key, upper_key)
+                if rate_limiter:
+                    rate_limiter.acquire_query()
+                rows += copy_export(db.connection, sql, out, params=params, header=f.tell() == 0)
+                f.flush()
+                os.fsync(f.fileno())
+                if upper_key is None:
+                    return rows
+                last_key = upper_key
+                checkpoint.save(last_key=last_key, rows=rows, bytes=f.tell())
+                print(f"  - 已寫入 {rows:,} 行")
+    
+    def fetch_batches(last_key):
+        """按鍵值順序逐批查詢，產生 (批次, 該批的最後一個鍵值)"""
+        while True:
+            query, params = build_keyset_query(library, table, key_columns, last_key, fetch_size)
+            if rate_limiter:
+                rate_limiter.acquire_query()
+            batch_df = pd.read_sql_query(query, db.connection, params=params)
+            last_key = pop_last_key(batch_df, key_columns) or last_key
+            yield batch_df, last_key
+            if len(batch_df) < fetch_size:
+                return
+    
+    with open_writer('csv', checkpoint.part_path, resume_rows=rows if state else None) as writer:
+        meter = rate_limiter.meter_writer(writer) if rate_limiter else None
+        
+        def write_batch(item):
+            batch_df, batch_last_key = item
+            if not batch_df.empty or writer.rows_written == 0:
+                writer.write_batch(batch_df)
+                if meter:
+                    meter.charge()
+            if len(batch_df) == fetch_size:
+                checkpoint.save(last_key=batch_last_key, rows=writer.rows_written, bytes=writer.flush())
+                print(f"  - 已寫入 {writer.rows_written:,} 行")
+        
+        # 下一批的查詢與本批的轉換、寫入同時進行
+        convert = (lambda item: (dtypes.apply(item[0]), item[1])) if dtypes is not None else None
+        timings = run_pipeline(fetch_batches(last_key), write_batch, transform=convert)
+    print(f"  - 各階段耗時: {timings.summary()}")
+    return writer.rows_written
+
+class DownloadWorkers:
+    """並行下載的工作線程：每個線程第一次使用時建立自己的 WRDS 連接，結束時統一關閉；
+    每個線程只佔用一個連接，分區下載時工作線程與分區查詢共用 MAX_WORKERS 個連接的上限"""
+
+    def __init__(self, workers, rate_limiter=None, connect=None, partitions=1):
+        self.workers = max(1, min(workers, MAX_WORKERS))
+        # 工作線程用剩的連接名額留給所有表格的分區查詢，至少保留一個
+        self.partition_slots = None
+        if partitions > 1:
+            self.workers = min(self.workers, MAX_WORKERS - 1)
+            self.partition_slots = threading.BoundedSemaphore(MAX_WORKERS - self.workers)
+        self.rate_limiter = rate_limiter
+        self._connect = connect or open_wrds_connection
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _worker_state(self):
+        state = self._local
+        if not hasattr(state, 'db'):
+            if self.rate_limiter:
+                self.rate_limiter.acquire_query()
+            state.db = self._connect()
+            with self._lock:
+                self._connections.append(state.db)
+        return state
+
+    def _download(self, lib, table_name, row_count, output_dir, download_kwargs):
+        state = self._worker_state()
+        print(f"\n[{threading.current_thread().name}] 開始下載 {lib}.{table_name} (預計 {row_count:,} 行)")
+        return download_table(
+            state.db, lib, table_name, output_dir,
+            total_rows=row_count,
+            rate_limiter=self.rate_limiter,
+            partition_slots=self.partition_slots,
+            **download_kwargs
+        )
+
+    def run(self, tables, output_dir, **download_kwargs):
+        """按給定順序把表格分派給工作線程，依完成順序返回 ((資料庫, 表格, 行數), 結果或異常)"""
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='worker') as executor:
+            futures = {
+                executor.submit(self._download, lib, table_name, row_count, output_dir, download_kwargs):
+                    (lib, table_name, row_count)
+                for lib, table_name, row_count, _ in tables
+            }
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result()
+                except Exception as e:
+                    yield futures[future], e
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for db in connections:
+            try:
+                db.close()
+            except:
+                pass
+
 def save_catalog(output_dir, catalog_data):
     """保存資料庫目錄信息"""
     try:
         catalog_file = os.path.join(output_dir, "wrds_catalog.csv")
-        df = pd.DataFrame(catalog_data, columns=[
-            "資料庫", "表格名稱", "大小", "行數", "上次掃描時間"
-        ])
+        df = pd.DataFrame(catalog_data, columns=CATALOG_COLUMNS[:len(catalog_data[0])] if catalog_data else CATALOG_COLUMNS)
         df.to_csv(catalog_file, index=False, encoding='utf-8-sig')
         print(f"資料庫目錄已更新: {catalog_file}")
     except Exception as e:
@@ -261,7 +710,7 @@ def load_catalog(output_dir):
         print(f"讀取資料庫目錄時出錯: {str(e)}")
         return None
 
-def update_catalog(db, output_dir, force_update=False):
+def update_catalog(db, output_dir, force_update=False, exact_counts=False):
     """更新資料庫目錄"""
     try:
         # 檢查現有目錄
@@ -276,7 +725,8 @@ def update_catalog(db, output_dir, force_update=False):
             print("錯誤: 沒有找到任何資料庫")
             return None
             
-        accessible_libraries = [lib for lib in libraries if check_access(db, lib)]
+        # 一次查詢檢查所有資料庫的訪問權限
+        accessible_libraries = SchemaAccess(db.connection).accessible(libraries)
         if not accessible_libraries:
             print("錯誤: 沒有可訪問的資料庫")
             return None
@@ -286,17 +736,19 @@ def update_catalog(db, output_dir, force_update=False):
         catalog_data = []
         current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         
-        for lib in tqdm(accessible_libraries, desc="掃描資料庫"):
-            tables = get_table_list(db, lib)
-            for table_info in tables:
-                table_name, size_str, size_bytes, row_count = table_info
-                catalog_data.append([
-                    lib,
-                    table_name,
-                    size_str,
-                    row_count,
-                    current_time
-                ])
+        # 一次查詢掃描所有可訪問資料庫的表格，不再逐表查詢大小和行數
+        print("正在批量掃描表格目錄...")
+        tables = scan_catalog(db.connection, accessible_libraries, exact_counts=exact_counts)
+        for lib, table_name, size_str, size_bytes, row_count, description in tables:
+            catalog_data.append([
+                lib,
+                table_name,
+                size_str,
+                row_count,
+                current_time,
+                size_bytes,
+                description or ""
+            ])
         
         # 保存目錄
         save_catalog(output_dir, catalog_data)
@@ -306,7 +758,14 @@ def update_catalog(db, output_dir, force_update=False):
         print_error(f"更新資料庫目錄時出錯", e)
         return None
 
-def download_all_tables():
+def download_all_tables(force_update=False, export_engine='copy', fetch_size=DEFAULT_FETCH_SIZE, output_format='csv',
+                        exact_counts=False, workers=DEFAULT_WORKERS,
+                        queries_per_minute=DEFAULT_QUERIES_PER_MINUTE, bytes_per_second=0, incremental=False,
+                        partitions=1, partition_min_rows=DEFAULT_PARTITION_MIN_ROWS, compact_dtypes=True):
+    # 所有線程共用一個限速器，取代原本每個表格之後的隨機延遲和定期休息
+    rate_limiter = RateLimiter(queries_per_minute=queries_per_minute, bytes_per_second=bytes_per_second)
+    partitions = max(1, min(partitions, MAX_PARTITIONS))
+    workers = DownloadWorkers(workers, rate_limiter=rate_limiter, partitions=partitions)
     try:
         print_progress_header()
         
@@ -322,7 +781,7 @@ def download_all_tables():
         
         # 步驟 3: 獲取或更新資料庫目錄
         print_step(3, 5, "獲取資料庫目錄")
-        catalog_data = update_catalog(db, output_dir)
+        catalog_data = update_catalog(db, output_dir, force_update=force_update, exact_counts=exact_counts)
         if not catalog_data:
             print("錯誤: 無法獲取資料庫目錄")
             return
@@ -334,15 +793,40 @@ def download_all_tables():
         all_tables = []
         total_size = 0
         skipped_tables = []
+        delta_count = 0
+        baseline_count = 0
         
-        for lib, table_name, size_str, row_count, _ in catalog_data:
+        # 增量同步模式：已下載且有水位線的表格只下載新增的行，沒有水位線的表格建立水位線
+        watermarks = WatermarkStore(os.path.join(output_dir, "watermarks.json")) if incremental else None
+        
+        # 一次查詢取得已有下載的資料庫中所有表格目前的欄位，結構改變的表格重新下載
+        manifest = get_manifest(output_dir)
+        downloaded_libraries = manifest.libraries(output_format)
+        current_columns = get_schema_column_types(db.connection, downloaded_libraries) if downloaded_libraries else {}
+        verify_count = 0
+        
+        for lib, table_name, size_str, row_count, *extra in catalog_data:
             # 檢查是否已下載
-            already_exists, existing_file = check_existing_download(output_dir, lib, table_name)
-            if already_exists:
-                skipped_tables.append((lib, table_name, existing_file))
-                continue
-                
-            all_tables.append((lib, table_name, row_count))
+            already_exists, existing_file = check_existing_download(output_dir, lib, table_name, output_format,
+                                                                    current_columns.get((lib, table_name)))
+            if already_exists and not manifest.latest(lib, table_name, output_format)['verified']:
+                # 下載索引建立之前的文件交給工作線程檢查是否完整
+                verify_count += 1
+            elif already_exists:
+                if watermarks is None:
+                    skipped_tables.append((lib, table_name, existing_file))
+                    continue
+                if (lib, table_name) in watermarks:
+                    delta_count += 1
+                else:
+                    baseline_count += 1
+            
+            # 舊版目錄沒有大小(位元組)欄位，以行數代替排序
+            size_bytes = extra[1] if len(extra) > 1 and pd.notna(extra[1]) else row_count
+            all_tables.append((lib, table_name, row_count, size_bytes))
+        
+        # 最大的表格最先下載，避免最後只剩一個大表格在跑
+        all_tables.sort(key=lambda item: item[3], reverse=True)
         
         # 顯示跳過的表格信息
         if skipped_tables:
@@ -355,59 +839,74 @@ def download_all_tables():
             return
             
         print(f"\n需要下載 {len(all_tables)} 個表格")
+        if delta_count:
+            print(f"其中 {delta_count} 個表格只下載水位線之後的新增數據")
+        if baseline_count:
+            print(f"其中 {baseline_count} 個已下載的表格沒有水位線，將由現有文件建立水位線後下載新增數據")
+        if verify_count:
+            print(f"其中 {verify_count} 個之前下載的文件尚未驗證，將先檢查是否完整")
         
         # 步驟 5: 開始下載
-        print_step(5, 5, "開始下載數據")
+        if workers.partition_slots is not None:
+            print_step(5, 5, f"開始下載數據 ({workers.workers} 個並行線程，"
+                             f"分區查詢共用 {MAX_WORKERS - workers.workers} 個連接)")
+        else:
+            print_step(5, 5, f"開始下載數據 ({workers.workers} 個並行線程)")
         download_log = []
         successful_downloads = 0
         total_rows_downloaded = 0
-        last_download_time = None
+        delta_tables = 0
+        delta_rows = 0
         
-        for i, (lib, table_name, row_count) in enumerate(all_tables, 1):
-            print(f"\n表格 {i}/{len(all_tables)}: {lib}.{table_name}")
-            print(f"預計行數: {row_count:,}")
-            
-            # 檢查是否需要休息
-            if should_take_break(i):
-                take_break()
-            
-            try:
-                success, file_path, downloaded_rows, download_time = download_table(
-                    db, lib, table_name, output_dir, 
-                    total_rows=row_count,
-                    last_download_time=last_download_time
-                )
-                last_download_time = download_time
-                
-                status = "成功" if success else "失敗"
-                if success:
-                    successful_downloads += 1
-                    total_rows_downloaded += downloaded_rows
-                
-                # 計算總進度
-                progress = (i / len(all_tables)) * 100
-                print(f"總進度: {progress:.1f}% ({i}/{len(all_tables)})")
-                
-                # 記錄下載信息
-                download_log.append([
-                    lib,
-                    table_name,
-                    f"{downloaded_rows:,}",
-                    status,
-                    datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    file_path if success else ""
-                ])
-                
-            except Exception as e:
-                print(f"下載失敗: {str(e)}")
+        results = workers.run(
+            all_tables, output_dir,
+            export_engine=export_engine,
+            fetch_size=fetch_size,
+            output_format=output_format,
+            watermarks=watermarks,
+            partitions=partitions,
+            partition_min_rows=partition_min_rows,
+            rows_exact=exact_counts,
+            compact_dtypes=compact_dtypes
+        )
+        for i, ((lib, table_name, row_count), result) in enumerate(results, 1):
+            if isinstance(result, Exception):
+                print(f"下載 {lib}.{table_name} 失敗: {str(result)}")
                 download_log.append([
                     lib,
                     table_name,
                     "0",
                     "失敗",
                     datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    str(e)
+                    str(result)
                 ])
+                continue
+            
+            success, file_path, downloaded_rows, download_time = result
+            status = "成功" if success else "失敗"
+            if success:
+                successful_downloads += 1
+                total_rows_downloaded += downloaded_rows
+                # 增量同步的結果（沒有新數據時沒有文件）
+                if file_path is None or os.path.dirname(file_path) == delta_directory(output_dir, lib, table_name):
+                    status = "成功(增量)"
+                    delta_tables += 1
+                    delta_rows += downloaded_rows
+            
+            # 計算總進度（按完成順序）
+            progress = (i / len(all_tables)) * 100
+            print(f"\n{lib}.{table_name}: {status}，{downloaded_rows:,} 行")
+            print(f"總進度: {progress:.1f}% ({i}/{len(all_tables)})")
+            
+            # 記錄下載信息
+            download_log.append([
+                lib,
+                table_name,
+                f"{downloaded_rows:,}",
+                status,
+                download_time.strftime("%Y-%m-%d %H:%M:%S"),
+                (file_path or "") if success else ""
+            ])
         
         if download_log:  # 只有在有下載記錄時才保存日誌
             # 保存下載日誌
@@ -426,6 +925,11 @@ def download_all_tables():
             print(f"失敗數量: {len(all_tables) - successful_downloads}")
             print(f"成功率: {(successful_downloads/len(all_tables)*100):.1f}%")
             print(f"總行數: {total_rows_downloaded:,}")
+            if watermarks is not None:
+                print(f"增量同步: {delta_tables} 個表格，新增 {delta_rows:,} 行")
+            limiter_stats = rate_limiter.stats()
+            print(f"查詢次數: {limiter_stats['queries']}，出錯次數: {limiter_stats['errors']}，"
+                  f"限速等待: {limiter_stats['waited_seconds']} 秒")
             print(f"\n下載日誌已保存到: {log_file}")
         else:
             print("\n沒有任何新表格需要下載")
@@ -433,6 +937,7 @@ def download_all_tables():
     except Exception as e:
         print_error("程序執行過程中發生錯誤", e)
     finally:
+        workers.close()
         try:
             db.close()
             print("\n資料庫連接已關閉")
@@ -441,12 +946,50 @@ def download_all_tables():
 
 if __name__ == "__main__":
     try:
+        parser = argparse.ArgumentParser(description="下載所有可訪問的 WRDS 表格")
+        parser.add_argument("--update-catalog", action="store_true", help="強制更新資料庫目錄")
+        parser.add_argument("--engine", choices=EXPORT_ENGINES, default='copy',
+                            help="匯出引擎: copy (COPY TO STDOUT)、stream (伺服器端游標)、raw (一次讀取整個表格)")
+        parser.add_argument("--fetch-size", type=int, default=DEFAULT_FETCH_SIZE,
+                            help=f"串流模式每次取回的行數 (預設: {DEFAULT_FETCH_SIZE})")
+        parser.add_argument("--format", choices=list(OUTPUT_FORMATS), default='csv',
+                            help="輸出格式 (預設: csv)；parquet/feather 會改用 stream 引擎")
+        parser.add_argument("--exact-counts", action="store_true",
+                            help="更新目錄時使用 COUNT(*) 計算精確行數（默認使用統計信息估算）")
+        parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                            help=f"並行下載的線程數，每個線程的所有查詢都在自己的一個連接上執行 "
+                                 f"(預設: {DEFAULT_WORKERS}，上限: {MAX_WORKERS})")
+        parser.add_argument("--queries-per-minute", type=float, default=DEFAULT_QUERIES_PER_MINUTE,
+                            help=f"所有線程合計每分鐘最多執行的查詢數 (預設: {DEFAULT_QUERIES_PER_MINUTE}，0 表示不限制)")
+        parser.add_argument("--max-bytes-per-second", type=int, default=0,
+                            help="所有線程合計每秒最多接收的位元組數 (預設: 0，不限制)")
+        parser.add_argument("--incremental", action="store_true",
+                            help="增量同步：已下載的表格只下載水位線（日期或鍵值欄位）之後的新增數據")
+        parser.add_argument("--partitions", type=int, default=1,
+                            help=f"大表格切分成多少個範圍並行下載 (預設: 1 不切分，上限: {MAX_PARTITIONS})；"
+                                 f"分區查詢與工作線程合計最多使用 {MAX_WORKERS} 個連接，另加主線程讀取目錄的一個連接")
+        parser.add_argument("--partition-min-rows", type=int, default=DEFAULT_PARTITION_MIN_ROWS,
+                            help=f"行數達到此值的表格才切分下載 (預設: {DEFAULT_PARTITION_MIN_ROWS:,})")
+        parser.add_argument("--no-compact-dtypes", action="store_true",
+                            help="stream/raw 引擎不把欄位轉換成緊湊的 dtype（可空整數、float32、category、datetime64）")
+        args = parser.parse_args()
+        
         # 檢查是否需要強制更新目錄
-        force_update = "--update-catalog" in sys.argv
-        if force_update:
+        if args.update_catalog:
             print("將強制更新資料庫目錄")
         
-        download_all_tables()
+        download_all_tables(force_update=args.update_catalog,
+                            export_engine=args.engine,
+                            fetch_size=args.fetch_size,
+                            output_format=args.format,
+                            exact_counts=args.exact_counts,
+                            workers=args.workers,
+                            queries_per_minute=args.queries_per_minute,
+                            bytes_per_second=args.max_bytes_per_second,
+                            incremental=args.incremental,
+                            partitions=args.partitions,
+                            partition_min_rows=args.partition_min_rows,
+                            compact_dtypes=not args.no_compact_dtypes)
     except KeyboardInterrupt:
         print("\n\n程序被用戶中斷")
         sys.exit(0)
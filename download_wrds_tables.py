@@ -1,11 +1,14 @@
-import wrds
 import pandas as pd
 from datetime import datetime
 import os
 from dotenv import load_dotenv
 import time
 import sys
+import argparse
 from sqlalchemy import text
+from wrds_export import get_column_types
+from output_formats import OUTPUT_FORMATS, open_writer, file_extension, arrow_schema_from_columns
+from query_cassette import connect_wrds
 
 def read_authorized_databases():
     """從 CSV 文件讀取授權的數據庫列表"""
@@ -36,8 +39,9 @@ def read_authorized_databases():
 def get_wrds_connection():
     """建立 WRDS 連接"""
     try:
+        # 設置了 WRDS_CASSETTE 時錄製或重播該連接上的查詢
         # 直接使用帳號密碼（注意：這些認證信息應該保密）
-        conn = wrds.Connection(
+        conn = connect_wrds(
             wrds_username='crysta_hwg',  # 您的 WRDS 用戶名
             wrds_password='Aa123456!',   # 您的 WRDS 密碼
             connect_args={'sslmode': 'require'},
@@ -75,7 +79,7 @@ def get_tables_for_database(conn, database):
         print(f"錯誤詳情: {str(e)}")
         return []
 
-def download_table_data(conn, schema, table, base_dir):
+def download_table_data(conn, schema, table, base_dir, output_format='csv'):
     """下載指定表格的數據"""
     try:
         print(f"\n開始處理表格: {schema}.{table}")
@@ -108,8 +112,14 @@ def download_table_data(conn, schema, table, base_dir):
         os.makedirs(schema_dir, exist_ok=True)
         
         current_date = datetime.now().strftime('%Y%m%d')
-        output_filename = os.path.join(schema_dir, f'{table}_{current_date}.csv')
-        df.to_csv(output_filename, index=False)
+        output_filename = os.path.join(schema_dir, f'{table}_{current_date}{file_extension(output_format)}')
+        
+        # 列式格式使用表格的欄位類型作為 schema，不依賴樣本數據推斷
+        arrow_schema = None
+        if output_format != 'csv':
+            arrow_schema = arrow_schema_from_columns(get_column_types(conn.connection, schema, table))
+        with open_writer(output_format, output_filename, arrow_schema) as writer:
+            writer.write_batch(df)
         
         print(f"成功下載並保存到: {output_filename}")
         time.sleep(1)
@@ -118,7 +128,7 @@ def download_table_data(conn, schema, table, base_dir):
         print(f"錯誤：處理表格 {schema}.{table} 時發生錯誤")
         print(f"錯誤詳情: {str(e)}")
 
-def fetch_authorized_data():
+def fetch_authorized_data(output_format='csv'):
     """下載所有授權數據庫的數據"""
     authorized_dbs = read_authorized_databases()
     print(f"授權的數據庫: {authorized_dbs}")
@@ -138,7 +148,7 @@ def fetch_authorized_data():
                 
             print(f"發現 {len(tables)} 個表格")
             for table in tables:
-                download_table_data(conn, db, table, base_dir)
+                download_table_data(conn, db, table, base_dir, output_format)
                 
     except Exception as e:
         print(f"錯誤：程序執行過程中發生未預期的錯誤")
@@ -153,4 +163,7 @@ def fetch_authorized_data():
                 pass
 
 if __name__ == "__main__":
-    fetch_authorized_data() 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="下載所有授權數據庫的表格數據")
+    parser.add_argument("--format", choices=list(OUTPUT_FORMATS), default='csv', help="輸出格式 (預設: csv)")
+    args = parser.parse_args()
+    fetch_authorized_data(args.format) 
\ No newline at end of file
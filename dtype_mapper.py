@@ -0,0 +1,120 @@
+import re
+import threading
+
+# 不同值佔行數的比例不超過此值、且不同值不超過 CATEGORY_MAX_UNIQUES 個的文字欄位轉換成 category；
+# 不同值較多時 category 的字典和編碼反而比原來的字串更佔記憶體，而且每批的字典不同，合併時也要重新編碼
+CATEGORY_MAX_RATIO = 0.05
+CATEGORY_MAX_UNIQUES = 100000
+
+# 文字欄位：是否使用 category 由不同值的比例決定
+TEXT = 'text'
+
+_NUMERIC_PRECISION = re.compile(r'^numeric\((\d+),\s*(\d+)\)$')
+
+def numeric_precision(pg_type):
+    """返回 numeric(p,s) 的 (p, s)；沒有指定精度時返回 None"""
+    match = _NUMERIC_PRECISION.match(pg_type.lower())
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+def compact_numeric_kind(pg_type):
+    """numeric(p,s) 可以無損表示的最小類型：'int16' / 'int32' / 'int64' / 'float32'，否則返回 None"""
+    precision = numeric_precision(pg_type)
+    if precision is None:
+        return None
+    digits, scale = precision
+    if scale == 0:
+        if digits <= 4:
+            return 'int16'
+        if digits <= 9:
+            return 'int32'
+        if digits <= 18:
+            return 'int64'
+        return None
+    # float32 可以準確往返最多 6 位有效數字的十進位數
+    return 'float32' if digits <= 6 else None
+
+_NUMERIC_DTYPES = {'int16': 'Int16', 'int32': 'Int32', 'int64': 'Int64', 'float32': 'float32'}
+
+def pandas_dtype_for_pg(pg_type):
+    """把 PostgreSQL 欄位類型對應到無損的緊湊 pandas dtype；文字欄位返回 TEXT，保持原樣的返回 None"""
+    pg_type = pg_type.lower()
+    if pg_type.endswith('[]'):
+        return None
+    if pg_type == 'smallint':
+        return 'Int16'
+    if pg_type == 'integer':
+        return 'Int32'
+    if pg_type == 'bigint':
+        return 'Int64'
+    if pg_type == 'real':
+        return 'float32'
+    if pg_type == 'double precision':
+        return 'float64'
+    if pg_type.startswith('numeric'):
+        return _NUMERIC_DTYPES.get(compact_numeric_kind(pg_type), 'float64')
+    if pg_type == 'boolean':
+        return 'boolean'
+    # datetime64[s] 可以表示 9999-12-31 等超出納秒範圍的日期
+    if pg_type == 'date':
+        return 'datetime64[s]'
+    if pg_type.startswith('timestamp') and 'with time zone' not in pg_type:
+        return 'datetime64[us]'
+    if pg_type in ('text', 'name') or pg_type.startswith(('character', 'varchar', 'char')):
+        return TEXT
+    return None
+
+def frame_memory(df):
+    """DataFrame 佔用的記憶體（位元組，包含字串對象）"""
+    return int(df.memory_usage(index=False, deep=True).sum())
+
+class DtypeMapper:
+    """由表格欄位類型決定每個欄位的緊湊 dtype（可空整數、無損的 float32、category、datetime64），
+    對每一批數據套用同一組轉換；distinct_ratios 為各欄位不同值佔行數的比例（來自 pg_stats），
+    row_count 為表格的（估算）行數，用於換算不同值的個數；沒有統計信息的文字欄位由第一批數據決定"""
+
+    def __init__(self, columns, distinct_ratios=None, category_max_ratio=CATEGORY_MAX_RATIO, row_count=None,
+                 category_max_uniques=CATEGORY_MAX_UNIQUES):
+        self.category_max_ratio = category_max_ratio
+        self.category_max_uniques = category_max_uniques
+        self.dtypes = {}
+        self._undecided = []
+        self._lock = threading.Lock()
+        distinct_ratios = distinct_ratios or {}
+        for name, pg_type in columns:
+            dtype = pandas_dtype_for_pg(pg_type)
+            if dtype == TEXT:
+                ratio = distinct_ratios.get(name)
+                if ratio is None:
+                    self._undecided.append(name)
+                elif self._use_category(ratio, ratio * row_count if row_count else None):
+                    self.dtypes[name] = 'category'
+            elif dtype is not None:
+                self.dtypes[name] = dtype
+
+    def _use_category(self, ratio, uniques=None):
+        return ratio <= self.category_max_ratio and (uniques is None or uniques <= self.category_max_uniques)
+
+    def _decide_text_columns(self, df):
+        with self._lock:
+            if not self._undecided or df.empty:
+                return
+            for name in self._undecided:
+                if name not in df.columns:
+                    continue
+                uniques = df[name].nunique()
+                if self._use_category(uniques / len(df), uniques):
+                    self.dtypes[name] = 'category'
+            self._undecided = []
+
+    def apply(self, df):
+        """就地轉換一批數據的欄位類型並返回該 DataFrame；無法轉換的欄位保持原樣"""
+        if self._undecided:
+            self._decide_text_columns(df)
+        for name, dtype in self.dtypes.items():
+            if name not in df.columns or df[name].dtype == dtype:
+                continue
+            try:
+                df[name] = df[name].astype(dtype)
+            except (ValueError, TypeError, OverflowError):
+                pass
+        return df
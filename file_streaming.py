@@ -0,0 +1,85 @@
+import time
+import zlib
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+def _import_zstandard():
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        return None
+
+def available_encodings():
+    """可用的即時壓縮編碼，按優先順序；zstd 需要安裝 zstandard"""
+    return ['zstd', 'gzip'] if _import_zstandard() else ['gzip']
+
+class _Encoder:
+    """串流壓縮：compress() 返回已產生的壓縮數據，sync() 把緩衝區中的數據送出，finish() 結束壓縮流"""
+
+    def __init__(self, encoding, level=None):
+        if encoding == 'gzip':
+            self._obj = zlib.compressobj(6 if level is None else level, zlib.DEFLATED, 31)
+            self._sync_mode = zlib.Z_SYNC_FLUSH
+        elif encoding == 'zstd':
+            zstandard = _import_zstandard()
+            if zstandard is None:
+                raise ImportError("zstd 壓縮需要安裝 zstandard（pip install zstandard）")
+            self._obj = zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+            self._sync_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            raise ValueError(f"不支援的壓縮編碼: {encoding}")
+        self._pending = False
+
+    def compress(self, data):
+        self._pending = True
+        return self._obj.compress(data)
+
+    def sync(self):
+        if not self._pending:
+            return b''
+        self._pending = False
+        return self._obj.flush(self._sync_mode)
+
+    def finish(self):
+        return self._obj.flush()
+
+def encode_chunks(chunks, encoding=None):
+    """按內容編碼壓縮數據塊；空數據塊表示暫時沒有新數據，此時把已壓縮的部分先送出"""
+    if encoding is None:
+        for chunk in chunks:
+            if chunk:
+                yield chunk
+        return
+    encoder = _Encoder(encoding)
+    for chunk in chunks:
+        output = encoder.compress(chunk) if chunk else encoder.sync()
+        if output:
+            yield output
+    yield encoder.finish()
+
+def iter_file(path, offset=0, chunk_size=STREAM_CHUNK_SIZE):
+    """從 offset 開始分塊讀取文件"""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+def iter_growing_file(fileobj, finished, chunk_size=STREAM_CHUNK_SIZE, poll_interval=0.5):
+    """讀取仍在寫入中的文件，讀到末尾時等待新數據，直到 finished() 為 True 且已讀完；
+    finished() 拋出異常表示寫入失敗。文件完成後被改名不影響已打開的文件對象"""
+    with fileobj:
+        while True:
+            # 先檢查狀態再讀取，避免漏掉完成前最後寫入的數據
+            done = finished()
+            chunk = fileobj.read(chunk_size)
+            if chunk:
+                yield chunk
+                continue
+            if done:
+                return
+            yield b''
+            time.sleep(poll_interval)
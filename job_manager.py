@@ -0,0 +1,145 @@
+import threading
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+# 任務狀態
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETE = 'complete'
+ERROR = 'error'
+
+class DownloadJob:
+    """單個下載任務，保存自己的進度狀態"""
+
+    def __init__(self, table_name, options):
+        self.id = uuid.uuid4().hex[:12]
+        self.table_name = table_name
+        self.options = options
+        self.state = QUEUED
+        self.created_at = datetime.now()
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+        # 狀態有變化時遞增版本號並喚醒等待中的事件流
+        self._changed = threading.Condition(self._lock)
+        self.version = 0
+        self._status = {
+            'status': '排隊等待中...',
+            'step': 0,
+            'progress': 0,
+            'filename': '',
+            'error': None
+        }
+
+    def update(self, **fields):
+        """更新任務的進度字段（與原 download_status 的字段相同）"""
+        with self._lock:
+            if all(self._status.get(key) == value for key, value in fields.items()):
+                return
+            self._status.update(fields)
+            self._notify()
+
+    def set_state(self, state):
+        with self._lock:
+            self.state = state
+            if state == RUNNING:
+                self.started_at = datetime.now()
+            elif state in (COMPLETE, ERROR):
+                self.finished_at = datetime.now()
+            self._notify()
+
+    def _notify(self):
+        self.version += 1
+        self._changed.notify_all()
+
+    def wait_for_change(self, version, timeout=None):
+        """等待狀態版本號超過 version，返回最新版本號（超時則返回原值）"""
+        with self._lock:
+            self._changed.wait_for(lambda: self.version > version, timeout=timeout)
+            return self.version
+
+    @property
+    def is_finished(self):
+        return self.state in (COMPLETE, ERROR)
+
+    def to_dict(self):
+        with self._lock:
+            data = dict(self._status)
+            data.update({
+                'job_id': self.id,
+                'table_name': self.table_name,
+                'options': self.options,
+                'state': self.state,
+                'created_at': self.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+                'started_at': self.started_at.strftime("%Y-%m-%d %H:%M:%S") if self.started_at else None,
+                'finished_at': self.finished_at.strftime("%Y-%m-%d %H:%M:%S") if self.finished_at else None,
+            })
+            return data
+
+    def get(self, field, default=None):
+        with self._lock:
+            return self._status.get(field, default)
+
+class JobManager:
+    """下載任務登記表：每個任務有自己的 ID 和狀態，由固定大小的線程池執行"""
+
+    def __init__(self, target, max_workers=2, max_history=100):
+        self._target = target
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='download')
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_workers = max_workers
+        self.max_history = max_history
+
+    def submit(self, table_name, **options):
+        """登記新任務並放入線程池隊列"""
+        job = DownloadJob(table_name, options)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._trim_history()
+        self._executor.submit(self._run, job)
+        return job
+
+    def _run(self, job):
+        job.set_state(RUNNING)
+        job.update(status='開始處理...')
+        try:
+            self._target(job.table_name, job=job, **job.options)
+            job.set_state(COMPLETE)
+        except Exception as e:
+            job.update(status='error', error=job.get('error') or str(e))
+            job.set_state(ERROR)
+            traceback.print_exc()
+
+    def _trim_history(self):
+        # 只保留最近 max_history 個任務，優先刪除已完成的舊任務
+        while len(self._jobs) > self.max_history:
+            finished = [job_id for job_id, job in self._jobs.items() if job.is_finished]
+            if not finished:
+                break
+            del self._jobs[finished[0]]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list_jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def latest(self):
+        with self._lock:
+            return next(reversed(self._jobs.values()), None)
+
+    def summary(self):
+        jobs = self.list_jobs()
+        return {
+            'max_workers': self.max_workers,
+            'queued': sum(1 for job in jobs if job.state == QUEUED),
+            'running': sum(1 for job in jobs if job.state == RUNNING),
+            'complete': sum(1 for job in jobs if job.state == COMPLETE),
+            'error': sum(1 for job in jobs if job.state == ERROR),
+        }
@@ -1,4 +1,3 @@
-import wrds
 import configparser
 from tabulate import tabulate
 import sys
@@ -6,6 +5,8 @@ import traceback
 import csv
 from datetime import datetime
 import os
+from wrds_export import SchemaAccess
+from query_cassette import connect_wrds, get_cassette, replaying
 
 def print_error(error_msg, error_obj=None):
     """打印錯誤信息"""
@@ -21,6 +22,11 @@ def print_error(error_msg, error_obj=None):
 
 def get_wrds_connection():
     try:
+        # 設置了 WRDS_CASSETTE 時錄製查詢，或不連接 WRDS 直接重播錄製的結果
+        if replaying():
+            print(f"\n正在重播錄製的查詢: {get_cassette().path}\n")
+            return connect_wrds()
+        
         # 讀取配置文件
         config = configparser.ConfigParser()
         config.read('config.ini')
@@ -30,9 +36,9 @@ def get_wrds_connection():
         password = config['WRDS']['password']
         
         print(f"\n嘗試連接到 WRDS (用戶名: {username})...")
-        db = wrds.Connection(wrds_username=username, 
-                           wrds_password=password, 
-                           autoconnect=True)
+        db = connect_wrds(wrds_username=username, 
+                          wrds_password=password, 
+                          autoconnect=True)
         print("成功連接到 WRDS 數據庫\n")
         return db
     except FileNotFoundError:
@@ -45,21 +51,6 @@ def get_wrds_connection():
         print_error(f"錯誤: 連接 WRDS 失敗", e)
         sys.exit(1)
 
-def check_access(db, library):
-    """檢查是否有訪問權限"""
-    try:
-        # 嘗試執行一個簡單的查詢來測試訪問權限
-        sql = f"""
-        SELECT 1
-        FROM information_schema.schemata
-        WHERE schema_name = '{library}'
-        AND has_schema_privilege(current_user, schema_name, 'USAGE')
-        """
-        result = db.raw_sql(sql)
-        return len(result) > 0
-    except:
-        return False
-
 def get_table_list(db, library):
     """獲取資料庫中的表格列表"""
     try:
@@ -117,17 +108,17 @@ def list_all_libraries():
         libraries_data = [["編號", "資料庫名稱", "描述", "訪問權限"]]  # CSV標題行
         accessible_count = 0
         
+        # 一次查詢取得所有資料庫的訪問權限和描述
+        schema_access = SchemaAccess(db.connection)
+        
         for i, lib in enumerate(libraries, 1):
             # 檢查訪問權限
-            has_access = check_access(db, lib)
+            has_access = schema_access.has_access(lib)
             if has_access:
                 accessible_count += 1
             
             # 獲取資料庫描述
-            try:
-                description = db.get_library_info(lib)
-            except:
-                description = ""
+            description = schema_access.description(lib)
             
             # 添加訪問狀態
             access_status = "可訪問" if has_access else "無權限"
@@ -145,11 +136,10 @@ def list_all_libraries():
         tables_data = [["資料庫名稱", "表格名稱", "大小"]]  # CSV標題行
         
         # 獲取每個可訪問資料庫的表格
-        for lib in libraries:
-            if check_access(db, lib):
-                tables = get_table_list(db, lib)
-                for table_name, size in tables:
-                    tables_data.append([lib, table_name, size])
+        for lib in schema_access.accessible(libraries):
+            tables = get_table_list(db, lib)
+            for table_name, size in tables:
+                tables_data.append([lib, table_name, size])
         
         # 保存表格列表
         tables_file = os.path.join(output_dir, f"wrds_tables_{current_time}.csv")
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime
+from output_formats import OUTPUT_FORMATS
+
+MANIFEST_FILENAME = 'download_manifest.sqlite'
+
+# 下載文件名的時間戳後綴，例如 _20240101_120000
+_TIMESTAMP_SUFFIX = re.compile(r'_\d{8}_\d{6}$')
+
+def file_checksum(path, chunk_size=1024 * 1024):
+    """計算文件的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def schema_hash(columns):
+    """由 [(欄位名稱, PostgreSQL 類型), ...] 計算表格結構的指紋"""
+    return hashlib.sha1(json.dumps(columns).encode('utf-8')).hexdigest()
+
+class DownloadManifest:
+    """已完成下載的持久索引（輸出目錄中的 SQLite），跳過判斷只需查一行記錄，不必掃描目錄或重讀文件"""
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, MANIFEST_FILENAME)
+        is_new = not os.path.exists(self.path)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS downloads (
+                    path TEXT PRIMARY KEY,
+                    library TEXT NOT NULL,
+                    table_name TEXT NOT NULL,
+                    format TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    rows INTEGER,
+                    bytes INTEGER NOT NULL,
+                    checksum TEXT,
+                    schema_hash TEXT,
+                    completed_at TEXT NOT NULL,
+                    verified INTEGER NOT NULL DEFAULT 1
+                )
+            """)
+            # 舊版索引沒有 verified 欄位；當時登記的現有文件沒有校驗和，標記為未驗證
+            columns = [row['name'] for row in self._db.execute("PRAGMA table_info(downloads)")]
+            if 'verified' not in columns:
+                self._db.execute("ALTER TABLE downloads ADD COLUMN verified INTEGER NOT NULL DEFAULT 1")
+                self._db.execute("UPDATE downloads SET verified = 0 WHERE checksum IS NULL")
+            self._db.execute("""
+                CREATE INDEX IF NOT EXISTS downloads_table
+                ON downloads (library, table_name, format, kind, completed_at)
+            """)
+        if is_new:
+            self.import_existing()
+
+    def import_existing(self):
+        """第一次建立索引時登記輸出目錄中已有的下載文件；這些文件可能是中斷的下載，登記為未驗證，
+        行數在第一次需要時檢查文件後補上"""
+        formats = {extension: name for name, (extension, _) in OUTPUT_FORMATS.items()}
+        count = 0
+        for library in sorted(os.listdir(self.output_dir)):
+            db_dir = os.path.join(self.output_dir, library)
+            if not os.path.isdir(db_dir):
+                continue
+            for root, _, files in os.walk(db_dir):
+                kind = 'delta' if root != db_dir else 'full'
+                for name in files:
+                    stem, ext = os.path.splitext(name)
+                    if ext not in formats or not _TIMESTAMP_SUFFIX.search(stem):
+                        continue
+                    path = os.path.join(root, name)
+                    completed_at = datetime.fromtimestamp(os.path.getmtime(path)).strftime("%Y-%m-%d %H:%M:%S")
+                    self.record(library, _TIMESTAMP_SUFFIX.sub('', stem), formats[ext], path,
+                                rows=None, kind=kind, checksum=None, completed_at=completed_at, verified=False)
+                    count += 1
+        if count:
+            print(f"已將 {count} 個現有下載文件登記到下載索引")
+
+    def record(self, library, table, output_format, path, rows, kind='full', checksum=None, schema_hash=None,
+               completed_at=None, verified=True):
+        """登記一個已完成的文件（同一路徑已有記錄時覆蓋）"""
+        with self._lock, self._db:
+            self._db.execute("""
+                INSERT OR REPLACE INTO downloads
+                (path, library, table_name, format, kind, rows, bytes, checksum, schema_hash, completed_at, verified)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (path, library, table, output_format, kind, rows, os.path.getsize(path), checksum, schema_hash,
+                  completed_at or datetime.now().strftime("%Y-%m-%d %H:%M:%S"), int(verified)))
+
+    def latest(self, library, table, output_format, kind='full'):
+        """返回表格最新一次完成的下載記錄（dict），沒有時返回 None"""
+        with self._lock:
+            row = self._db.execute("""
+                SELECT * FROM downloads
+                WHERE library = ? AND table_name = ? AND format = ? AND kind = ?
+                ORDER BY completed_at DESC
+                LIMIT 1
+            """, (library, table, output_format, kind)).fetchone()
+        return dict(row) if row else None
+
+    def libraries(self, output_format):
+        """返回有該格式下載記錄的資料庫名稱"""
+        with self._lock:
+            rows = self._db.execute("SELECT DISTINCT library FROM downloads WHERE format = ? ORDER BY library",
+                                    (output_format,)).fetchall()
+        return [row[0] for row in rows]
+
+    def mark_verified(self, path, rows):
+        """舊文件檢查完整後補上行數，標記為已驗證"""
+        with self._lock, self._db:
+            self._db.execute("UPDATE downloads SET rows = ?, verified = 1 WHERE path = ?", (rows, path))
+
+    def remove(self, path):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM downloads WHERE path = ?", (path,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+def get_manifest(output_dir):
+    """返回輸出目錄的下載索引（同一進程中共用一個實例）"""
+    key = os.path.abspath(output_dir)
+    with _manifests_lock:
+        if key not in _manifests:
+            os.makedirs(output_dir, exist_ok=True)
+            _manifests[key] = DownloadManifest(output_dir)
+        return _manifests[key]
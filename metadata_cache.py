@@ -0,0 +1,82 @@
+import threading
+import time
+from collections import OrderedDict
+
+class _Flight:
+    """正在載入中的緩存項目，其他請求等待同一結果"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+class MetadataCache:
+    """帶 TTL 和 LRU 容量上限的進程內元數據緩存，同一 key 同時只載入一次"""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()    # key -> (過期時間, 值)
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_load(self, key, loader, ttl):
+        """返回緩存值；過期或不存在時調用 loader 載入，並發的相同請求共用一次載入"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader()
+            with self._lock:
+                self._entries[key] = (time.monotonic() + ttl, flight.value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            return flight.value
+        except Exception as e:
+            # 載入失敗不緩存，等待中的請求得到同一個錯誤
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def invalidate(self, *prefix):
+        """刪除 key 以 prefix 開頭的緩存項目（不傳參數時清空全部），返回刪除數量"""
+        with self._lock:
+            keys = [key for key in self._entries if key[:len(prefix)] == prefix]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'keys': [
+                    {'key': list(key), 'expires_in': round(expires_at - now, 1)}
+                    for key, (expires_at, _) in self._entries.items()
+                ],
+            }
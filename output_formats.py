@@ -0,0 +1,361 @@
+import os
+import csv
+import json
+import shutil
+import pandas as pd
+from dtype_mapper import compact_numeric_kind, pandas_dtype_for_pg, TEXT
+
+# 支援的輸出格式: 格式名稱 -> (副檔名, MIME 類型)
+OUTPUT_FORMATS = {
+    'csv': ('.csv', 'text/csv'),
+    'parquet': ('.parquet', 'application/vnd.apache.parquet'),
+    'feather': ('.feather', 'application/vnd.apache.arrow.file'),
+}
+
+# 列式格式預設使用的壓縮算法
+DEFAULT_COMPRESSION = 'zstd'
+
+def file_extension(output_format):
+    """返回輸出格式對應的副檔名"""
+    return OUTPUT_FORMATS[output_format][0]
+
+def format_mimetype(path):
+    """根據副檔名返回文件的 MIME 類型"""
+    ext = os.path.splitext(path)[1]
+    for extension, mimetype in OUTPUT_FORMATS.values():
+        if ext == extension:
+            return mimetype
+    return 'application/octet-stream'
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.ipc
+        return pyarrow
+    except ImportError:
+        raise ImportError("Parquet/Feather 輸出需要安裝 pyarrow（pip install pyarrow）")
+
+def arrow_type_for_pg(pg_type):
+    """把 PostgreSQL 欄位類型（format_type 的輸出）對應到 Arrow 類型"""
+    pa = _import_pyarrow()
+    pg_type = pg_type.lower()
+    if pg_type.endswith('[]'):
+        return pa.list_(arrow_type_for_pg(pg_type[:-2]))
+    if pg_type == 'smallint':
+        return pa.int16()
+    if pg_type == 'integer':
+        return pa.int32()
+    if pg_type == 'bigint':
+        return pa.int64()
+    if pg_type == 'real':
+        return pa.float32()
+    # 精度較小的 numeric 與 DtypeMapper 一致地使用整數或 float32，其餘經 pandas coerce_float 後為浮點數
+    numeric_kind = compact_numeric_kind(pg_type)
+    if numeric_kind is not None:
+        return getattr(pa, numeric_kind)()
+    if pg_type in ('double precision', 'money') or pg_type.startswith('numeric'):
+        return pa.float64()
+    if pg_type == 'boolean':
+        return pa.bool_()
+    if pg_type == 'date':
+        return pa.date32()
+    if pg_type.startswith('timestamp') and 'with time zone' in pg_type:
+        return pa.timestamp('us', tz='UTC')
+    if pg_type.startswith('timestamp'):
+        return pa.timestamp('us')
+    # time with time zone 的時區偏移在 time64 中會丟失，與 json、uuid 等一起寫成字串
+    if pg_type.startswith('time') and 'with time zone' not in pg_type:
+        return pa.time64('us')
+    if pg_type.startswith('interval'):
+        return pa.duration('us')
+    if pg_type == 'bytea':
+        return pa.binary()
+    return pa.string()
+
+def _dump_json(value):
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+def _to_text(value):
+    return value if isinstance(value, str) else str(value)
+
+def _to_bytes(value):
+    return bytes(value) if isinstance(value, memoryview) else value
+
+def _time_to_text(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else _to_text(value)
+
+def value_converter(pg_type):
+    """Arrow 無法直接轉換的欄位值（json 的 dict/list、uuid、bytea 的 memoryview 等）在寫入前的轉換函數，
+    不需要轉換時返回 None"""
+    pg_type = pg_type.lower()
+    if pg_type.endswith('[]'):
+        return None
+    if pg_type in ('json', 'jsonb'):
+        return _dump_json
+    if pg_type == 'bytea':
+        return _to_bytes
+    if pg_type.startswith('time') and 'with time zone' in pg_type and not pg_type.startswith('timestamp'):
+        return _time_to_text
+    if arrow_type_for_pg(pg_type) == _import_pyarrow().string() and pandas_dtype_for_pg(pg_type) != TEXT:
+        return _to_text
+    return None
+
+def arrow_schema_from_columns(columns):
+    """由 [(欄位名稱, PostgreSQL 類型), ...] 建立固定的 Arrow schema；
+    欄位的 PostgreSQL 類型記錄在欄位元數據 pg_type 中，寫入器據此轉換欄位值"""
+    pa = _import_pyarrow()
+    return pa.schema([
+        pa.field(name, arrow_type_for_pg(pg_type), metadata={'pg_type': pg_type})
+        for name, pg_type in columns
+    ])
+
+class CsvBatchWriter:
+    """逐批寫入 CSV：只寫一次標題行，每批寫完即可釋放"""
+
+    # 可以接續寫入已有的文件（續傳）
+    resumable = True
+
+    def __init__(self, path, schema=None, resume_rows=None):
+        self.path = path
+        if resume_rows is None:
+            self.rows_written = 0
+            self._file = open(path, 'w', newline='', encoding='utf-8')
+            self._header_written = False
+        else:
+            # 接續寫入時標題行已經存在
+            self.rows_written = resume_rows
+            self._file = open(path, 'a', newline='', encoding='utf-8')
+            self._header_written = True
+
+    def write_batch(self, df):
+        df.to_csv(self._file, header=not self._header_written, index=False)
+        self._header_written = True
+        self.rows_written += len(df)
+
+    def size(self):
+        """目前已寫出的文件大小（位元組，包含尚在緩衝區中的部分）"""
+        return self._file.tell()
+
+    def flush(self):
+        """把已寫入的批次寫到磁碟，返回目前的文件大小（位元組）"""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return os.fstat(self._file.fileno()).st_size
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class _ArrowBatchWriter:
+    """列式格式寫入器的共用部分：schema 在第一批之前固定，之後每批都轉換成同一 schema"""
+
+    # 未寫完的列式文件沒有 footer，無法接續寫入
+    resumable = False
+
+    def __init__(self, path, schema=None, compression=DEFAULT_COMPRESSION, resume_rows=None):
+        if resume_rows is not None:
+            raise ValueError("列式格式不支援接續寫入")
+        self.pa = _import_pyarrow()
+        self.path = path
+        self.schema = schema
+        self.compression = compression
+        self.rows_written = 0
+        self._writer = None
+        self._closed = False
+        self._converters = {}
+        for field in schema or []:
+            pg_type = (field.metadata or {}).get(b'pg_type')
+            converter = value_converter(pg_type.decode()) if pg_type else None
+            if converter is not None:
+                self._converters[field.name] = converter
+
+    def _open(self):
+        raise NotImplementedError
+
+    def _to_table(self, df):
+        if self.schema is None:
+            # 沒有表格欄位類型時，由第一批推斷並固定下來（category 欄位使用其值的類型，各批的字典可以不同）
+            schema = self.pa.Table.from_pandas(df, preserve_index=False).schema
+            self.schema = self.pa.schema([
+                field.with_type(field.type.value_type) if self.pa.types.is_dictionary(field.type) else field
+                for field in schema
+            ])
+        converted = {name: df[name].map(converter, na_action='ignore')
+                     for name, converter in self._converters.items() if name in df.columns}
+        if converted:
+            df = df.assign(**converted)
+        return self.pa.Table.from_pandas(df, schema=self.schema, preserve_index=False, safe=False)
+
+    def write_batch(self, df):
+        table = self._to_table(df)
+        if self._writer is None:
+            self._writer = self._open()
+        self._writer.write_table(table)
+        self.rows_written += len(df)
+
+    def size(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def flush(self):
+        return self.size()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._writer is None and self.schema is not None:
+            # 空表也輸出一個只有 schema 的文件
+            self._writer = self._open()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class ParquetBatchWriter(_ArrowBatchWriter):
+    """逐批寫入 Parquet，每一批成為一個壓縮的 row group"""
+
+    def _open(self):
+        return self.pa.parquet.ParquetWriter(self.path, self.schema, compression=self.compression)
+
+class FeatherBatchWriter(_ArrowBatchWriter):
+    """逐批寫入 Arrow IPC 文件（Feather v2）"""
+
+    def _open(self):
+        options = self.pa.ipc.IpcWriteOptions(compression=self.compression)
+        return self.pa.ipc.new_file(self.path, self.schema, options=options)
+
+_WRITERS = {
+    'csv': CsvBatchWriter,
+    'parquet': ParquetBatchWriter,
+    'feather': FeatherBatchWriter,
+}
+
+def open_writer(output_format, path, schema=None, resume_rows=None):
+    """依輸出格式建立逐批寫入器；resume_rows 不為 None 時接續寫入已有 resume_rows 行的文件"""
+    if output_format not in _WRITERS:
+        raise ValueError(f"不支援的輸出格式: {output_format}")
+    return _WRITERS[output_format](path, schema=schema, resume_rows=resume_rows)
+
+def supports_resume(output_format):
+    """輸出格式是否可以從中斷處接續寫入"""
+    return _WRITERS[output_format].resumable
+
+def merge_files(output_format, paths, path):
+    """按順序把多個同格式、同結構的文件合併成一個（CSV 只保留第一個文件的標題行）"""
+    if output_format == 'csv':
+        with open(path, 'wb') as out:
+            for i, part in enumerate(paths):
+                with open(part, 'rb') as f:
+                    if i > 0:
+                        f.readline()
+                    shutil.copyfileobj(f, out, 1024 * 1024)
+        return
+
+    pa = _import_pyarrow()
+    writer = None
+    try:
+        for part in paths:
+            if output_format == 'parquet':
+                source = pa.parquet.ParquetFile(part)
+                if writer is None:
+                    writer = pa.parquet.ParquetWriter(path, source.schema_arrow, compression=DEFAULT_COMPRESSION)
+                # 逐個 row group 複製，記憶體中只保留一個 row group
+                for i in range(source.num_row_groups):
+                    writer.write_table(source.read_row_group(i))
+            else:
+                with pa.memory_map(part) as f:
+                    source = pa.ipc.open_file(f)
+                    if writer is None:
+                        options = pa.ipc.IpcWriteOptions(compression=DEFAULT_COMPRESSION)
+                        writer = pa.ipc.new_file(path, source.schema, options=options)
+                    for i in range(source.num_record_batches):
+                        writer.write_batch(source.get_batch(i))
+    finally:
+        if writer is not None:
+            writer.close()
+
+def _count_csv_rows(path):
+    """逐塊讀取一遍 CSV 計算數據行數（引號內的換行不算新行），不保留任何數據"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            return 0
+        # 每一行（包括最後一行）都以換行結束，否則是寫到一半被中斷的文件
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b'\n':
+            raise ValueError(f"{path} 最後一行不完整")
+    with open(path, newline='', encoding='utf-8') as f:
+        lines = sum(1 for _ in csv.reader(f))
+    return max(lines - 1, 0)
+
+def _max_csv_value(path, column, pg_type):
+    """逐塊讀取 CSV 的一個欄位，按 PostgreSQL 類型解析後返回最大值"""
+    pg_type = pg_type.lower()
+    is_time = pg_type == 'date' or pg_type.startswith('timestamp')
+    result = None
+    for chunk in pd.read_csv(path, usecols=[column], dtype=str, chunksize=1000000, encoding='utf-8'):
+        values = chunk[column].dropna()
+        if values.empty:
+            continue
+        if is_time:
+            values = pd.to_datetime(values, utc='with time zone' in pg_type)
+        else:
+            values = pd.to_numeric(values)
+        chunk_max = values.max()
+        result = chunk_max if result is None else max(result, chunk_max)
+    if result is None:
+        return None
+    if pg_type == 'date':
+        return result.date()
+    if is_time:
+        return result.to_pydatetime()
+    return result.item()
+
+def column_max(path, column, pg_type):
+    """讀取已輸出文件中一個欄位的最大值（只讀取該欄位），沒有非空值時返回 None"""
+    ext = os.path.splitext(path)[1]
+    if ext == file_extension('csv'):
+        return _max_csv_value(path, column, pg_type)
+    pa = _import_pyarrow()
+    import pyarrow.compute
+    import pyarrow.feather
+    if ext == file_extension('parquet'):
+        table = pa.parquet.read_table(path, columns=[column])
+    else:
+        table = pa.feather.read_table(path, columns=[column])
+    values = table.column(0)
+    if pa.types.is_dictionary(values.type):
+        values = values.cast(values.type.value_type)
+    result = pa.compute.max(values).as_py()
+    # 緊湊 dtype 把日期保存為 datetime64，水位線仍按日期記錄
+    if result is not None and pg_type.lower() == 'date' and hasattr(result, 'date'):
+        return result.date()
+    return result
+
+def count_rows(path):
+    """讀取已輸出文件的行數（列式格式只讀取元數據，CSV 逐塊讀取）；文件不完整時拋出異常"""
+    ext = os.path.splitext(path)[1]
+    if ext == file_extension('parquet'):
+        pa = _import_pyarrow()
+        return pa.parquet.ParquetFile(path).metadata.num_rows
+    if ext == file_extension('feather'):
+        pa = _import_pyarrow()
+        with pa.memory_map(path) as source:
+            reader = pa.ipc.open_file(source)
+            # 較舊的 pyarrow 沒有 count_rows，改為逐批讀取
+            if hasattr(reader, 'count_rows'):
+                return reader.count_rows()
+            return sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+    return _count_csv_rows(path)
@@ -0,0 +1,149 @@
+import queue
+import threading
+import time
+
+# 階段之間的隊列最多容納的批次數；隊列滿時上游階段等待，記憶體中最多只有幾個批次
+DEFAULT_MAX_PENDING = 2
+
+STAGE_NAMES = {'fetch': '抓取', 'transform': '轉換', 'write': '寫入'}
+
+_DONE = object()
+
+class PipelineStats:
+    """各階段的工作時間（busy）和等待時間（wait，包括等待上游的數據和等待下游騰出隊列空間）"""
+
+    def __init__(self, stages):
+        self.stages = {name: {'busy': 0.0, 'wait': 0.0, 'batches': 0} for name in stages}
+        self.elapsed = 0.0
+
+    def _add(self, stage, field, seconds):
+        self.stages[stage][field] += seconds
+
+    def bottleneck(self):
+        """工作時間最長的階段"""
+        return max(self.stages, key=lambda name: self.stages[name]['busy'])
+
+    def to_dict(self):
+        return {
+            'elapsed': round(self.elapsed, 3),
+            'bottleneck': self.bottleneck(),
+            'stages': {name: {key: round(value, 3) if isinstance(value, float) else value
+                              for key, value in stage.items()}
+                       for name, stage in self.stages.items()},
+        }
+
+    def summary(self):
+        parts = [f"{STAGE_NAMES.get(name, name)} {stage['busy']:.1f} 秒（等待 {stage['wait']:.1f} 秒）"
+                 for name, stage in self.stages.items()]
+        bottleneck = self.bottleneck()
+        return f"{'、'.join(parts)}；總計 {self.elapsed:.1f} 秒，瓶頸: {STAGE_NAMES.get(bottleneck, bottleneck)}"
+
+def run_pipeline(source, sink, transform=None, max_pending=DEFAULT_MAX_PENDING):
+    """讓抓取、轉換和寫入重疊進行：source 在抓取線程中迭代，transform（可選）在轉換線程中執行，
+    sink 在調用線程中逐批寫入；任何階段出錯時停止所有階段並在調用線程拋出該錯誤。返回 PipelineStats"""
+    stages = ['fetch'] + (['transform'] if transform else []) + ['write']
+    stats = PipelineStats(stages)
+    stop = threading.Event()
+    errors = []
+    queues = [queue.Queue(maxsize=max(1, max_pending)) for _ in stages[1:]]
+
+    def put(q, item, stage):
+        start = time.perf_counter()
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        stats._add(stage, 'wait', time.perf_counter() - start)
+
+    def get(q, stage, upstream):
+        # 上游線程已結束且隊列為空時（例如出錯時沒能放入結束標記）視為結束
+        start = time.perf_counter()
+        while True:
+            try:
+                item = q.get(timeout=0.1)
+                break
+            except queue.Empty:
+                if not upstream.is_alive() and q.empty():
+                    item = _DONE
+                    break
+        stats._add(stage, 'wait', time.perf_counter() - start)
+        return item
+
+    def fetch():
+        iterator = iter(source)
+        try:
+            while not stop.is_set():
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                stats._add('fetch', 'busy', time.perf_counter() - start)
+                stats.stages['fetch']['batches'] += 1
+                put(queues[0], item, 'fetch')
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            # 提前停止時關閉生成器，釋放其中的游標和連接
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+            put(queues[0], _DONE, 'fetch')
+
+    def convert():
+        try:
+            while True:
+                item = get(queues[0], 'transform', threads[0])
+                if item is _DONE:
+                    break
+                if stop.is_set():
+                    continue
+                start = time.perf_counter()
+                item = transform(item)
+                stats._add('transform', 'busy', time.perf_counter() - start)
+                stats.stages['transform']['batches'] += 1
+                put(queues[1], item, 'transform')
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            put(queues[1], _DONE, 'transform')
+
+    threads = [threading.Thread(target=fetch, name='pipeline-fetch', daemon=True)]
+    if transform:
+        threads.append(threading.Thread(target=convert, name='pipeline-transform', daemon=True))
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = get(queues[-1], 'write', threads[-1])
+            if item is _DONE:
+                break
+            start = time.perf_counter()
+            sink(item)
+            stats._add('write', 'busy', time.perf_counter() - start)
+            stats.stages['write']['batches'] += 1
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        stop.set()
+        # 清空隊列，讓等待放入數據的上游線程結束
+        for thread in threads:
+            while thread.is_alive():
+                for q in queues:
+                    try:
+                        while True:
+                            q.get_nowait()
+                    except queue.Empty:
+                        pass
+                thread.join(timeout=0.1)
+        stats.elapsed = time.perf_counter() - started
+
+    if errors:
+        raise errors[0]
+    return stats
@@ -0,0 +1,545 @@
+import argparse
+import functools
+import hashlib
+import itertools
+import json
+import os
+import pickle
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+import wrds
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import registry
+from sqlalchemy.dialects.postgresql.psycopg2 import PGDialect_psycopg2
+from sqlalchemy.engine import URL
+
+# 查詢錄製文件（cassette）：設置 WRDS_CASSETTE 為目錄後，所有經由 db_pool、connect_wrds 建立的連接
+# 在 record 模式下照常查詢並把查詢、參數、結果批次和耗時寫入該目錄，在 replay 模式下不連接 WRDS，直接返回錄製的結果
+CASSETTE_MODES = ('record', 'replay')
+# 重播速度: recorded 按錄製時的耗時等待，max 不等待
+REPLAY_SPEEDS = ('recorded', 'max')
+
+CASSETTE_VERSION = 1
+INDEX_FILENAME = 'queries.jsonl'
+META_FILENAME = 'cassette.json'
+DATA_DIRNAME = 'data'
+
+# COPY 輸出按行寫出，錄製時合併成約此大小的區塊
+COPY_CHUNK_SIZE = 1024 * 1024
+# 重播時累積到此秒數才實際等待，避免大量很短的 sleep 拖慢重播
+MIN_PAUSE_SECONDS = 0.005
+
+class QueryNotRecorded(psycopg2.DatabaseError):
+    """重播時遇到錄製文件中沒有的查詢"""
+
+def normalize_query(query):
+    """查詢文字的比對形式：合併空白字元"""
+    if isinstance(query, bytes):
+        query = query.decode('utf-8')
+    return ' '.join(str(query).split())
+
+def query_key(query, params=None):
+    """由查詢文字和參數計算比對用的鍵"""
+    params_json = json.dumps(params, sort_keys=True, default=repr) if params is not None else ''
+    return hashlib.sha1(f"{normalize_query(query)}\0{params_json}".encode('utf-8')).hexdigest()
+
+def _dump_chunk(f, seconds, data):
+    try:
+        pickle.dump((seconds, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+    except TypeError:
+        # bytea 欄位以 memoryview 返回，無法序列化
+        data = [tuple(bytes(v) if isinstance(v, memoryview) else v for v in row) for row in data]
+        pickle.dump((seconds, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def _read_chunks(path):
+    """依序讀出錄製的 (耗時, 數據) 區塊"""
+    if path is None:
+        return
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+def _error_info(error):
+    return {'type': type(error).__name__, 'pgcode': getattr(error, 'pgcode', None), 'message': str(error)}
+
+def _replay_error(info):
+    """重建錄製時的資料庫錯誤，讓 SQLAlchemy 包裝成相同類型的異常"""
+    error_class = None
+    if info.get('pgcode'):
+        try:
+            error_class = psycopg2.errors.lookup(info['pgcode'])
+        except KeyError:
+            pass
+    if error_class is None:
+        error_class = getattr(psycopg2, info['type'], psycopg2.DatabaseError)
+    return error_class(info['message'])
+
+class QueryCassette:
+    """查詢錄製文件：index（queries.jsonl）每行記錄一次查詢的文字、參數、欄位描述、行數、耗時或錯誤，
+    結果的各個批次連同取回耗時保存在 data/ 下。pickle 格式只應重播自己錄製的文件"""
+
+    def __init__(self, path, mode='replay', speed='recorded'):
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"不支援的錄製模式: {mode}（可選: {', '.join(CASSETTE_MODES)}）")
+        if speed not in REPLAY_SPEEDS:
+            raise ValueError(f"不支援的重播速度: {speed}（可選: {', '.join(REPLAY_SPEEDS)}）")
+        self.path = path
+        self.mode = mode
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._started = time.perf_counter()
+        if mode == 'record':
+            os.makedirs(os.path.join(path, DATA_DIRNAME), exist_ok=True)
+            # 同一目錄可以多次錄製，新的查詢追加在後面
+            self._ids = itertools.count(self._count_entries() + 1)
+            meta_path = os.path.join(path, META_FILENAME)
+            if not os.path.exists(meta_path):
+                with open(meta_path, 'w', encoding='utf-8') as f:
+                    json.dump({'version': CASSETTE_VERSION, 'created_at': datetime.now().isoformat(timespec='seconds')},
+                              f, indent=2)
+            self._index = open(os.path.join(path, INDEX_FILENAME), 'a', encoding='utf-8')
+        else:
+            if not os.path.exists(os.path.join(path, INDEX_FILENAME)):
+                raise FileNotFoundError(f"找不到查詢錄製文件: {os.path.join(path, INDEX_FILENAME)}")
+            self._entries = defaultdict(list)
+            for entry in self.entries():
+                self._entries[entry['key']].append(entry)
+            self._positions = defaultdict(int)
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    def entries(self):
+        with open(os.path.join(self.path, INDEX_FILENAME), encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def _count_entries(self):
+        if not os.path.exists(os.path.join(self.path, INDEX_FILENAME)):
+            return 0
+        return sum(1 for _ in self.entries())
+
+    # 錄製
+
+    def new_entry_id(self):
+        with self._lock:
+            return next(self._ids)
+
+    def data_path(self, entry_id):
+        return os.path.join(self.path, DATA_DIRNAME, f'{entry_id:06d}.pkl')
+
+    def record(self, entry_id, kind, query, params, seconds, started, description=None, rowcount=-1,
+               error=None, has_data=False):
+        entry = {
+            'id': entry_id,
+            'kind': kind,
+            'key': query_key(query, params),
+            'query': normalize_query(query),
+            'params': json.loads(json.dumps(params, default=repr)) if params is not None else None,
+            'started': round(started - self._started, 6),
+            'seconds': round(seconds, 6),
+            'rowcount': rowcount,
+            'description': [list(column)[:7] for column in description] if description else None,
+            'error': _error_info(error) if error is not None else None,
+            'data': os.path.relpath(self.data_path(entry_id), self.path) if has_data else None,
+        }
+        with self._lock:
+            self._index.write(json.dumps(entry, ensure_ascii=False, default=repr) + '\n')
+            self._index.flush()
+
+    # 重播
+
+    def take(self, query, params=None):
+        """返回下一個相同查詢的錄製結果；相同查詢的次數多於錄製時重複使用最後一個"""
+        key = query_key(query, params)
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                raise QueryNotRecorded(f"錄製文件中沒有此查詢: {normalize_query(query)[:300]} 參數: {params!r}")
+            position = self._positions[key]
+            self._positions[key] = position + 1
+        return entries[min(position, len(entries) - 1)]
+
+    def read_chunks(self, entry):
+        return _read_chunks(os.path.join(self.path, entry['data']) if entry['data'] else None)
+
+    def pause(self, seconds):
+        """按錄製時的耗時等待；多睡的時間從之後的等待中扣除"""
+        if self.speed != 'recorded' or seconds <= 0:
+            return
+        debt = getattr(self._local, 'debt', 0.0) + seconds
+        if debt >= MIN_PAUSE_SECONDS:
+            started = time.perf_counter()
+            time.sleep(debt)
+            debt -= time.perf_counter() - started
+        self._local.debt = debt
+
+    # 建立連接
+
+    def create_engine(self, url, **kwargs):
+        """建立 SQLAlchemy 引擎：record 模式連接真實的資料庫並錄製，replay 模式使用錄製的結果"""
+        if self.replaying:
+            kwargs.pop('connect_args', None)
+            return create_engine(URL.create('postgresql+wrds_cassette'), creator=lambda: ReplayConnection(self),
+                                 use_native_hstore=False, **kwargs)
+        connect_args = dict(kwargs.pop('connect_args', None) or {},
+                            connection_factory=functools.partial(RecordingConnection, cassette=self))
+        return create_engine(url, connect_args=connect_args, **kwargs)
+
+    def open_wrds_connection(self, **kwargs):
+        return CassetteWrdsConnection(self, **kwargs)
+
+    def close(self):
+        if self.mode == 'record':
+            with self._lock:
+                self._index.close()
+
+class _RecordingFile:
+    """包裝 COPY 的輸出文件，把寫出的數據合併成區塊，連同產生該區塊的耗時錄製下來"""
+
+    def __init__(self, fileobj, data_file):
+        self._fileobj = fileobj
+        self._data_file = data_file
+        self._buffer = bytearray()
+        self._last = time.perf_counter()
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= COPY_CHUNK_SIZE:
+            self.flush_chunk()
+        return self._fileobj.write(data)
+
+    def flush_chunk(self):
+        if not self._buffer:
+            return
+        now = time.perf_counter()
+        _dump_chunk(self._data_file, now - self._last, bytes(self._buffer))
+        self._buffer = bytearray()
+        self._last = now
+
+class RecordingCursor(psycopg2.extensions.cursor):
+    """照常執行查詢，並把查詢、結果批次和耗時寫入錄製文件"""
+
+    _entry = None
+    _data_file = None
+
+    def _finish_entry(self):
+        """寫入查詢的索引記錄"""
+        if self._entry is None:
+            return
+        entry, self._entry = self._entry, None
+        self.connection.cassette.record(entry['id'], 'execute', entry['query'], entry['params'], entry['seconds'],
+                                        entry['started'], description=self.description, rowcount=self.rowcount,
+                                        has_data=self._data_file is not None)
+
+    def _close_data_file(self):
+        self._finish_entry()
+        if self._data_file is not None:
+            self._data_file.close()
+            self._data_file = None
+
+    def execute(self, query, vars=None):
+        cassette = self.connection.cassette
+        self._close_data_file()
+        entry_id = cassette.new_entry_id()
+        started = time.perf_counter()
+        try:
+            result = super().execute(query, vars)
+        except psycopg2.Error as e:
+            cassette.record(entry_id, 'execute', query, vars, time.perf_counter() - started, started, error=e)
+            raise
+        self._entry = {'id': entry_id, 'query': query, 'params': vars, 'started': started,
+                       'seconds': time.perf_counter() - started}
+        if self.description is not None or self.name is not None:
+            self._data_file = open(cassette.data_path(entry_id), 'wb')
+        # 伺服器端游標在第一次取回數據後才有欄位描述，索引記錄延到那時寫入
+        if self.name is None:
+            self._finish_entry()
+        return result
+
+    def _record_rows(self, started, rows):
+        if self._data_file is not None:
+            _dump_chunk(self._data_file, time.perf_counter() - started, rows)
+            self._data_file.flush()
+        self._finish_entry()
+        return rows
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._record_rows(started, [row] if row is not None else [])
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        return self._record_rows(started, super().fetchmany(self.arraysize if size is None else size))
+
+    def fetchall(self):
+        started = time.perf_counter()
+        return self._record_rows(started, super().fetchall())
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            yield from rows
+
+    def copy_expert(self, sql, file, size=8192):
+        cassette = self.connection.cassette
+        self._close_data_file()
+        entry_id = cassette.new_entry_id()
+        started = time.perf_counter()
+        with open(cassette.data_path(entry_id), 'wb') as data_file:
+            recorder = _RecordingFile(file, data_file)
+            try:
+                super().copy_expert(sql, recorder, size)
+            except psycopg2.Error as e:
+                recorder.flush_chunk()
+                cassette.record(entry_id, 'copy', sql, None, time.perf_counter() - started, started, error=e,
+                                has_data=True)
+                raise
+            recorder.flush_chunk()
+        cassette.record(entry_id, 'copy', sql, None, time.perf_counter() - started, started,
+                        rowcount=self.rowcount, has_data=True)
+
+    def close(self):
+        self._close_data_file()
+        super().close()
+
+class RecordingConnection(psycopg2.extensions.connection):
+    """psycopg2 連接，所有游標都是 RecordingCursor"""
+
+    def __init__(self, dsn, *args, cassette=None, **kwargs):
+        super().__init__(dsn, *args, **kwargs)
+        self.cassette = cassette
+        self.cursor_factory = RecordingCursor
+
+def _quote(value):
+    adapted = psycopg2.extensions.adapt(value)
+    if hasattr(adapted, 'encoding'):
+        adapted.encoding = 'utf8'
+    return adapted.getquoted().decode('utf-8')
+
+class ReplayCursor:
+    """按查詢文字和參數返回錄製的結果，提供 SQLAlchemy、pandas 和 COPY 匯出用到的 DB-API 游標介面"""
+
+    def __init__(self, connection, name=None):
+        self.connection = connection
+        self.name = name
+        self.description = None
+        self.rowcount = -1
+        self.arraysize = 1
+        self.itersize = 2000
+        self.closed = False
+        self._rows = []
+        self._position = 0
+        self._chunks = None
+
+    def execute(self, query, vars=None):
+        cassette = self.connection.cassette
+        entry = cassette.take(query, vars)
+        cassette.pause(entry['seconds'])
+        if entry['error']:
+            raise _replay_error(entry['error'])
+        self.description = [tuple(column) for column in entry['description']] if entry['description'] else None
+        self.rowcount = entry['rowcount']
+        self._rows = []
+        self._position = 0
+        self._chunks = cassette.read_chunks(entry)
+
+    def executemany(self, query, vars_list):
+        for vars in vars_list:
+            self.execute(query, vars)
+
+    def mogrify(self, query, vars=None):
+        if vars is None:
+            return query.encode('utf-8')
+        if isinstance(vars, dict):
+            return (query % {name: _quote(value) for name, value in vars.items()}).encode('utf-8')
+        return (query % tuple(_quote(value) for value in vars)).encode('utf-8')
+
+    def _fill(self, size):
+        """讀入錄製的批次，直到緩衝區至少有 size 行（None 為全部），按錄製時的取回耗時等待"""
+        while self._chunks is not None and (size is None or len(self._rows) - self._position < size):
+            try:
+                seconds, rows = next(self._chunks)
+            except StopIteration:
+                self._chunks = None
+                break
+            self.connection.cassette.pause(seconds)
+            self._rows = self._rows[self._position:] + list(rows)
+            self._position = 0
+
+    def fetchone(self):
+        self._fill(1)
+        if self._position >= len(self._rows):
+            return None
+        row = self._rows[self._position]
+        self._position += 1
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        self._fill(size)
+        rows = self._rows[self._position:self._position + size]
+        self._position += len(rows)
+        return rows
+
+    def fetchall(self):
+        self._fill(None)
+        rows = self._rows[self._position:]
+        self._rows, self._position = [], 0
+        return rows
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            yield from rows
+
+    def copy_expert(self, sql, file, size=8192):
+        cassette = self.connection.cassette
+        entry = cassette.take(sql)
+        for seconds, data in cassette.read_chunks(entry):
+            cassette.pause(seconds)
+            file.write(data)
+        if entry['error']:
+            raise _replay_error(entry['error'])
+        self.rowcount = entry['rowcount']
+
+    def setinputsizes(self, sizes):
+        pass
+
+    def setoutputsize(self, size, column=None):
+        pass
+
+    def close(self):
+        self.closed = True
+        self._chunks = None
+
+class ReplayConnection:
+    """不連接資料庫的 DB-API 連接，所有查詢由錄製文件回答"""
+
+    def __init__(self, cassette):
+        self.cassette = cassette
+        self.autocommit = False
+        self.readonly = None
+        self.deferrable = None
+        self.closed = 0
+        self.status = psycopg2.extensions.STATUS_READY
+        self.encoding = 'UTF8'
+        self.notices = []
+
+    def cursor(self, name=None, *args, **kwargs):
+        return ReplayCursor(self, name)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+    def set_isolation_level(self, level):
+        pass
+
+    def set_session(self, *args, **kwargs):
+        pass
+
+    def set_client_encoding(self, encoding):
+        self.encoding = encoding
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+class ReplayDialect(PGDialect_psycopg2):
+    """重播用的方言：不對連接執行 psycopg2 的類型註冊，也不需要連線檢查"""
+
+    supports_statement_cache = True
+
+    def on_connect(self):
+        return None
+
+    def do_ping(self, dbapi_connection):
+        return True
+
+registry.register('postgresql.wrds_cassette', __name__, 'ReplayDialect')
+
+class CassetteWrdsConnection(wrds.Connection):
+    """經由查詢錄製文件連接的 wrds.Connection；重播時不需要帳號和網路"""
+
+    def __init__(self, cassette, **kwargs):
+        self._cassette = cassette
+        super().__init__(**kwargs)
+
+    def connect(self):
+        url = URL.create('postgresql', username=self._username or None, password=self._password or None,
+                         host=self._hostname, port=self._port, database=self._dbname)
+        self.engine = self._cassette.create_engine(url, isolation_level="AUTOCOMMIT",
+                                                   connect_args=self._connect_args)
+        self.connection = self.engine.connect()
+
+_cassette = None
+_cassette_lock = threading.Lock()
+
+def get_cassette():
+    """返回環境變量 WRDS_CASSETTE（目錄）、WRDS_CASSETTE_MODE、WRDS_CASSETTE_SPEED 設定的錄製文件，未設置時返回 None"""
+    global _cassette
+    path = os.getenv('WRDS_CASSETTE')
+    if not path:
+        return None
+    if _cassette is None:
+        with _cassette_lock:
+            if _cassette is None:
+                _cassette = QueryCassette(path, os.getenv('WRDS_CASSETTE_MODE', 'replay'),
+                                          os.getenv('WRDS_CASSETTE_SPEED', 'recorded'))
+    return _cassette
+
+def replaying():
+    """是否正在重播錄製的查詢（此時不需要 WRDS 帳號）"""
+    cassette = get_cassette()
+    return cassette is not None and cassette.replaying
+
+def connect_wrds(**kwargs):
+    """建立 wrds.Connection；設置了 WRDS_CASSETTE 時錄製或重播該連接上的查詢"""
+    cassette = get_cassette()
+    if cassette is None:
+        return wrds.Connection(**kwargs)
+    return cassette.open_wrds_connection(**kwargs)
+
+def print_summary(path, top=20):
+    """列出錄製文件中耗時最長的查詢"""
+    cassette = QueryCassette(path, 'replay', 'max')
+    entries = list(cassette.entries())
+    print(f"錄製文件: {path}，共 {len(entries):,} 次查詢，"
+          f"查詢耗時合計 {sum(entry['seconds'] for entry in entries):.1f} 秒")
+    totals = {}
+    for entry in entries:
+        fetch_seconds = sum(seconds for seconds, _ in cassette.read_chunks(entry))
+        total = totals.setdefault(entry['key'], {'query': entry['query'], 'count': 0, 'seconds': 0.0})
+        total['count'] += 1
+        total['seconds'] += entry['seconds'] + fetch_seconds
+    for total in sorted(totals.values(), key=lambda total: total['seconds'], reverse=True)[:top]:
+        print(f"{total['seconds']:>10.3f} 秒 {total['count']:>6} 次  {total['query'][:120]}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="查看查詢錄製文件（WRDS_CASSETTE）的內容")
+    parser.add_argument("path", help="錄製文件目錄")
+    parser.add_argument("--top", type=int, default=20, help="列出耗時最長的查詢數量 (預設: 20)")
+    args = parser.parse_args()
+    print_summary(args.path, args.top)
@@ -0,0 +1,161 @@
+import threading
+import time
+import psycopg2
+from sqlalchemy import exc
+
+class TokenBucket:
+    """令牌桶：每秒補充 rate 個令牌，最多累積 capacity 個；rate 為 0 時不限速"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, amount=1):
+        """取走 amount 個令牌，不足時等待；返回等待的秒數"""
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # 允許令牌變成負數（預支），超過容量的大請求也只需等待一次
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+class _ThrottledWriter:
+    """寫入時按位元組數取令牌的文件包裝，用於限制 COPY 的輸出速度"""
+
+    def __init__(self, fileobj, limiter):
+        self._fileobj = fileobj
+        self._limiter = limiter
+
+    def write(self, data):
+        self._limiter.consume_bytes(len(data))
+        return self._fileobj.write(data)
+
+class _WriterMeter:
+    """按逐批寫入器輸出文件的增長量取令牌，用於經過 pandas 的下載（與 COPY 一樣按寫出的位元組計算）"""
+
+    def __init__(self, writer, limiter):
+        self._writer = writer
+        self._limiter = limiter
+        self._size = writer.size()
+
+    def charge(self):
+        """每寫入一批之後調用"""
+        size = self._writer.size()
+        if size > self._size:
+            self._limiter.consume_bytes(size - self._size)
+        self._size = size
+
+class RateLimiter:
+    """所有下載線程共用的限速器：每分鐘查詢數和每秒位元組數兩個令牌桶，連接或負載錯誤時自適應退避"""
+
+    # 連接中斷、無法連接、查詢超時等錯誤（psycopg2 的 QueryCanceled 也是 OperationalError）
+    LOAD_ERROR_TYPES = (psycopg2.OperationalError, exc.OperationalError, exc.TimeoutError, exc.DisconnectionError)
+
+    # 表示伺服器負載過高或連接被中斷的錯誤信息
+    LOAD_ERRORS = (
+        'too many connections',
+        'too many clients',
+        'statement timeout',
+        'canceling statement',
+        'server closed the connection',
+        'connection reset',
+        'timeout expired',
+        'could not connect',
+    )
+
+    def __init__(self, queries_per_minute=60, bytes_per_second=0, min_backoff=5.0, max_backoff=300.0):
+        self.queries = TokenBucket(queries_per_minute / 60.0, capacity=max(queries_per_minute / 60.0, 1))
+        self.bytes = TokenBucket(bytes_per_second)
+        self.queries_per_minute = queries_per_minute
+        self.bytes_per_second = bytes_per_second
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._backoff = 0.0
+        self._paused_until = 0.0
+        self.query_count = 0
+        self.bytes_count = 0
+        self.error_count = 0
+        self.waited = 0.0
+
+    def _wait_for_backoff(self):
+        with self._lock:
+            wait = self._paused_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+            return wait
+        return 0.0
+
+    def acquire_query(self):
+        """執行一個查詢之前調用：先等待退避期結束，再取一個查詢令牌"""
+        waited = self._wait_for_backoff() + self.queries.acquire()
+        with self._lock:
+            self.query_count += 1
+            self.waited += waited
+        return waited
+
+    def consume_bytes(self, amount):
+        """記錄收到的位元組數，超過每秒上限時等待"""
+        waited = self.bytes.acquire(amount)
+        with self._lock:
+            self.bytes_count += amount
+            self.waited += waited
+        return waited
+
+    def wrap_file(self, fileobj):
+        """返回寫入時受位元組限速的文件對象；未設置位元組上限時返回原對象"""
+        if not self.bytes_per_second:
+            return fileobj
+        return _ThrottledWriter(fileobj, self)
+
+    def meter_writer(self, writer):
+        """返回按 writer 輸出文件大小的增長量限速的計量器（每批寫入後調用其 charge()）"""
+        return _WriterMeter(writer, self)
+
+    def is_load_error(self, error):
+        """錯誤是否來自連接或伺服器負載；權限不足、表格不存在等只與單個表格有關的錯誤返回 False"""
+        if isinstance(error, self.LOAD_ERROR_TYPES) or isinstance(getattr(error, 'orig', None), self.LOAD_ERROR_TYPES):
+            return True
+        message = str(error).lower()
+        return any(pattern in message for pattern in self.LOAD_ERRORS)
+
+    def record_success(self):
+        """查詢成功後退避時間減半，低於最小值時取消退避"""
+        with self._lock:
+            self._backoff /= 2
+            if self._backoff < self.min_backoff:
+                self._backoff = 0.0
+
+    def record_error(self, error):
+        """連接或負載錯誤時加倍退避時間，所有線程都暫停到退避期結束；返回退避秒數，
+        其他錯誤只讓該表格失敗，不暫停（返回 0）"""
+        with self._lock:
+            self.error_count += 1
+            if not self.is_load_error(error):
+                return 0.0
+            # 從較長的退避開始，避免在伺服器恢復之前反復重連
+            self._backoff = min(max(self._backoff * 2, self.min_backoff * 4), self.max_backoff)
+            self._paused_until = max(self._paused_until, time.monotonic() + self._backoff)
+            return self._backoff
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queries': self.query_count,
+                'bytes': self.bytes_count,
+                'errors': self.error_count,
+                'waited_seconds': round(self.waited, 1),
+                'backoff_seconds': round(self._backoff, 1),
+            }
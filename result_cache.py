@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+INDEX_FILENAME = 'result_cache.sqlite'
+
+def cache_key(table_name, output_format, columns=None, filters=None, limit=None, compact_dtypes=True,
+              export_engine='pandas'):
+    """由表格、欄位、過濾條件、行數上限、格式、dtype 設定和匯出引擎計算緩存鍵；表格名稱不分大小寫，過濾條件與順序無關"""
+    normalized_filters = sorted(
+        json.dumps({
+            'column': spec.get('column'),
+            'op': str(spec.get('op', '=')).strip().lower(),
+            'value': spec.get('value'),
+        }, sort_keys=True, default=str)
+        for spec in filters or []
+    )
+    request = {
+        'table': table_name.strip().lower(),
+        'format': output_format,
+        'columns': list(columns) if columns else None,
+        'filters': normalized_filters,
+        'limit': limit,
+        'compact_dtypes': compact_dtypes,
+        # COPY 與 pandas 輸出的 CSV 文字格式不同（布林值 t/f 與 True/False、數值和時間的寫法），列式格式與引擎無關
+        'engine': export_engine if output_format == 'csv' else None,
+    }
+    return hashlib.sha1(json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
+
+def link_or_copy(source_path, path):
+    """以硬連結（不支援時複製）原子地建立 path"""
+    # 已是同一個文件時 rename 不會做任何事，臨時連結會殘留
+    if os.path.exists(path) and os.path.samefile(source_path, path):
+        return
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(source_path, tmp_path)
+    except OSError:
+        shutil.copyfile(source_path, tmp_path)
+    os.replace(tmp_path, path)
+
+class ResultCache:
+    """下載結果的磁碟緩存：相同的請求直接返回上次的文件；總大小超過上限時淘汰最久未使用的項目，
+    表格的目錄指紋改變時使該表格的所有項目失效"""
+
+    def __init__(self, cache_dir, max_bytes, max_age=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # 沒有目錄指紋的項目的最長保存時間（秒）
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._db = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _index(self):
+        """返回索引數據庫的連接，第一次使用時才建立緩存目錄和數據庫；調用時須持有 self._lock"""
+        if self._db is not None:
+            return self._db
+        os.makedirs(self.cache_dir, exist_ok=True)
+        db = sqlite3.connect(os.path.join(self.cache_dir, INDEX_FILENAME), check_same_thread=False)
+        db.row_factory = sqlite3.Row
+        with db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    table_name TEXT NOT NULL,
+                    format TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    rows INTEGER,
+                    bytes INTEGER NOT NULL,
+                    fingerprint TEXT,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS entries_table ON entries (table_name)")
+            db.execute("CREATE INDEX IF NOT EXISTS entries_access ON entries (last_access)")
+        self._db = db
+        return db
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def lookup(self, key, table_name, fingerprint):
+        """返回有效的緩存項目（dict）並更新使用時間；指紋改變、過期或文件遺失時返回 None"""
+        table_name = table_name.lower()
+        with self._lock:
+            self._index()
+            if fingerprint is not None:
+                # 表格內容已改變：該表格的所有緩存項目都失效
+                stale = self._db.execute(
+                    "SELECT key, path FROM entries WHERE table_name = ? AND fingerprint IS NOT ?",
+                    (table_name, fingerprint)).fetchall()
+                self._delete(stale)
+            row = self._db.execute("SELECT * FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None and not self._is_valid(row):
+                self._delete([row])
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            with self._db:
+                self._db.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+            return dict(row)
+
+    def _is_valid(self, row):
+        if not os.path.exists(row['path']) or os.path.getsize(row['path']) != row['bytes']:
+            return False
+        if row['fingerprint'] is None and self.max_age is not None:
+            return time.time() - row['created_at'] <= self.max_age
+        return True
+
+    def store(self, key, table_name, output_format, source_path, rows, fingerprint):
+        """把下載完成的文件加入緩存（可行時使用硬連結，不額外佔用空間），然後按上限淘汰舊項目"""
+        size = os.path.getsize(source_path)
+        if not self.enabled or size > self.max_bytes:
+            return None
+        with self._lock:
+            self._index()
+        path = os.path.join(self.cache_dir, key + os.path.splitext(source_path)[1])
+        link_or_copy(source_path, path)
+
+        now = time.time()
+        with self._lock:
+            with self._db:
+                self._db.execute("""
+                    INSERT OR REPLACE INTO entries
+                    (key, table_name, format, path, rows, bytes, fingerprint, created_at, last_access)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (key, table_name.lower(), output_format, path, rows, size, fingerprint, now, now))
+            self._evict()
+        return path
+
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(bytes), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        victims = []
+        for row in self._db.execute("SELECT key, path, bytes FROM entries ORDER BY last_access"):
+            if total <= self.max_bytes:
+                break
+            victims.append(row)
+            total -= row['bytes']
+        self.evictions += len(victims)
+        self._delete(victims)
+
+    def _delete(self, rows):
+        if not rows:
+            return
+        with self._db:
+            self._db.executemany("DELETE FROM entries WHERE key = ?", [(row['key'],) for row in rows])
+        for row in rows:
+            try:
+                os.remove(row['path'])
+            except FileNotFoundError:
+                pass
+
+    def invalidate(self, table_name=None):
+        """刪除某個表格（不指定時為全部）的緩存項目，返回刪除數量"""
+        with self._lock:
+            self._index()
+            if table_name:
+                rows = self._db.execute("SELECT key, path FROM entries WHERE table_name = ?",
+                                        (table_name.lower(),)).fetchall()
+            else:
+                rows = self._db.execute("SELECT key, path FROM entries").fetchall()
+            self._delete(rows)
+            return len(rows)
+
+    def stats(self):
+        with self._lock:
+            self._index()
+            entries = [dict(row) for row in self._db.execute(
+                "SELECT table_name, format, rows, bytes, last_access FROM entries ORDER BY last_access DESC")]
+            return {
+                'entries': len(entries),
+                'bytes': sum(entry['bytes'] for entry in entries),
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'tables': entries,
+            }
@@ -11,12 +11,12 @@ def check_time_range():
     return 1 <= current_hour < 8
 
 def run_download():
-    """執行下載腳本"""
+    """執行增量同步：已下載的表格只下載水位線之後的新增數據，新表格完整下載"""
     if check_time_range():
         print(f"\n開始執行下載任務 - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
         try:
             # 使用 subprocess 執行下載腳本
-            result = subprocess.run([sys.executable, 'download_wrds_tables.py'], 
+            result = subprocess.run([sys.executable, 'download_all_tables.py', '--incremental'], 
                                  capture_output=True, 
                                  text=True)
             
@@ -30,12 +30,18 @@ def run_download():
             with open(log_file, 'a', encoding='utf-8') as f:
                 f.write(f"\n{'='*50}\n")
                 f.write(f"執行時間: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+                # 下載腳本最後輸出的增量統計（各表格新增的行數見下方輸出和下載日誌）
+                delta_summary = [line for line in result.stdout.splitlines() if line.startswith('增量同步:')]
+                if delta_summary:
+                    f.write(f"{delta_summary[-1]}\n")
                 f.write(f"執行結果:\n{result.stdout}\n")
                 if result.stderr:
                     f.write(f"錯誤信息:\n{result.stderr}\n")
                 f.write(f"{'='*50}\n")
             
             print(f"下載任務完成 - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+            if delta_summary:
+                print(delta_summary[-1])
             
         except Exception as e:
             print(f"執行過程中發生錯誤: {str(e)}")
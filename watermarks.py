@@ -0,0 +1,43 @@
+import json
+import os
+import threading
+from datetime import datetime
+
+class WatermarkStore:
+    """增量同步的水位線：每個表格記錄水位線欄位和已下載的最大值，保存在輸出目錄的 JSON 文件中"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._marks = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self._marks = json.load(f)
+
+    @staticmethod
+    def _key(library, table):
+        return f"{library}.{table}"
+
+    def get(self, library, table):
+        """返回 {'column', 'value', 'updated_at'}，沒有水位線時返回 None"""
+        with self._lock:
+            mark = self._marks.get(self._key(library, table))
+            return dict(mark) if mark else None
+
+    def update(self, library, table, column, value):
+        """記錄新的水位線並立即寫入文件（先寫臨時文件再改名）"""
+        with self._lock:
+            self._marks[self._key(library, table)] = {
+                'column': column,
+                # 日期等類型以字串保存，作為查詢參數時由 PostgreSQL 轉換回原類型
+                'value': value if isinstance(value, (int, float)) else str(value),
+                'updated_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            }
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._marks, f, ensure_ascii=False, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+    def __contains__(self, item):
+        library, table = item
+        return self.get(library, table) is not None
@@ -1,28 +1,59 @@
 import wrds
 import pandas as pd
+import argparse
 from datetime import datetime, timedelta
+from wrds_export import (get_column_types, get_distinct_ratios, SelectSpec, parse_filter_expression,
+                         date_range_filters)
+from dtype_mapper import DtypeMapper, frame_memory
+from output_formats import OUTPUT_FORMATS, open_writer, file_extension, arrow_schema_from_columns
 
-def fetch_wrds_data(table_name):
+def fetch_wrds_data(table_name, output_format='csv', columns=None, filters=None, limit=None, compact_dtypes=True):
     try:
         # Connect to WRDS with credentials
         conn = wrds.Connection(wrds_username='crysta_hwg', wrds_password='Aa123456!')
         
-        # Construct the SQL query
-        sql_query = f"""
-            SELECT *
-            FROM {table_name}
-        """
+        # Construct the SQL query; projections, filters and limits are pushed into the SQL
+        # and need the table's columns for validation
+        spec = None
+        if columns or filters or limit is not None:
+            if '.' not in table_name:
+                raise ValueError("columns, filters and limit require a schema-qualified table name")
+            schema_name, table = table_name.split('.', 1)
+            spec = SelectSpec(get_column_types(conn.connection, schema_name, table), columns, filters, limit)
+            sql_query, params = spec.query(schema_name, table)
+        else:
+            sql_query = f"""
+                SELECT *
+                FROM {table_name}
+            """
+            params = None
         
         print(f"Fetching data from: {table_name}")
         
         # Execute the query and load into DataFrame
-        df = conn.raw_sql(sql_query)
+        df = conn.raw_sql(sql_query, params=params)
         
-        # Save to CSV
+        table_columns = None
+        if '.' in table_name:
+            schema_name, table = table_name.split('.', 1)
+            table_columns = spec.output_columns() if spec else get_column_types(conn.connection, schema_name, table)
+        
+        # Shrink the DataFrame to compact dtypes derived from the column types
+        # (nullable integers, lossless float32, categoricals, datetime64)
+        if compact_dtypes and table_columns:
+            raw_memory = frame_memory(df)
+            df = DtypeMapper(table_columns, get_distinct_ratios(conn.connection, schema_name, table)).apply(df)
+            print(f"Memory usage: {raw_memory / 1024 ** 2:.1f} MB -> {frame_memory(df) / 1024 ** 2:.1f} MB")
+        
+        # Save in the requested format (columnar formats use the table's column types)
         current_date = datetime.now().strftime('%Y%m%d')
         table_name_clean = table_name.replace('.', '_')
-        output_filename = f'{table_name_clean}_{current_date}.csv'
-        df.to_csv(output_filename, index=False)
+        output_filename = f'{table_name_clean}_{current_date}{file_extension(output_format)}'
+        arrow_schema = None
+        if output_format != 'csv' and table_columns:
+            arrow_schema = arrow_schema_from_columns(table_columns)
+        with open_writer(output_format, output_filename, arrow_schema) as writer:
+            writer.write_batch(df)
         
         print(f"Data successfully downloaded and saved to {output_filename}")
         
@@ -36,11 +67,36 @@ def fetch_wrds_data(table_name):
         return None
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download a WRDS table")
+    parser.add_argument("--format", choices=list(OUTPUT_FORMATS), default='csv', help="output format (default: csv)")
+    parser.add_argument("--table", help="WRDS table name (prompted for when omitted)")
+    parser.add_argument("--columns", help="comma-separated list of columns to download (default: all)")
+    parser.add_argument("--filter", action="append", default=[], dest="filters",
+                        help='row filter such as "date>=2015-01-01" or "ticker in AAPL,MSFT"; may be repeated')
+    parser.add_argument("--date-column", help="date column used by --start-date/--end-date")
+    parser.add_argument("--start-date", help="first date to download (inclusive)")
+    parser.add_argument("--end-date", help="last date to download (inclusive)")
+    parser.add_argument("--limit", type=int, help="maximum number of rows to download")
+    parser.add_argument("--no-compact-dtypes", action="store_true",
+                        help="keep pandas' default dtypes instead of compact ones derived from the column types")
+    args = parser.parse_args()
+    
+    if (args.start_date or args.end_date) and not args.date_column:
+        parser.error("--start-date/--end-date require --date-column")
+    try:
+        filters = [parse_filter_expression(expr) for expr in args.filters]
+    except ValueError as e:
+        parser.error(str(e))
+    filters += date_range_filters(args.date_column, args.start_date, args.end_date)
+    columns = [col.strip() for col in args.columns.split(',') if col.strip()] if args.columns else None
+    
     # Get table name from user input
-    print("Please enter the WRDS table name (e.g., comp_na_daily_all.company):")
-    table_name = input().strip()
+    table_name = args.table
+    if not table_name:
+        print("Please enter the WRDS table name (e.g., comp_na_daily_all.company):")
+        table_name = input().strip()
     
     if table_name:
-        fetch_wrds_data(table_name)
+        fetch_wrds_data(table_name, args.format, columns, filters, args.limit, not args.no_compact_dtypes)
     else:
         print("No table name provided. Please run the script again with a valid table name.") 
\ No newline at end of file
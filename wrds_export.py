@@ -0,0 +1,722 @@
+import hashlib
+import json
+import queue
+import re
+import threading
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+# ctid 的 keyset 分頁需要 TID 範圍掃描（PostgreSQL 14+）
+CTID_MIN_SERVER_VERSION = 140000
+CTID_KEY = 'ctid'
+CTID_COLUMN = '_wrds_ctid'
+
+def quote_ident(name):
+    """為 SQL 標識符加上雙引號"""
+    return '"' + name.replace('"', '""') + '"'
+
+def find_pagination_key(conn, schema_name, table_name):
+    """尋找可用於 keyset 分頁的排序鍵（主鍵 > 唯一索引 > ctid），找不到時返回 None"""
+    # 主鍵或所有欄位皆為 NOT NULL 的唯一索引，欄位越少越好
+    key_query = text("""
+        SELECT array_agg(a.attname::text ORDER BY k.ord) AS key_columns
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        CROSS JOIN LATERAL unnest(i.indkey::int2[]) WITH ORDINALITY AS k(attnum, ord)
+        JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = k.attnum
+        WHERE n.nspname = :schema
+        AND c.relname = :table
+        AND i.indisunique
+        AND i.indisvalid
+        AND i.indpred IS NULL
+        AND i.indexprs IS NULL
+        GROUP BY i.indexrelid, i.indisprimary
+        HAVING bool_and(a.attnotnull)
+        ORDER BY i.indisprimary DESC, count(*)
+        LIMIT 1
+    """)
+    key_columns = conn.execute(key_query, {"schema": schema_name, "table": table_name}).scalar()
+    if key_columns:
+        return list(key_columns)
+
+    # 沒有可用索引時，普通表可以退而使用 ctid（視圖沒有 ctid）
+    relkind_query = text("""
+        SELECT c.relkind
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = :schema
+        AND c.relname = :table
+    """)
+    relkind = conn.execute(relkind_query, {"schema": schema_name, "table": table_name}).scalar()
+    server_version = conn.execute(text("SHOW server_version_num")).scalar()
+    if relkind in ('r', 'm') and int(server_version) >= CTID_MIN_SERVER_VERSION:
+        return [CTID_KEY]
+
+    return None
+
+def build_keyset_query(schema_name, table_name, key_columns, last_key, batch_size, select="*", conditions=(),
+                       condition_params=None):
+    """構建 keyset 分頁查詢：WHERE key > last_seen ORDER BY key LIMIT batch_size
+
+    select 和 conditions 用於欄位投影和額外的過濾條件（見 SelectSpec）
+    """
+    params = {"batch_size": batch_size}
+    params.update(condition_params or {})
+    relation = f"{schema_name}.{table_name}"
+    conditions = list(conditions)
+
+    if key_columns == [CTID_KEY]:
+        if last_key is not None:
+            conditions.append("ctid > CAST(:k0 AS tid)")
+            params["k0"] = last_key[0]
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
+        query = text(f"""
+            SELECT {select}, ctid::text AS {CTID_COLUMN}
+            FROM {relation}
+            {where}
+            ORDER BY ctid
+            LIMIT :batch_size
+        """)
+        return query, params
+
+    quoted = ", ".join(quote_ident(col) for col in key_columns)
+    if last_key is not None:
+        placeholders = ", ".join(f":k{i}" for i in range(len(key_columns)))
+        # 複合鍵使用行比較，可以直接利用索引
+        conditions.append(f"({quoted}) > ({placeholders})")
+        params.update({f"k{i}": value for i, value in enumerate(last_key)})
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    query = text(f"""
+        SELECT {select}
+        FROM {relation}
+        {where}
+        ORDER BY {quoted}
+        LIMIT :batch_size
+    """)
+    return query, params
+
+def find_batch_upper_key(conn, schema_name, table_name, key_columns, last_key, batch_size):
+    """返回從 last_key 之後第 batch_size 行的鍵值（只掃描索引），剩餘不足 batch_size 行時返回 None"""
+    quoted = ", ".join(quote_ident(col) for col in key_columns)
+    params = {"offset": batch_size - 1}
+    where = ""
+    if last_key is not None:
+        placeholders = ", ".join(f":k{i}" for i in range(len(key_columns)))
+        where = f"WHERE ({quoted}) > ({placeholders})"
+        params.update({f"k{i}": value for i, value in enumerate(last_key)})
+    query = text(f"""
+        SELECT {quoted}
+        FROM {schema_name}.{table_name}
+        {where}
+        ORDER BY {quoted}
+        OFFSET :offset
+        LIMIT 1
+    """)
+    row = conn.execute(query, params).fetchone()
+    return list(row) if row is not None else None
+
+def build_key_range_sql(schema_name, table_name, key_columns, last_key, upper_key):
+    """構建 COPY 使用的鍵範圍查詢 last_key < key <= upper_key（psycopg2 參數格式），返回 (sql, params)"""
+    quoted = ", ".join(quote_ident(col) for col in key_columns)
+    conditions = []
+    params = {}
+    for name, op, key in (("k", ">", last_key), ("u", "<=", upper_key)):
+        if key is None:
+            continue
+        placeholders = ", ".join(f"%({name}{i})s" for i in range(len(key_columns)))
+        conditions.append(f"({quoted}) {op} ({placeholders})")
+        params.update({f"{name}{i}": value for i, value in enumerate(key)})
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    sql = f"SELECT * FROM {schema_name}.{table_name} {where} ORDER BY {quoted}"
+    return sql, params
+
+def plan_partitions(conn, schema_name, table_name, partitions):
+    """把表格切分成互不重疊的範圍：普通表按 ctid 數據頁（PostgreSQL 14+），否則按整數/日期排序鍵的值域
+
+    返回 [{'column', 'low', 'high'}, ...]（low/high 為 None 表示不設界限），無法切分時返回 None
+    """
+    if partitions < 2:
+        return None
+
+    key_columns = find_pagination_key(conn, schema_name, table_name)
+    if key_columns == [CTID_KEY]:
+        pages = conn.execute(text("""
+            SELECT pg_relation_size(CAST(:relation AS regclass)) / current_setting('block_size')::int
+        """), {"relation": f"{schema_name}.{table_name}"}).scalar()
+        if not pages or pages < partitions:
+            return None
+        bounds = [pages * i // partitions for i in range(1, partitions)]
+        edges = [None] + [f"({page},0)" for page in bounds] + [None]
+        return [{'column': CTID_KEY, 'low': edges[i], 'high': edges[i + 1]} for i in range(partitions)]
+
+    # 排序鍵的第一個欄位不為 NULL，值域均分後每行恰好屬於一個分區
+    if not key_columns:
+        return None
+    column = key_columns[0]
+    pg_type = dict(get_column_types(conn, schema_name, table_name)).get(column)
+    if pg_type not in ('smallint', 'integer', 'bigint', 'date'):
+        return None
+    low, high = conn.execute(text(
+        f"SELECT min({quote_ident(column)}), max({quote_ident(column)}) FROM {schema_name}.{table_name}"
+    )).fetchone()
+    if low is None:
+        return None
+    if pg_type == 'date':
+        start, span = low.toordinal(), high.toordinal() - low.toordinal() + 1
+        to_value = lambda n: str(low.fromordinal(n))
+    else:
+        start, span = low, high - low + 1
+        to_value = lambda n: n
+    if span < partitions:
+        return None
+    edges = [None] + [to_value(start + span * i // partitions) for i in range(1, partitions)] + [None]
+    return [{'column': column, 'low': edges[i], 'high': edges[i + 1]} for i in range(partitions)]
+
+def build_partition_query(schema_name, table_name, partition):
+    """構建單個分區的查詢：low <= 欄位 < high，返回 (text, params)"""
+    if partition['column'] == CTID_KEY:
+        column, cast = "ctid", lambda name: f"CAST(:{name} AS tid)"
+    else:
+        column, cast = quote_ident(partition['column']), lambda name: f":{name}"
+    conditions = []
+    params = {}
+    if partition['low'] is not None:
+        conditions.append(f"{column} >= {cast('low')}")
+        params['low'] = partition['low']
+    if partition['high'] is not None:
+        conditions.append(f"{column} < {cast('high')}")
+        params['high'] = partition['high']
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    return text(f"SELECT * FROM {schema_name}.{table_name} {where}"), params
+
+def pop_last_key(batch_df, key_columns):
+    """取得批次最後一行的排序鍵值，並移除 ctid 輔助欄位"""
+    if batch_df.empty:
+        return None
+    if key_columns == [CTID_KEY]:
+        last_key = [batch_df[CTID_COLUMN].iloc[-1]]
+        batch_df.drop(columns=[CTID_COLUMN], inplace=True)
+        return last_key
+    # to_dict() 會轉換成 Python 原生類型，方便作為查詢參數
+    last_row = batch_df[key_columns].iloc[[-1]].to_dict('records')[0]
+    return [last_row[col] for col in key_columns]
+
+def stream_query(connectable, query, params=None, fetch_size=100000):
+    """使用伺服器端游標（stream_results）逐塊讀取查詢結果，每塊 fetch_size 行；
+    connectable 為 Engine 時另外取一個連接，為 Connection 時直接在該連接上執行"""
+    if isinstance(query, str):
+        query = text(query)
+    query = query.execution_options(stream_results=True, max_row_buffer=fetch_size)
+    if isinstance(connectable, Engine):
+        with connectable.connect() as conn:
+            yield from _stream_chunks(conn, query, params, fetch_size)
+    else:
+        yield from _stream_chunks(connectable, query, params, fetch_size)
+
+def _stream_chunks(conn, query, params, fetch_size):
+    # 伺服器端游標只能在交易中使用：AUTOCOMMIT 的連接（wrds.Connection）串流期間暫時關閉自動提交
+    dbapi_conn = conn.connection.dbapi_connection
+    autocommit = getattr(dbapi_conn, 'autocommit', False)
+    if autocommit:
+        dbapi_conn.autocommit = False
+    try:
+        for chunk in pd.read_sql_query(query, conn, params=params, chunksize=fetch_size):
+            yield chunk
+    finally:
+        if autocommit:
+            dbapi_conn.rollback()
+            dbapi_conn.autocommit = True
+
+class _CountingWriter:
+    """包裝輸出文件，統計 COPY 寫出的行數並定期回報進度"""
+
+    def __init__(self, fileobj, progress_callback=None, report_every=100000):
+        self._fileobj = fileobj
+        self._progress_callback = progress_callback
+        self._report_every = report_every
+        self._next_report = report_every
+        self.lines = 0
+        self.bytes_written = 0
+
+    def write(self, data):
+        self._fileobj.write(data)
+        self.lines += data.count(b'\n')
+        self.bytes_written += len(data)
+        if self._progress_callback and self.lines >= self._next_report:
+            self._next_report = self.lines + self._report_every
+            # 第一行是標題行
+            self._progress_callback(max(self.lines - 1, 0))
+        return len(data)
+
+def build_copy_sql(cursor, query, params=None, header=True):
+    """將 SELECT 查詢包裝成 COPY (...) TO STDOUT WITH CSV，參數由 psycopg2 安全地內嵌"""
+    if params:
+        query = cursor.mogrify(query, params).decode()
+    options = "CSV HEADER" if header else "CSV"
+    return f"COPY ({query}) TO STDOUT WITH {options}"
+
+def copy_export(connectable, query, fileobj, params=None, header=True, progress_callback=None):
+    """使用 PostgreSQL COPY TO STDOUT 將查詢結果直接寫入二進制文件對象，返回行數；
+    connectable 為 Engine 時另外取一個連接，為 Connection 時直接在該連接上執行"""
+    if not isinstance(query, str):
+        # SQLAlchemy text() 查詢先編譯成 psycopg2 的參數格式
+        compiled = query.compile(dialect=connectable.dialect)
+        query = str(compiled)
+        params = dict(compiled.params, **(params or {}))
+    if not isinstance(connectable, Engine):
+        return _copy_to(connectable.connection.dbapi_connection, query, fileobj, params, header, progress_callback)
+    raw_conn = connectable.raw_connection()
+    try:
+        return _copy_to(raw_conn, query, fileobj, params, header, progress_callback)
+    finally:
+        raw_conn.close()
+
+def _copy_to(raw_conn, query, fileobj, params, header, progress_callback):
+    cursor = raw_conn.cursor()
+    try:
+        writer = _CountingWriter(fileobj, progress_callback)
+        cursor.copy_expert(build_copy_sql(cursor, query, params, header), writer)
+        rows = cursor.rowcount
+        if rows is None or rows < 0:
+            rows = max(writer.lines - (1 if header else 0), 0)
+        return rows
+    finally:
+        cursor.close()
+
+class _QueueWriter:
+    """把 COPY 輸出放入有界隊列，供 HTTP 回應以生成器方式讀取"""
+
+    def __init__(self, chunks, cancelled, chunk_size):
+        self._chunks = chunks
+        self._cancelled = cancelled
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self._chunk_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if not self._buffer:
+            return
+        chunk = bytes(self._buffer)
+        self._buffer = bytearray()
+        # 隊列滿時等待讀取端；讀取端已放棄（例如客戶端斷線）時中止 COPY
+        while True:
+            try:
+                self._chunks.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                if self._cancelled.is_set():
+                    raise IOError("COPY 輸出的讀取端已關閉")
+
+def iter_copy_export(engine, query, params=None, header=True, chunk_size=1024 * 1024):
+    """在背景線程執行 COPY，並以 bytes 區塊的生成器輸出，適合直接作為 HTTP 回應主體"""
+    chunks = queue.Queue(maxsize=8)
+    cancelled = threading.Event()
+    done = object()
+    errors = []
+
+    def run_copy():
+        writer = _QueueWriter(chunks, cancelled, chunk_size)
+        try:
+            copy_export(engine, query, writer, params=params, header=header)
+            writer.flush()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            chunks.put(done)
+
+    worker = threading.Thread(target=run_copy, daemon=True)
+    worker.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is done:
+                break
+            yield chunk
+    finally:
+        cancelled.set()
+        # 讓背景線程可以放入結束標記
+        while worker.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+    if errors:
+        raise errors[0]
+
+# 增量同步時優先作為水位線的日期欄位（按順序）
+WATERMARK_COLUMNS = ('date', 'datadate', 'caldt', 'rdate', 'fdate', 'anndats', 'statpers')
+
+def find_watermark_column(conn, schema_name, table_name):
+    """尋找增量同步的水位線欄位：常見的日期欄位，其次是單欄位的數值/日期主鍵；找不到時返回 None"""
+    columns = dict(get_column_types(conn, schema_name, table_name))
+    for name in WATERMARK_COLUMNS:
+        if name in columns and (columns[name] == 'date' or columns[name].startswith('timestamp')):
+            return name
+
+    key_columns = find_pagination_key(conn, schema_name, table_name)
+    if key_columns and len(key_columns) == 1 and key_columns[0] in columns:
+        pg_type = columns[key_columns[0]]
+        if pg_type in ('smallint', 'integer', 'bigint', 'date') or pg_type.startswith(('numeric', 'timestamp')):
+            return key_columns[0]
+    return None
+
+def get_column_max(conn, schema_name, table_name, column, above=None):
+    """返回欄位的最大值；above 不為 None 時只看大於 above 的行（沒有時返回 None）"""
+    where = ""
+    params = {}
+    if above is not None:
+        where = f"WHERE {quote_ident(column)} > :above"
+        params["above"] = above
+    query = text(f"SELECT max({quote_ident(column)}) FROM {schema_name}.{table_name} {where}")
+    return conn.execute(query, params).scalar()
+
+# 過濾條件支援的運算符 -> SQL
+FILTER_OPERATORS = {
+    '=': '=', '!=': '<>', '<>': '<>', '<': '<', '<=': '<=', '>': '>', '>=': '>=',
+    'like': 'LIKE', 'in': 'IN', 'not in': 'NOT IN', 'between': 'BETWEEN',
+    'is null': 'IS NULL', 'is not null': 'IS NOT NULL',
+}
+
+# 命令列過濾表達式，例如 "date>=2015-01-01"、"ticker in AAPL,MSFT"、"ret is not null"
+_FILTER_EXPRESSION = re.compile(
+    r'^\s*(\w+)\s*(is not null|is null|not in|between|like|in|>=|<=|!=|<>|=|<|>)\s*(.*?)\s*$', re.IGNORECASE)
+
+def parse_filter_expression(expression):
+    """把 "欄位 運算符 值" 形式的表達式轉換成過濾條件 dict；in/between 的多個值以逗號分隔"""
+    match = _FILTER_EXPRESSION.match(expression)
+    if not match:
+        raise ValueError(f"無法解析過濾條件: {expression}")
+    column, op, value = match.group(1), match.group(2).lower(), match.group(3)
+    if op in ('in', 'not in', 'between'):
+        value = [item.strip() for item in value.split(',')]
+    elif op in ('is null', 'is not null'):
+        value = None
+    return {'column': column, 'op': op, 'value': value}
+
+def date_range_filters(date_column, start_date=None, end_date=None):
+    """把日期範圍轉換成過濾條件（包含起止日期）"""
+    filters = []
+    if start_date:
+        filters.append({'column': date_column, 'op': '>=', 'value': start_date})
+    if end_date:
+        filters.append({'column': date_column, 'op': '<=', 'value': end_date})
+    return filters
+
+class SelectSpec:
+    """下載的欄位投影、過濾條件和行數上限：欄位名稱對照表格欄位驗證，所有值都作為綁定參數"""
+
+    def __init__(self, table_columns, columns=None, filters=None, limit=None):
+        self.table_columns = list(table_columns)
+        names = [name for name, _ in self.table_columns]
+
+        self.columns = list(dict.fromkeys(columns)) if columns else None
+        unknown = [col for col in self.columns or [] if col not in names]
+        if unknown:
+            raise ValueError(f"表格中沒有以下欄位: {', '.join(unknown)}")
+
+        self.filters = list(filters or [])
+        self.conditions = []
+        self.params = {}
+        for i, spec in enumerate(self.filters):
+            self._add_condition(i, spec, names)
+
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except (TypeError, ValueError):
+                raise ValueError(f"行數上限必須是整數: {limit}")
+            if limit <= 0:
+                raise ValueError("行數上限必須大於 0")
+        self.limit = limit
+
+    def _add_condition(self, i, spec, names):
+        if not isinstance(spec, dict):
+            raise ValueError(f"過濾條件格式錯誤: {spec}")
+        column = spec.get('column')
+        op = str(spec.get('op', '=')).strip().lower()
+        value = spec.get('value')
+        if column not in names:
+            raise ValueError(f"過濾條件中的欄位不存在: {column}")
+        if op not in FILTER_OPERATORS:
+            raise ValueError(f"不支援的過濾運算符: {op}")
+
+        quoted = quote_ident(column)
+        sql_op = FILTER_OPERATORS[op]
+        if op in ('is null', 'is not null'):
+            self.conditions.append(f"{quoted} {sql_op}")
+        elif op in ('in', 'not in'):
+            if not isinstance(value, list) or not value:
+                raise ValueError(f"{op} 的值必須是非空列表: {column}")
+            placeholders = []
+            for j, item in enumerate(value):
+                self.params[f"f{i}_{j}"] = item
+                placeholders.append(f":f{i}_{j}")
+            self.conditions.append(f"{quoted} {sql_op} ({', '.join(placeholders)})")
+        elif op == 'between':
+            if not isinstance(value, list) or len(value) != 2:
+                raise ValueError(f"between 的值必須是兩個元素的列表: {column}")
+            self.params.update({f"f{i}_0": value[0], f"f{i}_1": value[1]})
+            self.conditions.append(f"{quoted} BETWEEN :f{i}_0 AND :f{i}_1")
+        else:
+            if value is None or isinstance(value, (list, dict)):
+                raise ValueError(f"{op} 的值必須是單個值: {column}")
+            self.params[f"f{i}"] = value
+            self.conditions.append(f"{quoted} {sql_op} :f{i}")
+
+    @property
+    def is_empty(self):
+        return self.columns is None and not self.filters and self.limit is None
+
+    def select_list(self, extra_columns=()):
+        """SELECT 的欄位列表；extra_columns 為分頁等需要、但不在投影中的欄位"""
+        if self.columns is None:
+            return "*"
+        columns = self.columns + [col for col in extra_columns if col not in self.columns]
+        return ", ".join(quote_ident(col) for col in columns)
+
+    def output_columns(self):
+        """輸出文件的 [(欄位名稱, PostgreSQL 類型), ...]，按投影的順序"""
+        if self.columns is None:
+            return self.table_columns
+        types = dict(self.table_columns)
+        return [(col, types[col]) for col in self.columns]
+
+    def query(self, schema_name, table_name):
+        """完整的查詢（包含行數上限），返回 (text, params)"""
+        where = "WHERE " + " AND ".join(self.conditions) if self.conditions else ""
+        limit = "LIMIT :row_limit" if self.limit is not None else ""
+        params = dict(self.params)
+        if self.limit is not None:
+            params["row_limit"] = self.limit
+        return text(f"SELECT {self.select_list()} FROM {schema_name}.{table_name} {where} {limit}"), params
+
+    def to_dict(self):
+        return {'columns': self.columns, 'filters': self.filters, 'limit': self.limit}
+
+def estimate_query_rows(conn, query, params=None, exact=False):
+    """返回 (查詢結果行數, 是否精確)；默認使用規劃器的估算，exact=True 時執行 COUNT(*)"""
+    if exact:
+        count_query = text(f"SELECT COUNT(*) FROM ({query.text}) AS q")
+        return int(conn.execute(count_query, params or {}).scalar()), True
+    plan = conn.execute(text(f"EXPLAIN (FORMAT JSON) {query.text}"), params or {}).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows']), False
+
+def get_column_types(conn, schema_name, table_name):
+    """按欄位順序返回表格的 [(欄位名稱, PostgreSQL 類型), ...]"""
+    query = text("""
+        SELECT a.attname AS column_name,
+               format_type(a.atttypid, a.atttypmod) AS data_type
+        FROM pg_attribute a
+        JOIN pg_class c ON c.oid = a.attrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = :schema
+        AND c.relname = :table
+        AND a.attnum > 0
+        AND NOT a.attisdropped
+        ORDER BY a.attnum
+    """)
+    result = conn.execute(query, {"schema": schema_name, "table": table_name})
+    return [(row[0], row[1]) for row in result]
+
+def get_schema_column_types(conn, schemas):
+    """一次查詢返回多個數據庫所有表格的 {(數據庫, 表格): [(欄位名稱, PostgreSQL 類型), ...]}"""
+    query = text("""
+        SELECT n.nspname, c.relname, a.attname, format_type(a.atttypid, a.atttypmod)
+        FROM pg_attribute a
+        JOIN pg_class c ON c.oid = a.attrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = ANY(:schemas)
+        AND c.relkind IN ('r', 'p', 'v', 'm', 'f')
+        AND a.attnum > 0
+        AND NOT a.attisdropped
+        ORDER BY n.nspname, c.relname, a.attnum
+    """)
+    tables = {}
+    for library, table, column, data_type in conn.execute(query, {"schemas": list(schemas)}):
+        tables.setdefault((library, table), []).append((column, data_type))
+    return tables
+
+def get_distinct_ratios(conn, schema_name, table_name):
+    """由 pg_stats 返回 {欄位名稱: 不同值佔行數的比例}；沒有統計信息的欄位（或視圖）不包含在內"""
+    query = text("""
+        SELECT s.attname, s.n_distinct, c.reltuples
+        FROM pg_stats s
+        JOIN pg_namespace n ON n.nspname = s.schemaname
+        JOIN pg_class c ON c.relnamespace = n.oid AND c.relname = s.tablename
+        WHERE s.schemaname = :schema
+        AND s.tablename = :table
+    """)
+    ratios = {}
+    for name, n_distinct, reltuples in conn.execute(query, {"schema": schema_name, "table": table_name}):
+        # 負數表示不同值佔行數的比例，正數為不同值的個數
+        if n_distinct < 0:
+            ratios[name] = -n_distinct
+        elif reltuples and reltuples > 0:
+            ratios[name] = min(n_distinct / reltuples, 1.0)
+    return ratios
+
+def table_fingerprint(conn, schema_name, table_name):
+    """由系統目錄計算表格內容的指紋（文件節點、大小、增刪改計數、註釋），表格被重新載入或修改後指紋改變；
+    視圖和分區表包含其依賴的表格；表格不存在時返回 None"""
+    query = text("""
+        WITH RECURSIVE rels(oid) AS (
+            SELECT c.oid
+            FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = :schema
+            AND c.relname = :table
+            UNION
+            SELECT e.child
+            FROM rels
+            JOIN (
+                SELECT r.ev_class AS parent, d.refobjid AS child
+                FROM pg_rewrite r
+                JOIN pg_depend d ON d.classid = 'pg_rewrite'::regclass
+                    AND d.objid = r.oid
+                    AND d.refclassid = 'pg_class'::regclass
+                    AND d.refobjid <> r.ev_class
+                UNION ALL
+                SELECT inhparent, inhrelid FROM pg_inherits
+            ) e ON e.parent = rels.oid
+        )
+        SELECT c.oid::regclass::text AS relation,
+               c.relkind,
+               c.relfilenode,
+               CASE WHEN c.relkind IN ('r', 'm', 'p') THEN pg_relation_size(c.oid) END AS size,
+               s.n_tup_ins,
+               s.n_tup_upd,
+               s.n_tup_del,
+               obj_description(c.oid, 'pg_class') AS description
+        FROM rels
+        JOIN pg_class c ON c.oid = rels.oid
+        LEFT JOIN pg_stat_all_tables s ON s.relid = c.oid
+        ORDER BY 1
+    """)
+    rows = conn.execute(query, {"schema": schema_name, "table": table_name}).fetchall()
+    if not rows:
+        return None
+    state = json.dumps([list(row) for row in rows], default=str)
+    return hashlib.sha1(state.encode('utf-8')).hexdigest()
+
+def estimate_row_count(conn, schema_name, table_name, exact=False):
+    """返回 (行數, 是否精確)；默認使用統計信息估算，exact=True 時才執行 COUNT(*)"""
+    if exact:
+        count_query = text(f"SELECT COUNT(*) FROM {schema_name}.{table_name}")
+        return int(conn.execute(count_query).scalar()), True
+
+    # 與規劃器相同的做法：按目前的頁數縮放 reltuples，沒有 ANALYZE 過時使用 n_live_tup
+    stats_query = text("""
+        SELECT c.relkind,
+               c.reltuples,
+               c.relpages,
+               CASE WHEN c.relkind IN ('r', 'm', 'p')
+                    THEN pg_relation_size(c.oid) / current_setting('block_size')::int
+               END AS current_pages,
+               s.n_live_tup
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        LEFT JOIN pg_stat_all_tables s ON s.relid = c.oid
+        WHERE n.nspname = :schema
+        AND c.relname = :table
+    """)
+    row = conn.execute(stats_query, {"schema": schema_name, "table": table_name}).fetchone()
+    if row is not None and row.relkind in ('r', 'm', 'p'):
+        if row.reltuples is not None and row.reltuples >= 0 and row.relpages > 0:
+            return int(row.reltuples / row.relpages * row.current_pages), False
+        if row.n_live_tup:
+            return int(row.n_live_tup), False
+        if row.current_pages == 0:
+            return 0, False
+
+    # 視圖或沒有統計信息的表：使用規劃器對整表查詢的行數估算
+    plan = conn.execute(text(f"EXPLAIN (FORMAT JSON) SELECT * FROM {schema_name}.{table_name}")).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows']), False
+
+def format_row_count(rows, exact):
+    """格式化行數；估算值加上「約」"""
+    return f"{rows:,}" if exact else f"約 {rows:,}"
+
+def scan_catalog(conn, schemas=None, exact_counts=False):
+    """一次查詢取得所有可訪問數據庫的表格、大小、估算行數和描述
+
+    返回 [(數據庫, 表格, 大小文字, 大小位元組, 行數, 描述), ...]，schemas 為 None 時掃描全部
+    """
+    schema_filter = "AND n.nspname = ANY(:schemas)" if schemas is not None else ""
+    query = text(f"""
+        SELECT n.nspname AS library,
+               c.relname AS table_name,
+               pg_size_pretty(pg_total_relation_size(c.oid)) AS size,
+               pg_total_relation_size(c.oid) AS size_bytes,
+               CASE
+                   WHEN c.reltuples >= 0 AND c.relpages > 0
+                       THEN (c.reltuples / c.relpages
+                             * (pg_relation_size(c.oid) / current_setting('block_size')::int))::bigint
+                   ELSE COALESCE(s.n_live_tup, 0)
+               END AS row_count,
+               obj_description(c.oid, 'pg_class') AS description
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        LEFT JOIN pg_stat_all_tables s ON s.relid = c.oid
+        WHERE c.relkind IN ('r', 'p')
+        AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+        AND n.nspname NOT LIKE 'pg\\_%'
+        AND has_schema_privilege(n.oid, 'USAGE')
+        AND has_table_privilege(c.oid, 'SELECT')
+        {schema_filter}
+        ORDER BY n.nspname, c.relname
+    """)
+    params = {"schemas": list(schemas)} if schemas is not None else {}
+    rows = [tuple(row) for row in conn.execute(query, params)]
+    if exact_counts:
+        rows = [
+            (lib, table, size, size_bytes, estimate_row_count(conn, lib, table, exact=True)[0], description)
+            for lib, table, size, size_bytes, _, description in rows
+        ]
+    return rows
+
+class SchemaAccess:
+    """一次查詢取得所有數據庫（schema）的訪問權限和描述，結果在本次執行中重複使用"""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._schemas = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._schemas is None:
+                query = text("""
+                    SELECT n.nspname AS library,
+                           has_schema_privilege(n.oid, 'USAGE') AS has_access,
+                           obj_description(n.oid, 'pg_namespace') AS description
+                    FROM pg_namespace n
+                    WHERE n.nspname NOT IN ('pg_catalog', 'information_schema')
+                    AND n.nspname NOT LIKE 'pg\\_%'
+                """)
+                self._schemas = {
+                    row.library: (bool(row.has_access), row.description or "")
+                    for row in self._conn.execute(query)
+                }
+            return self._schemas
+
+    def has_access(self, library):
+        """是否有該數據庫的 USAGE 權限（不存在的數據庫視為無權限）"""
+        return self._load().get(library, (False, ""))[0]
+
+    def description(self, library):
+        return self._load().get(library, (False, ""))[1]
+
+    def accessible(self, libraries):
+        """過濾出有訪問權限的數據庫，保持原順序"""
+        return [lib for lib in libraries if self.has_access(lib)]